@@ -0,0 +1,410 @@
+# Copyright (c) 2008 Alan Kligman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Throughput and latency of an Echo service over each transport. Every case
+# starts a server process and a client process on this host; the client keeps
+# depth batches of batch calls in flight on each of concurrency connections
+# (threads, for the synchronous transport) for the given number of seconds
+# after a warmup. Options taking a list run every combination:
+#
+#   python bench.py --transport tx-tcp,sync --payload 16,4096 --depth 1,16 \
+#       --output results.json --compare baseline.json
+#
+# Reported per case: calls/sec, latency percentiles, CPU seconds per call in
+# the client and the server, and the objects left for the cycle collector
+# per call in the client (the growth of gc.get_count() with the collector
+# off), along with the client's peak RSS. bench_pb2 is generated from
+# bench.proto by make.
+
+import os
+import sys
+import gc
+import time
+import json
+import platform
+import resource
+import subprocess
+import threading
+import multiprocessing
+from optparse import OptionParser
+
+from bench_pb2 import Bench, Bench_Stub, EchoRequest, EchoResponse
+
+transports = [ "tx-tcp", "tx-udp", "sync" ]
+
+class BenchService( Bench ):
+	def Echo( self, rpc_controller, request, done ):
+		response = EchoResponse()
+		response.payload = request.payload
+		done( response )
+
+def cpu_time():
+	usage = resource.getrusage( resource.RUSAGE_SELF )
+	return usage.ru_utime + usage.ru_stime
+
+# Runs in the server process: reports the address, then answers each message
+# from the parent with the CPU time used so far until told to stop.
+def serve( transport, options, conn ):
+	if transport == "sync":
+		from protobufrpc import synchronous
+		serverClass = getattr( synchronous, options.sync_server )
+		server = serverClass( ( "127.0.0.1", 0 ), BenchService() )
+		conn.send( server.server_address )
+		def control():
+			while conn.recv() != "stop":
+				conn.send( cpu_time() )
+			server.shutdown()
+		thread = threading.Thread( target=control )
+		thread.setDaemon( True )
+		thread.start()
+		server.serve_forever()
+		server.server_close()
+	else:
+		from twisted.internet import reactor
+		from protobufrpc import tx
+		if transport == "tx-tcp":
+			port = reactor.listenTCP( 0, tx.Factory( BenchService() ), interface="127.0.0.1" )
+		else:
+			channel = tx.UdpChannel()
+			channel.add_service( BenchService() )
+			port = reactor.listenUDP( 0, channel, interface="127.0.0.1" )
+		conn.send( ( port.getHost().host, port.getHost().port ) )
+		def control():
+			while conn.recv() != "stop":
+				conn.send( cpu_time() )
+			reactor.callFromThread( reactor.stop )
+		thread = threading.Thread( target=control )
+		thread.setDaemon( True )
+		thread.start()
+		reactor.run( installSignalHandlers=False )
+
+# Collects the latency of each call completed between the end of the warmup
+# and the end of the run. The parent is told when the warmup is over, so
+# that it can start counting the server's CPU time too.
+class Recorder( object ):
+	def __init__( self, options, conn ):
+		self.conn = conn
+		self.started = time.time()
+		self.warmEnd = self.started + options.warmup
+		self.end = self.warmEnd + options.duration
+		self.warm = False
+		self.latencies = []
+		self.errors = 0
+		self._lock = threading.Lock()
+
+	def running( self ):
+		return time.time() < self.end
+
+	def record( self, sent, failed ):
+		now = time.time()
+		self._lock.acquire()
+		try:
+			if now < self.warmEnd:
+				return
+			if not self.warm:
+				self._warmed( now )
+			if failed:
+				self.errors += 1
+			else:
+				self.latencies.append( now - sent )
+		finally:
+			self._lock.release()
+
+	def _warmed( self, now ):
+		self.warm = True
+		self.measured = now
+		self.conn.send( "warm" )
+		gc.collect()
+		gc.disable()
+		self.gcObjects = gc.get_count()[ 0 ]
+		self.cpu = cpu_time()
+
+	def result( self ):
+		finished = time.time()
+		cpu = cpu_time()
+		if not self.warm:
+			return None
+		gcObjects = gc.get_count()[ 0 ] - self.gcObjects
+		gc.enable()
+		calls = len( self.latencies )
+		seconds = finished - self.measured
+		latencies = sorted( self.latencies )
+		def percentile( p ):
+			if not latencies:
+				return None
+			return latencies[ min( int( p / 100.0 * len( latencies ) ), len( latencies ) - 1 ) ]
+		return { "calls": calls, "errors": self.errors, "seconds": seconds,
+			"calls_per_sec": calls / seconds,
+			"latency": { "mean": sum( latencies ) / max( calls, 1 ), "p50": percentile( 50 ),
+				"p99": percentile( 99 ), "p999": percentile( 99.9 ), "max": latencies and latencies[ -1 ] or None },
+			"client_cpu_per_call": ( cpu - self.cpu ) / max( calls, 1 ),
+			"gc_objects_per_call": float( gcObjects ) / max( calls, 1 ),
+			"client_max_rss_kb": resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss }
+
+def make_request( payload ):
+	request = EchoRequest()
+	request.payload = "x" * payload
+	return request
+
+# Runs in the client process for the tx transports: one connection per
+# concurrency, each running depth lanes that send a batch, wait for all of
+# its responses and send the next.
+def drive_tx( transport, addr, case, options, conn ):
+	from twisted.internet import reactor
+	from twisted.internet.protocol import ClientCreator
+	from twisted.internet.defer import Deferred, DeferredList
+	from protobufrpc import tx
+	from protobufrpc.common import Controller
+
+	recorder = Recorder( options, conn )
+	request = make_request( case[ "payload" ] )
+	lanes = [ case[ "concurrency" ] * case[ "depth" ] ]
+
+	def lane_done():
+		lanes[ 0 ] -= 1
+		if not lanes[ 0 ]:
+			conn.send( recorder.result() )
+			reactor.stop()
+
+	def lane( channel, stub ):
+		if not recorder.running():
+			lane_done()
+			return
+		sent = time.time()
+		calls = []
+		channel.start_batch()
+		for i in range( case[ "batch" ] ):
+			d = Deferred()
+			controller = Controller()
+			d.addCallback( lambda response, controller=controller: recorder.record( sent, controller.Failed() ) )
+			stub.Echo( controller, request, d.callback )
+			calls.append( d )
+		channel.end_batch()
+		DeferredList( calls ).addCallback( lambda results: lane( channel, stub ) )
+
+	def connected( channel ):
+		stub = Bench_Stub( channel )
+		for i in range( case[ "depth" ] ):
+			lane( channel, stub )
+
+	kwargs = { "timeout": options.timeout }
+	if transport == "tx-tcp":
+		client = ClientCreator( reactor, tx.TcpChannel, **kwargs )
+		for i in range( case[ "concurrency" ] ):
+			client.connectTCP( addr[ 0 ], addr[ 1 ] ).addCallback( connected )
+	else:
+		for i in range( case[ "concurrency" ] ):
+			channel = tx.UdpChannel( addr[ 0 ], addr[ 1 ], **kwargs )
+			reactor.listenUDP( 0, channel, interface="127.0.0.1" )
+			connected( channel )
+	reactor.run( installSignalHandlers=False )
+
+# Runs in the client process for the synchronous transport: a thread per
+# concurrency, each with a connection of its own. Batches are sent one at a
+# time; without batching, depth calls are pipelined.
+def drive_sync( addr, case, options, conn ):
+	from collections import deque
+	from protobufrpc import synchronous
+	from protobufrpc.common import Controller
+
+	recorder = Recorder( options, conn )
+	request = make_request( case[ "payload" ] )
+
+	def call( stub, sent ):
+		controller = Controller()
+		return stub.Echo( controller, request,
+			lambda response: recorder.record( sent, controller.Failed() ) )
+
+	def run():
+		if case[ "depth" ] > 1 and case[ "batch" ] == 1:
+			channel = synchronous.PipelinedTcpChannel( addr, max_pending=case[ "depth" ],
+				timeout=options.timeout )
+			stub = Bench_Stub( channel )
+			futures = deque()
+			while recorder.running():
+				while len( futures ) < case[ "depth" ]:
+					futures.append( call( stub, time.time() ) )
+				futures.popleft().wait()
+			for future in futures:
+				future.wait()
+		else:
+			channel = synchronous.TcpChannel( addr, timeout=options.timeout )
+			stub = Bench_Stub( channel )
+			while recorder.running():
+				sent = time.time()
+				channel.start_batch()
+				for i in range( case[ "batch" ] ):
+					call( stub, sent )
+				channel.end_batch()
+		channel.close()
+
+	threads = [ threading.Thread( target=run ) for i in range( case[ "concurrency" ] ) ]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	conn.send( recorder.result() )
+
+def drive( transport, addr, case, options, conn ):
+	if transport == "sync":
+		drive_sync( addr, case, options, conn )
+	else:
+		drive_tx( transport, addr, case, options, conn )
+
+def run_case( case, options ):
+	serverConn, serverEnd = multiprocessing.Pipe()
+	server = multiprocessing.Process( target=serve, args=( case[ "transport" ], options, serverEnd ) )
+	server.start()
+	addr = serverConn.recv()
+
+	clientConn, clientEnd = multiprocessing.Pipe()
+	client = multiprocessing.Process( target=drive,
+		args=( case[ "transport" ], addr, case, options, clientEnd ) )
+	client.start()
+	result = None
+	serverCpu = None
+	deadline = time.time() + options.warmup + options.duration + 60
+	while time.time() < deadline:
+		if not clientConn.poll( 1 ):
+			if not client.is_alive():
+				break
+			continue
+		message = clientConn.recv()
+		if message == "warm":
+			serverConn.send( "cpu" )
+			serverCpu = serverConn.recv()
+		else:
+			result = message
+			break
+	if result is not None:
+		serverConn.send( "cpu" )
+		result[ "server_cpu_per_call" ] = ( serverConn.recv() - serverCpu ) / max( result[ "calls" ], 1 )
+	serverConn.send( "stop" )
+	client.join( 10 )
+	server.join( 10 )
+	for process in ( client, server ):
+		if process.is_alive():
+			process.terminate()
+	if result is not None:
+		result.update( case )
+	return result
+
+def split( value, convert=str ):
+	return [ convert( v ) for v in value.split( "," ) ]
+
+def revision():
+	try:
+		return subprocess.Popen( [ "git", "rev-parse", "HEAD" ], stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE, cwd=os.path.dirname( os.path.abspath( __file__ ) ) ).communicate()[ 0 ].strip()
+	except OSError:
+		return None
+
+def key( result ):
+	return tuple( [ result[ k ] for k in ( "transport", "concurrency", "payload", "batch", "depth" ) ] )
+
+def describe( result ):
+	return "%-7s c=%-3d payload=%-6d batch=%-3d depth=%-3d" % key( result )
+
+def report( result ):
+	latency = result[ "latency" ]
+	def ms( seconds ):
+		if seconds is None:
+			return "-"
+		return "%.3f" % ( seconds * 1000 )
+	print "%s %9.0f calls/s  p50 %sms p99 %sms p999 %sms  cpu %.1f+%.1fus/call  gc %.2f/call  errors %d" % (
+		describe( result ), result[ "calls_per_sec" ], ms( latency[ "p50" ] ), ms( latency[ "p99" ] ),
+		ms( latency[ "p999" ] ), result[ "client_cpu_per_call" ] * 1e6, result[ "server_cpu_per_call" ] * 1e6,
+		result[ "gc_objects_per_call" ], result[ "errors" ] )
+
+def compare( results, baseline ):
+	previous = dict( [ ( key( r ), r ) for r in baseline[ "results" ] ] )
+	print
+	print "compared with %s (%s):" % ( baseline.get( "revision" ), baseline.get( "started" ) )
+	for result in results:
+		old = previous.get( key( result ) )
+		if old is None:
+			continue
+		def change( new, old ):
+			if not new or not old:
+				return "     -"
+			return "%+5.1f%%" % ( ( new - old ) * 100.0 / old )
+		print "%s calls/s %s  p99 %s  cpu/call %s" % ( describe( result ),
+			change( result[ "calls_per_sec" ], old[ "calls_per_sec" ] ),
+			change( result[ "latency" ][ "p99" ], old[ "latency" ][ "p99" ] ),
+			change( result[ "client_cpu_per_call" ] + result[ "server_cpu_per_call" ],
+				old[ "client_cpu_per_call" ] + old[ "server_cpu_per_call" ] ) )
+
+def main( argv ):
+	parser = OptionParser( usage="%prog [options]" )
+	parser.add_option( "--transport", default=",".join( transports ),
+		help="comma-separated transports out of %s [%%default]" % ", ".join( transports ) )
+	parser.add_option( "--concurrency", default="1,8", help="connections, or threads for sync [%default]" )
+	parser.add_option( "--payload", default="16,1024", help="request and response payload bytes [%default]" )
+	parser.add_option( "--batch", default="1", help="calls sent in one frame [%default]" )
+	parser.add_option( "--depth", default="1,16", help="batches in flight per connection [%default]" )
+	parser.add_option( "--duration", type="float", default=5, help="measured seconds per case [%default]" )
+	parser.add_option( "--warmup", type="float", default=1, help="unmeasured seconds per case [%default]" )
+	parser.add_option( "--timeout", type="float", default=5,
+		help="seconds after which a call counts as an error [%default]" )
+	parser.add_option( "--sync-server", default="ThreadPoolTcpServer",
+		help="synchronous server class [%default]" )
+	parser.add_option( "--output", help="write the results to this JSON file" )
+	parser.add_option( "--compare", help="compare with the results in this JSON file" )
+	options, args = parser.parse_args( argv )
+
+	for transport in split( options.transport ):
+		if transport not in transports:
+			parser.error( "unknown transport %r" % transport )
+	cases = []
+	for transport in split( options.transport ):
+		for concurrency in split( options.concurrency, int ):
+			for payload in split( options.payload, int ):
+				for batch in split( options.batch, int ):
+					for depth in split( options.depth, int ):
+						cases.append( { "transport": transport, "concurrency": concurrency,
+							"payload": payload, "batch": batch, "depth": depth } )
+
+	run = { "started": time.strftime( "%Y-%m-%dT%H:%M:%S" ), "revision": revision(),
+		"python": platform.python_version(), "platform": platform.platform(),
+		"cpus": multiprocessing.cpu_count(), "duration": options.duration, "warmup": options.warmup,
+		"sync_server": options.sync_server, "results": [] }
+	for case in cases:
+		result = run_case( case, options )
+		if result is None:
+			print "%s failed" % describe( case )
+			continue
+		report( result )
+		run[ "results" ].append( result )
+
+	if options.output:
+		f = open( options.output, "w" )
+		try:
+			json.dump( run, f, indent=2, sort_keys=True )
+		finally:
+			f.close()
+	if options.compare:
+		f = open( options.compare )
+		try:
+			compare( run[ "results" ], json.load( f ) )
+		finally:
+			f.close()
+
+if __name__ == "__main__":
+	main( sys.argv[ 1: ] )
@@ -0,0 +1,698 @@
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# The asyncio counterpart of protobufrpc.tx, speaking the same wire format.
+# It is written against plain Protocol callbacks and Futures rather than
+# coroutines, so it also runs on trollius and on uvloop.
+#
+#   transport, channel = await loop.create_connection( TcpChannel, host, port )
+#   proxy = Proxy( Test_Stub( channel ) )
+#   response = await proxy.Test.Echo( request )
+#
+#   server = await loop.create_server( Factory( TestService() ), host, port )
+#
+# As in tx, calls carry their timeout to the server, and a call that times
+# out, is cancelled through its controller's StartCancel() or has its future
+# cancelled is cancelled on the server as well. single_flight=SingleFlight(...)
+# collapses identical calls in flight, and on a Factory identical requests
+# being served, as it does in tx.
+
+import struct
+import time
+from collections import deque
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+import google.protobuf.service
+from protobufrpc.protobufrpc_pb2 import Rpc, Request, Response, Error
+from protobufrpc.common import Controller, RpcErrors, RpcError, DispatchTable, PendingCalls, method_name, method_number
+from protobufrpc.common import Compressor, request_timeout, encode_request
+
+__all__ = [ "TcpChannel", "Stream", "Proxy", "Factory" ]
+
+try:
+    StopAsyncIteration
+except NameError:
+    StopAsyncIteration = None
+
+_header = struct.Struct( "!I" )
+
+class TcpChannel( asyncio.Protocol, google.protobuf.service.RpcChannel ):
+    id = 0
+    def __init__( self, batch=False, batch_window=0, batch_bytes=65536, max_in_flight=None,
+            compact_methods=False, timeout=None, max_pending=None, block=True, max_waiting=1024,
+            compression=None, compression_threshold=1024, single_flight=None, loop=None ):
+        google.protobuf.service.RpcChannel.__init__( self )
+        self._loop = loop or asyncio.get_event_loop()
+        self.transport = None
+        # Outstanding calls, as in tx: dropped on response or timeout, and
+        # beyond max_pending either queued in self._waiting, with their
+        # deadline already armed and up to max_waiting of them, or failed.
+        self._pending = PendingCalls( timeout, max_pending )
+        self._block = block
+        self._maxWaiting = max_waiting
+        self._waiting = deque()
+        self._expireHandle = None
+        self._expireAt = None
+        self._dispatch = DispatchTable()
+        self._compactMethods = compact_methods
+        self._buffer = bytearray()
+        self._offset = 0
+        # Requests (when batching) and finished responses are gathered into
+        # self._outgoing and written as one frame by flush().
+        self._batching = batch
+        self._batchWindow = batch_window
+        self._batchBytes = batch_bytes
+        self._outgoing = None
+        self._outgoingSize = 0
+        self._flushHandle = None
+        self._dispatching = False
+        # Reading is paused while the transport's write buffer is above its
+        # high-water mark or max_in_flight requests are being handled.
+        self._maxInFlight = max_in_flight
+        self._inFlight = 0
+        self._readingPaused = False
+        self._writingPaused = False
+        self._drainWaiters = []
+        # Client-streamed calls being received, by id.
+        self._streams = {}
+        # The controllers of requests being served, by id, so that the
+        # client can cancel them, and the last few cancelled requests that
+        # had not arrived yet.
+        self._serving = {}
+        self._cancelled = set()
+        self._compressor = Compressor( compression, compression_threshold )
+        # Collapses identical calls and requests in flight; see SingleFlight.
+        self._singleFlight = single_flight
+
+    def add_service( self, service ):
+        self._dispatch.add_service( service )
+
+    def connection_made( self, transport ):
+        self.transport = transport
+
+    def connection_lost( self, exc ):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        if self._expireHandle is not None:
+            self._expireHandle.cancel()
+            self._expireHandle = None
+        self._outgoing = None
+        if exc is None:
+            exc = RuntimeError( "connection lost" )
+        waiting, self._waiting = self._waiting, deque()
+        for id, call in self._pending.clear():
+            if isinstance( call, Stream ):
+                call.fail( exc )
+            elif not call[ 0 ].done():
+                call[ 0 ].set_exception( exc )
+        for call in waiting:
+            if not call[ 0 ].done():
+                call[ 0 ].set_exception( exc )
+        self._wake_drain_waiters()
+
+    def data_received( self, data ):
+        self._buffer.extend( data )
+        buffer = self._buffer
+        while len( buffer ) - self._offset >= _header.size:
+            length = _header.unpack_from( buffer, self._offset )[ 0 ]
+            start = self._offset + _header.size
+            if len( buffer ) < start + length:
+                break
+            self._offset = start + length
+            self.string_received( bytes( buffer[ start:self._offset ] ) )
+        if self._offset == len( buffer ):
+            del buffer[ : ]
+            self._offset = 0
+        elif self._offset > 65536:
+            del buffer[ :self._offset ]
+            self._offset = 0
+
+    def string_received( self, data ):
+        rpc = Rpc()
+        rpc.ParseFromString( data )
+
+        self._dispatching = True
+        try:
+            self.dispatch_requests( rpc )
+        finally:
+            self._dispatching = False
+        if self._outgoing is not None and len( self._outgoing.response ):
+            self.flush()
+
+        for serializedResponse in rpc.response:
+            pending = self._pending.get( serializedResponse.id )
+            if pending is None:
+                continue
+            try:
+                self._compressor.decode( serializedResponse, 'serialized_response' )
+            except ValueError:
+                serializedResponse = self.error_response( serializedResponse.id, RpcErrors.CANNOT_DECOMPRESS )
+            if isinstance( pending, Stream ):
+                if not serializedResponse.more:
+                    self._pending.pop( serializedResponse.id )
+                pending.callback( serializedResponse )
+                continue
+            self._pending.pop( serializedResponse.id )
+            future, responseClass, rpcController = pending
+            if future.done():
+                continue
+            if serializedResponse.HasField( 'error' ):
+                if rpcController is not None:
+                    rpcController.SetFailed( serializedResponse.error.text )
+                future.set_exception( RpcError( serializedResponse.error.code,
+                    serializedResponse.error.text ) )
+            else:
+                response = responseClass()
+                response.ParseFromString( serializedResponse.serialized_response )
+                future.set_result( response )
+        if self._waiting:
+            self._release_waiting()
+
+    def dispatch_requests( self, rpc ):
+        for serializedRequest in rpc.request:
+            id = serializedRequest.id
+            if serializedRequest.cancel:
+                self._cancel_request( id )
+                continue
+            if id in self._cancelled:
+                self._cancelled.discard( id )
+                self._streams.pop( id, None )
+                continue
+            stream = self._streams.get( id )
+            if stream is not None:
+                entry, controller = stream
+                if not serializedRequest.more:
+                    del self._streams[ id ]
+            else:
+                entry = self._dispatch.lookup( serializedRequest )
+                if entry is None:
+                    self.sendError( id, self._dispatch.error_code( serializedRequest ) )
+                    continue
+                controller = Controller()
+                controller.writer = self._stream_writer( id )
+                if serializedRequest.more:
+                    self._streams[ id ] = ( entry, controller )
+            controller.more = serializedRequest.more
+            if serializedRequest.HasField( 'timeout' ):
+                controller.deadline = time.time() + serializedRequest.timeout / 1000.0
+
+            try:
+                self._compressor.decode( serializedRequest, 'serialized_request' )
+            except ValueError:
+                self._streams.pop( id, None )
+                self.sendError( id, RpcErrors.CANNOT_DECOMPRESS )
+                continue
+
+            # Only the last call of a client-streamed request is expected to
+            # call done, so only that one counts towards max_in_flight.
+            counted = not serializedRequest.more
+            flight = None
+            if self._singleFlight is not None and stream is None and counted and \
+                    self._singleFlight.enabled( entry.name ):
+                if not self._singleFlight.start( entry.name, serializedRequest.serialized_request,
+                        self._shared_response( id ) ):
+                    continue
+                # The leader answers the identical requests too, so it runs
+                # to the end even if its own client gives up or its deadline
+                # passes; only its own reply is dropped then.
+                flight = ( entry.name, serializedRequest.serialized_request, controller.deadline )
+                controller.deadline = None
+
+            if stream is not None and not serializedRequest.HasField( 'serialized_request' ):
+                request = None
+            else:
+                request = entry.requestClass()
+                request.ParseFromString( serializedRequest.serialized_request )
+            if counted:
+                self._inFlight += 1
+                self._serving[ id ] = None if flight is not None else controller
+                self._update_reading()
+            entry.service.CallMethod( entry.method, controller, request,
+                self._method_done( id, controller, counted, flight ) )
+
+    # Requests cancelled before they arrive are dropped when they do; those
+    # being served stop counting towards max_in_flight, and their response
+    # is never sent.
+    def _cancel_request( self, id ):
+        if id not in self._serving:
+            self._streams.pop( id, None )
+            if len( self._cancelled ) >= 1024:
+                self._cancelled.clear()
+            self._cancelled.add( id )
+            return
+        controller = self._serving[ id ]
+        if controller is None:
+            return
+        del self._serving[ id ]
+        self._inFlight -= 1
+        self._update_reading()
+        controller.StartCancel()
+
+    def _method_done( self, id, controller, counted=True, flight=None ):
+        def done( response ):
+            if counted:
+                if id not in self._serving:
+                    return
+                del self._serving[ id ]
+                self._inFlight -= 1
+            if controller.IsCancelled():
+                self._update_reading()
+                return
+            serializedResponse = Response()
+            serializedResponse.id = id
+            if controller.Failed():
+                serializedResponse.error.code = 1
+                serializedResponse.error.text = controller.ErrorText()
+            elif response is not None:
+                serializedResponse.serialized_response = response.SerializeToString()
+            if flight is not None:
+                name, data, deadline = flight
+                self._singleFlight.finish( name, data, serializedResponse )
+                if deadline is not None and time.time() >= deadline:
+                    self._update_reading()
+                    return
+            self.queue_response( serializedResponse )
+            self._update_reading()
+        return done
+
+    # Answers request id with the response to an identical request.
+    def _shared_response( self, id ):
+        def deliver( serializedResponse ):
+            response = Response()
+            response.CopyFrom( serializedResponse )
+            response.id = id
+            self.queue_response( response )
+        return deliver
+
+    def _stream_writer( self, id ):
+        def write( message ):
+            serializedResponse = Response()
+            serializedResponse.id = id
+            serializedResponse.more = True
+            serializedResponse.serialized_response = message.SerializeToString()
+            self.queue_response( serializedResponse )
+            self.flush()
+        return write
+
+    def error_response( self, id, code ):
+        serializedResponse = Response()
+        serializedResponse.id = id
+        serializedResponse.error.code = code
+        serializedResponse.error.text = RpcErrors.msgs[ code ]
+        return serializedResponse
+
+    def sendError( self, id, code ):
+        self.queue_response( self.error_response( id, code ) )
+
+    def queue_response( self, serializedResponse ):
+        if self.transport is None:
+            return
+        rpcResponse = self._outgoing_rpc().response.add()
+        rpcResponse.CopyFrom( serializedResponse )
+        if rpcResponse.HasField( 'serialized_response' ):
+            self._compressor.encode( rpcResponse, 'serialized_response', rpcResponse.serialized_response )
+        if not self._dispatching and self._flushHandle is None:
+            self._flushHandle = self._loop.call_soon( self.flush )
+
+    def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done ):
+        future = asyncio.Future( loop=self._loop )
+        if done is not None:
+            future.add_done_callback( _callback( done ) )
+        if self._singleFlight is not None and \
+                self._join_flight( future, methodDescriptor, rpcController, request, responseClass ):
+            return future
+        if not self._pending.full():
+            self._send_call( future, methodDescriptor, rpcController, request, responseClass )
+        elif self._block and ( self._maxWaiting is None or len( self._waiting ) < self._maxWaiting ):
+            deadline = self._pending.deadline( self._loop.time(), getattr( rpcController, "timeout", None ) )
+            self._waiting.append( ( future, methodDescriptor, rpcController, request, responseClass, deadline ) )
+            if deadline is not None:
+                self._schedule_expiry( deadline )
+        else:
+            self._fail_call( future, rpcController, RpcErrors.TOO_MANY_PENDING )
+        return future
+
+    # Whether an identical call is already in flight, in which case future
+    # gets a copy of its response, or its failure.
+    def _join_flight( self, future, methodDescriptor, rpcController, request, responseClass ):
+        name = method_name( methodDescriptor )
+        if not self._singleFlight.enabled( name ):
+            return False
+        data = request.SerializeToString()
+        def deliver( first ):
+            if future.done():
+                return
+            if first.cancelled():
+                self._fail_call( future, rpcController, RpcErrors.CANCELLED )
+            elif first.exception() is not None:
+                if rpcController is not None:
+                    rpcController.SetFailed( str( first.exception() ) )
+                future.set_exception( first.exception() )
+            else:
+                response = responseClass()
+                response.CopyFrom( first.result() )
+                future.set_result( response )
+        if not self._singleFlight.start_call( name, data, deliver ):
+            return True
+        future.add_done_callback( lambda future: self._singleFlight.finish_call( name, data, future ) )
+        return False
+
+    def _send_call( self, future, methodDescriptor, rpcController, request, responseClass, deadline=None ):
+        self.id += 1
+        id = self.id
+        deadline = self._add_pending( id, ( future, responseClass, rpcController ), rpcController, deadline )
+        future.add_done_callback( lambda future: future.cancelled() and self.cancel_call( id ) )
+        self._send_request( methodDescriptor, request, id, False, deadline )
+
+    def _add_pending( self, id, call, rpcController, deadline=None ):
+        deadline = self._pending.add( id, call, self._loop.time(), getattr( rpcController, "timeout", None ),
+            deadline )
+        if deadline is not None:
+            self._schedule_expiry( deadline )
+        if isinstance( rpcController, Controller ):
+            rpcController.canceller = lambda: self.cancel_call( id )
+        return deadline
+
+    # Fails call id with RpcErrors.CANCELLED, unless its future was
+    # cancelled, and tells the server to stop working on it.
+    def cancel_call( self, id ):
+        call = self._pending.pop( id )
+        if call is None:
+            return
+        self.send_cancels( [ id ] )
+        if isinstance( call, Stream ):
+            call.fail( RpcError( RpcErrors.CANCELLED ) )
+        elif not call[ 0 ].done():
+            self._fail_call( call[ 0 ], call[ 2 ], RpcErrors.CANCELLED )
+        self._release_waiting()
+
+    def send_cancels( self, ids ):
+        if self.transport is None or not ids:
+            return
+        data = b"".join( [ encode_request( id, cancel=True ) for id in ids ] )
+        self.transport.write( _header.pack( len( data ) ) + data )
+
+    def open_stream( self, methodDescriptor, responseClass, rpcController=None ):
+        self.id += 1
+        stream = Stream( self, self.id, methodDescriptor, responseClass, rpcController )
+        self._add_pending( self.id, stream, rpcController )
+        return stream
+
+    def call_stream( self, methodDescriptor, request, responseClass, rpcController=None ):
+        stream = self.open_stream( methodDescriptor, responseClass, rpcController )
+        stream.close( request )
+        return stream
+
+    # Only the first request of a stream names the method.
+    def send_stream_request( self, stream, request, more ):
+        self._send_request( stream.method, request, stream.id, more )
+        stream.method = None
+
+    def _send_request( self, methodDescriptor, request, id, more, deadline=None ):
+        if self._batching:
+            rpc = self._outgoing_rpc()
+        else:
+            rpc = Rpc()
+        rpcRequest = rpc.request.add()
+        if methodDescriptor is not None:
+            if self._compactMethods:
+                rpcRequest.method_id = method_number( method_name( methodDescriptor ) )
+            else:
+                rpcRequest.method = method_name( methodDescriptor )
+        if request is not None:
+            self._compressor.encode( rpcRequest, 'serialized_request', request.SerializeToString() )
+        rpcRequest.id = id
+        if more:
+            rpcRequest.more = True
+        if deadline is not None:
+            rpcRequest.timeout = request_timeout( deadline, self._loop.time() )
+
+        if not self._batching:
+            self.send_rpc( rpc )
+        else:
+            self._outgoingSize += rpcRequest.ByteSize()
+            if self._outgoingSize >= self._batchBytes:
+                self.flush()
+            elif self._flushHandle is None:
+                self._flushHandle = self._loop.call_later( self._batchWindow, self.flush )
+
+    def _fail_call( self, future, rpcController, code ):
+        if rpcController is not None:
+            rpcController.SetFailed( RpcErrors.msgs[ code ] )
+        future.set_exception( RpcError( code ) )
+
+    def _schedule_expiry( self, deadline ):
+        if self._expireHandle is not None:
+            if self._expireAt <= deadline:
+                return
+            self._expireHandle.cancel()
+        self._expireAt = deadline
+        self._expireHandle = self._loop.call_at( deadline, self.expire_calls )
+
+    def expire_calls( self ):
+        self._expireHandle = None
+        now = self._loop.time()
+        expired = self._pending.expire( now )
+        for id, call in expired:
+            if isinstance( call, Stream ):
+                call.fail( RpcError( RpcErrors.TIMEOUT ) )
+            elif not call[ 0 ].done():
+                self._fail_call( call[ 0 ], call[ 2 ], RpcErrors.TIMEOUT )
+        self.send_cancels( [ id for id, call in expired ] )
+        # Waiting calls have no id yet, so there is nothing to cancel.
+        waiting = deque()
+        for call in self._waiting:
+            if call[ 5 ] is not None and call[ 5 ] <= now:
+                if not call[ 0 ].done():
+                    self._fail_call( call[ 0 ], call[ 2 ], RpcErrors.TIMEOUT )
+            else:
+                waiting.append( call )
+        self._waiting = waiting
+        deadlines = [ call[ 5 ] for call in waiting if call[ 5 ] is not None ]
+        deadline = self._pending.next_deadline()
+        if deadline is not None:
+            deadlines.append( deadline )
+        if deadlines:
+            self._schedule_expiry( min( deadlines ) )
+        self._release_waiting()
+
+    def _release_waiting( self ):
+        while self._waiting and not self._pending.full():
+            call = self._waiting.popleft()
+            if call[ 0 ].done():
+                continue
+            if call[ 5 ] is not None and call[ 5 ] <= self._loop.time():
+                self._fail_call( call[ 0 ], call[ 2 ], RpcErrors.TIMEOUT )
+            else:
+                self._send_call( *call )
+
+    def _outgoing_rpc( self ):
+        if self._outgoing is None:
+            self._outgoing = Rpc()
+            self._outgoingSize = 0
+        return self._outgoing
+
+    def flush( self ):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        rpc, self._outgoing = self._outgoing, None
+        if rpc is not None and ( len( rpc.request ) or len( rpc.response ) ):
+            self.send_rpc( rpc )
+
+    def send_rpc( self, rpc ):
+        data = rpc.SerializeToString()
+        self.transport.write( _header.pack( len( data ) ) + data )
+
+    def pause_writing( self ):
+        self._writingPaused = True
+        self._update_reading()
+
+    def resume_writing( self ):
+        self._writingPaused = False
+        self._update_reading()
+        self._wake_drain_waiters()
+
+    def drain( self ):
+        future = asyncio.Future( loop=self._loop )
+        if self._writingPaused and self.transport is not None:
+            self._drainWaiters.append( future )
+        else:
+            future.set_result( None )
+        return future
+
+    def _wake_drain_waiters( self ):
+        waiters, self._drainWaiters = self._drainWaiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result( None )
+
+    def _update_reading( self ):
+        if self.transport is None:
+            return
+        overloaded = self._writingPaused or ( self._maxInFlight is not None
+            and self._inFlight >= self._maxInFlight )
+        if overloaded and not self._readingPaused:
+            self._readingPaused = True
+            self.transport.pause_reading()
+        elif not overloaded and self._readingPaused:
+            self._readingPaused = False
+            self.transport.resume_reading()
+
+# The client end of a streamed call, from TcpChannel.open_stream or
+# call_stream. It is an async iterator over the responses, and next()
+# returns a future for the next one, which resolves to None once the stream
+# has ended; both raise RpcError if the call failed. Methods that take a
+# stream of requests are fed with write(), and close() ends the stream,
+# optionally with one last request.
+class Stream( object ):
+    def __init__( self, channel, id, methodDescriptor, responseClass, rpcController ):
+        self.id = id
+        self.method = methodDescriptor
+        self._channel = channel
+        self._responseClass = responseClass
+        self._controller = rpcController
+        self._responses = deque()
+        self._waiters = deque()
+        self._finished = False
+        self._error = None
+
+    def write( self, request ):
+        self._channel.send_stream_request( self, request, True )
+
+    def close( self, request=None ):
+        self._channel.send_stream_request( self, request, False )
+
+    def next( self ):
+        return self._next( None )
+
+    def __aiter__( self ):
+        return self
+
+    def __anext__( self ):
+        return self._next( StopAsyncIteration )
+
+    def _next( self, end ):
+        future = asyncio.Future( loop=self._channel._loop )
+        if self._responses:
+            future.set_result( self._responses.popleft() )
+        elif self._finished:
+            self._end( future, end )
+        else:
+            self._waiters.append( ( future, end ) )
+        return future
+
+    def _end( self, future, end ):
+        if future.done():
+            return
+        if self._error is not None:
+            future.set_exception( self._error )
+        elif end is None:
+            future.set_result( None )
+        else:
+            future.set_exception( end() )
+
+    def callback( self, serializedResponse ):
+        if serializedResponse.HasField( 'error' ):
+            self.fail( RpcError( serializedResponse.error.code, serializedResponse.error.text ) )
+            return
+        if serializedResponse.HasField( 'serialized_response' ):
+            response = self._responseClass()
+            response.ParseFromString( serializedResponse.serialized_response )
+            while self._waiters:
+                future, end = self._waiters.popleft()
+                if not future.done():
+                    future.set_result( response )
+                    break
+            else:
+                self._responses.append( response )
+        if not serializedResponse.more:
+            self._finish()
+
+    def fail( self, exception ):
+        if self._controller is not None:
+            self._controller.SetFailed( str( exception ) )
+        self._error = exception
+        self._finish()
+
+    def _finish( self ):
+        self._finished = True
+        waiters, self._waiters = self._waiters, deque()
+        for future, end in waiters:
+            self._end( future, end )
+
+def _callback( done ):
+    def callback( future ):
+        if not future.cancelled() and future.exception() is None:
+            done( future.result() )
+    return callback
+
+class Factory( object ):
+    protocol = TcpChannel
+
+    def __init__( self, *services, **kwargs ):
+        self._dispatch = DispatchTable( services )
+        self._kwargs = kwargs
+
+    def __call__( self ):
+        p = self.protocol( **self._kwargs )
+        p.factory = self
+        p._dispatch = self._dispatch
+        return p
+
+class Proxy( object ):
+    # Holds a _Method for each method of the stub's service, built once from
+    # its descriptor.
+    class _Proxy( object ):
+        def __init__( self, stub ):
+            self._stub = stub
+            for method in stub.GetDescriptor().methods:
+                setattr( self, method.name, Proxy._Method( stub, method ) )
+
+    # proxy.Service.Method( request ) returns a future for the response;
+    # proxy.Service.Method.stream( request ) a Stream of responses, and
+    # proxy.Service.Method.open() a Stream to write requests to. Failures
+    # raise RpcError from the future, so no Controller is needed; one given
+    # is told why too, and may be Reset() and passed again.
+    class _Method( object ):
+        def __init__( self, stub, method ):
+            self._channel = stub.rpc_channel
+            self._method = method
+            self._responseClass = stub.GetResponseClass( method )
+
+        def __call__( self, request, controller=None ):
+            return self._channel.CallMethod( self._method, controller, request, self._responseClass, None )
+
+        def stream( self, request ):
+            stream = self.open()
+            stream.close( request )
+            return stream
+
+        def open( self ):
+            return self._channel.open_stream( self._method, self._responseClass, Controller() )
+
+    def __init__( self, *stubs ):
+        self._stubs = {}
+        for s in stubs:
+            self._stubs[ s.GetDescriptor().name ] = self._Proxy( s )
+
+    def __getattr__( self, key ):
+        return self._stubs[ key ]
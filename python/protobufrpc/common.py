@@ -18,8 +18,31 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import zlib
+import heapq
+import random
+import threading
+import time
+import functools
+from collections import OrderedDict
 from google.protobuf.service import RpcController
 
+try:
+    from google.protobuf.internal import api_implementation
+    _pythonProtobuf = api_implementation.Type() == "python"
+except ImportError:
+    _pythonProtobuf = True
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
 def flatten( l ):
     result = []
     for i in l:
@@ -31,9 +54,39 @@ def flatten( l ):
 
 class Controller( RpcController ):
     error = None
+    # Seconds to wait for the response before the call fails with
+    # RpcErrors.TIMEOUT; None falls back to the channel's timeout.
+    timeout = None
+    # Streaming, on the server side. A method called for a client-streamed
+    # request finds more set while further requests of the stream are to
+    # come; it is called once per request, with the same controller, and
+    # the final call may get None if the client ended the stream without a
+    # message. A method streams its response by calling write() for each
+    # message before done().
+    more = False
+    writer = None
+    # Cancellation. On the client side, StartCancel() fails the call the
+    # controller was last used for with RpcErrors.CANCELLED and tells the
+    # server, through the canceller set by the channel. On the server side
+    # the channel calls StartCancel() when the client gives up, and the call
+    # also counts as cancelled once deadline (a time.time(), from the
+    # timeout the client sent) has passed; either way no response is sent.
+    cancelled = False
+    canceller = None
+    deadline = None
+    _cancelCallbacks = None
 
+    # Back to a new controller's state, timeout included, so that it can be
+    # passed to another call.
     def Reset( self ):
         self.error = None
+        self.timeout = None
+        self.more = False
+        self.writer = None
+        self.cancelled = False
+        self.canceller = None
+        self.deadline = None
+        self._cancelCallbacks = None
 
     def Failed( self ):
         return self.error != None
@@ -42,16 +95,901 @@ class Controller( RpcController ):
         return self.error
 
     def StartCancel( self ):
-        pass
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.canceller is not None:
+            self.canceller()
+        callbacks, self._cancelCallbacks = self._cancelCallbacks or [], None
+        for callback in callbacks:
+            callback()
 
     def SetFailed( self, reason ):
         self.error = reason
 
     def IsCancelled( self ):
-        pass
+        return self.cancelled or ( self.deadline is not None and time.time() >= self.deadline )
 
+    # callback is called once, when StartCancel() is.
     def NotifyOnCancel( self, callback ):
-        pass
+        if self.cancelled:
+            callback()
+        elif self._cancelCallbacks is None:
+            self._cancelCallbacks = [ callback ]
+        else:
+            self._cancelCallbacks.append( callback )
+
+    def write( self, message ):
+        if self.writer is None:
+            raise RuntimeError( "this call cannot stream responses" )
+        self.writer( message )
+
+class RpcErrors:
+    SUCCESS = 0
+    UNSERIALIZE_RPC = 1
+    SERVICE_NOT_FOUND = 2
+    METHOD_NOT_FOUND = 3
+    CANNOT_DESERIALIZE_REQUEST = 4
+    TIMEOUT = 5
+    TOO_MANY_PENDING = 6
+    CONNECTION_LOST = 7
+    CANNOT_DECOMPRESS = 8
+    CANCELLED = 9
+
+    msgs = ['Success',
+            'Error when unserializing Rpc message',
+            'Service not found',
+            'Method not found',
+            'Cannot deserialized request',
+            'Request timed out',
+            'Too many pending requests',
+            'Connection lost',
+            'Cannot decompress payload',
+            'Request cancelled']
+
+# The RpcErrors code of a failure given its text, 1 for failures that
+# services set themselves.
+def error_code( text ):
+    try:
+        return RpcErrors.msgs.index( text )
+    except ValueError:
+        return 1
+
+# The Request.timeout to send for a call due at deadline.
+def request_timeout( deadline, now ):
+    return max( int( ( deadline - now ) * 1000 ), 1 )
+
+class RpcError( Exception ):
+    def __init__( self, code, text=None ):
+        if text is None:
+            text = RpcErrors.msgs[ code ]
+        Exception.__init__( self, text )
+        self.code = code
+        self.text = text
+
+_methodNames = {}
+
+def method_name( methodDescriptor ):
+    try:
+        return _methodNames[ methodDescriptor ]
+    except KeyError:
+        name = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
+        _methodNames[ methodDescriptor ] = name
+        return name
+
+# The compact wire form of a method name, sent as Request.method_id in place
+# of the name by channels created with compact_methods=True.
+def method_number( name ):
+    return zlib.crc32( name.encode( "utf-8" ) ) & 0xffffffff
+
+# The bytes of a serialized message, passed on without being parsed. It
+# stands in for a message class wherever one would be parsed: ParseFromString
+# keeps the bytes and SerializeToString gives them back.
+class RawMessage( object ):
+    __slots__ = ( "data", )
+
+    def __init__( self, data=b"" ):
+        self.data = data
+
+    def ParseFromString( self, data ):
+        if isinstance( data, memoryview ):
+            data = data.tobytes()
+        self.data = data
+
+    def SerializeToString( self ):
+        return self.data
+
+    def ByteSize( self ):
+        return len( self.data )
+
+    def CopyFrom( self, other ):
+        self.data = other.SerializeToString()
+
+    def Clear( self ):
+        self.data = b""
+
+    def IsInitialized( self ):
+        return True
+
+# A message of messageClass that is only parsed when one of its fields or
+# methods is first used. Until then SerializeToString gives back the bytes
+# it was parsed from. Its own methods are private so that every field name
+# reaches the message.
+class LazyMessage( object ):
+    def __init__( self, messageClass, data=b"" ):
+        object.__setattr__( self, "_class", messageClass )
+        object.__setattr__( self, "_data", data )
+        object.__setattr__( self, "_message", None )
+
+    def _parse( self ):
+        if self._message is None:
+            message = self._class()
+            message.ParseFromString( self._data )
+            object.__setattr__( self, "_message", message )
+        return self._message
+
+    def _parsed( self ):
+        return self._message is not None
+
+    def ParseFromString( self, data ):
+        if isinstance( data, memoryview ):
+            data = data.tobytes()
+        object.__setattr__( self, "_data", data )
+        object.__setattr__( self, "_message", None )
+
+    def SerializeToString( self ):
+        if self._message is None:
+            return self._data
+        return self._message.SerializeToString()
+
+    def ByteSize( self ):
+        if self._message is None:
+            return len( self._data )
+        return self._message.ByteSize()
+
+    def CopyFrom( self, other ):
+        self.ParseFromString( other.SerializeToString() )
+
+    def __getattr__( self, key ):
+        return getattr( self._parse(), key )
+
+    def __setattr__( self, key, value ):
+        setattr( self._parse(), key, value )
+
+    def __eq__( self, other ):
+        if isinstance( other, LazyMessage ):
+            other = other._parse()
+        return self._parse() == other
+
+    def __ne__( self, other ):
+        return not self == other
+
+# How payloads of the method called name are decoded, going by decoding:
+# either one of "eager" (parsed into messageClass, the default), "lazy"
+# (into a LazyMessage) or "raw" (left as a RawMessage), or a dict of those
+# by "Service.Method" or "Service" name. Returns what to make messages with.
+def decoder( messageClass, decoding, name ):
+    if isinstance( decoding, dict ):
+        decoding = decoding.get( name, decoding.get( name.split( '.' )[ 0 ], "eager" ) )
+    if decoding is None or decoding == "eager":
+        return messageClass
+    if decoding == "lazy":
+        return functools.partial( LazyMessage, messageClass )
+    if decoding == "raw":
+        return RawMessage
+    raise ValueError( "unknown decoding %r" % decoding )
+
+class MethodEntry( object ):
+    __slots__ = ( "service", "method", "requestClass", "responseClass", "name", "number" )
+
+    def __init__( self, service, method, decoding=None ):
+        self.service = service
+        self.method = method
+        self.name = method_name( method )
+        self.number = method_number( self.name )
+        self.requestClass = decoder( service.GetRequestClass( method ), decoding, self.name )
+        self.responseClass = service.GetResponseClass( method )
+
+# Maps the "Service.Method" names (and compact method ids) found in incoming
+# requests to prebuilt MethodEntry objects, so dispatch is one dict lookup.
+# Requests are decoded as decoding says; see decoder().
+class DispatchTable( object ):
+    def __init__( self, services=(), decoding=None ):
+        self.services = {}
+        self.methods = {}
+        self.numbers = {}
+        self.decoding = decoding
+        for s in services:
+            self.add_service( s )
+
+    def add_service( self, service ):
+        descriptor = service.GetDescriptor()
+        self.services[ descriptor.name ] = service
+        for method in descriptor.methods:
+            entry = MethodEntry( service, method, self.decoding )
+            other = self.numbers.get( entry.number )
+            if other is not None and other.name != entry.name:
+                raise ValueError( "method id of %s collides with %s" % ( entry.name, other.name ) )
+            self.methods[ entry.name ] = entry
+            self.numbers[ entry.number ] = entry
+
+    def lookup( self, serializedRequest ):
+        entry = self.methods.get( serializedRequest.method )
+        if entry is None and serializedRequest.HasField( 'method_id' ):
+            entry = self.numbers.get( serializedRequest.method_id )
+        return entry
+
+    def error_code( self, serializedRequest ):
+        if serializedRequest.method.split( '.' )[ 0 ] in self.services:
+            return RpcErrors.METHOD_NOT_FOUND
+        if serializedRequest.HasField( 'method_id' ):
+            return RpcErrors.METHOD_NOT_FOUND
+        return RpcErrors.SERVICE_NOT_FOUND
+
+# The calls a channel is waiting on, by request id. Calls with a deadline are
+# also pushed onto a heap so expire() only looks at the ones that are due;
+# heap entries for calls that were answered in time are dropped lazily.
+class PendingCalls( object ):
+    def __init__( self, timeout=None, max_pending=None ):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._calls = {}
+        self._deadlines = []
+
+    def __len__( self ):
+        return len( self._calls )
+
+    def __contains__( self, id ):
+        return id in self._calls
+
+    def full( self ):
+        return self.max_pending is not None and len( self._calls ) >= self.max_pending
+
+    # When a call made at now is due, given its own timeout or the default.
+    def deadline( self, now, timeout=None ):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return now + timeout
+
+    # Adds a call made at now; deadline, if given, is one armed earlier,
+    # while the call waited for a free slot.
+    def add( self, id, call, now, timeout=None, deadline=None ):
+        if deadline is None:
+            deadline = self.deadline( now, timeout )
+        self._calls[ id ] = call
+        if deadline is None:
+            return None
+        heapq.heappush( self._deadlines, ( deadline, id ) )
+        if len( self._deadlines ) > 2 * len( self._calls ) + 64:
+            self._deadlines = [ d for d in self._deadlines if d[ 1 ] in self._calls ]
+            heapq.heapify( self._deadlines )
+        return deadline
+
+    def get( self, id, default=None ):
+        return self._calls.get( id, default )
+
+    def pop( self, id, default=None ):
+        return self._calls.pop( id, default )
+
+    def next_deadline( self ):
+        deadlines = self._deadlines
+        while deadlines and deadlines[ 0 ][ 1 ] not in self._calls:
+            heapq.heappop( deadlines )
+        if deadlines:
+            return deadlines[ 0 ][ 0 ]
+        return None
+
+    def expire( self, now ):
+        expired = []
+        deadlines = self._deadlines
+        while deadlines and deadlines[ 0 ][ 0 ] <= now:
+            id = heapq.heappop( deadlines )[ 1 ]
+            call = self._calls.pop( id, None )
+            if call is not None:
+                expired.append( ( id, call ) )
+        return expired
+
+    def clear( self ):
+        calls, self._calls = self._calls, {}
+        self._deadlines = []
+        return calls.items()
+
+# Connection selection for the pooled channels. Both policies compare the
+# calls each connection has outstanding; power-of-two-choices only looks at
+# two connections picked at random, so clients sharing a pool do not all
+# pile onto the same idle connection.
+def least_outstanding( channels ):
+    return min( channels, key=lambda c: c.outstanding() )
+
+def power_of_two_choices( channels ):
+    if len( channels ) < 2:
+        return channels[ 0 ]
+    a, b = random.sample( channels, 2 )
+    if b.outstanding() < a.outstanding():
+        return b
+    return a
+
+balancers = { "least_outstanding": least_outstanding, "p2c": power_of_two_choices }
+
+_transportErrors = ( RpcErrors.msgs[ RpcErrors.TIMEOUT ], RpcErrors.msgs[ RpcErrors.CONNECTION_LOST ] )
+
+def transport_failed( controller ):
+    return controller is not None and controller.Failed() and controller.ErrorText() in _transportErrors
+
+# Failure bookkeeping for one endpoint of a pooled channel. After
+# max_failures failures in a row the endpoint is ejected, i.e. left out of
+# selection, for eject_time seconds, doubling each time it is ejected again
+# before it has recovered.
+class EndpointHealth( object ):
+    def __init__( self, max_failures=3, eject_time=10 ):
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.failures = 0
+        self.ejections = 0
+        self.ejectedUntil = 0
+
+    def ejected( self, now ):
+        return now < self.ejectedUntil
+
+    def succeeded( self ):
+        self.failures = 0
+        self.ejections = 0
+
+    def failed( self, now ):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.ejectedUntil = now + self.eject_time * 2 ** min( self.ejections, 6 )
+            self.ejections += 1
+            self.failures = 0
+
+# Payload codecs, numbered as in the Compression enum of protobufrpc.proto.
+class Compression:
+    NONE = 0
+    ZLIB = 1
+    LZ4 = 2
+    ZSTD = 3
+
+    names = { "zlib": ZLIB, "lz4": LZ4, "zstd": ZSTD }
+
+    # The codecs this process can use, in order of preference.
+    available = [ c for c, m in ( ( ZSTD, zstd ), ( LZ4, lz4 ), ( ZLIB, zlib ) ) if m is not None ]
+
+# Per-connection payload compression. Each end lists the codecs it can
+# decode in accept_compression on its messages until it has seen the peer's
+# list, and on one message more so the peer learns its list in turn; from
+# then on payloads of at least threshold bytes go out compressed with the
+# first codec of ours the peer accepts. zstd contexts are kept per thread
+# and reused from message to message.
+#
+# codecs is True for every available codec, or a list of codec names; None
+# or an empty list sends nothing compressed and asks for nothing compressed,
+# though compressed payloads are still decoded.
+class Compressor( object ):
+    def __init__( self, codecs=True, threshold=1024, level=None ):
+        if codecs is True:
+            codecs = Compression.available
+        elif codecs:
+            codecs = [ Compression.names[ c ] for c in codecs ]
+            for c in codecs:
+                if c not in Compression.available:
+                    raise ValueError( "compression codec %r is not available" % c )
+        self.accepted = list( codecs or () )
+        self.threshold = threshold
+        self.level = level
+        self.peer = None
+        self.codec = Compression.NONE
+        self._told = False
+        self._local = threading.local()
+
+    def negotiate( self, peerCodecs ):
+        self.peer = list( peerCodecs )
+        for c in self.accepted:
+            if c in self.peer:
+                self.codec = c
+                break
+
+    def advertisement( self ):
+        if not self.accepted or self._told:
+            return None
+        if self.peer is not None:
+            self._told = True
+        return self.accepted
+
+    def compress( self, codec, data ):
+        if codec == Compression.ZLIB:
+            if self.level is None:
+                return zlib.compress( data )
+            return zlib.compress( data, self.level )
+        if codec == Compression.LZ4:
+            return lz4.compress( data )
+        if codec == Compression.ZSTD:
+            c = getattr( self._local, "compressor", None )
+            if c is None:
+                c = self._local.compressor = zstd.ZstdCompressor( level=self.level or 3 )
+            return c.compress( data )
+        raise ValueError( "unknown compression codec %r" % codec )
+
+    def decompress( self, codec, data ):
+        if codec == Compression.ZLIB:
+            return zlib.decompress( data )
+        if codec == Compression.LZ4 and lz4 is not None:
+            return lz4.decompress( data )
+        if codec == Compression.ZSTD and zstd is not None:
+            d = getattr( self._local, "decompressor", None )
+            if d is None:
+                d = self._local.decompressor = zstd.ZstdDecompressor()
+            return d.decompress( data )
+        raise ValueError( "unknown compression codec %r" % codec )
+
+    # Returns ( data, codec, codecs ): data compressed with codec when that
+    # pays off (codec is Compression.NONE otherwise), and our codec list
+    # while the peer may still need it.
+    def pack( self, data ):
+        codec = self.codec
+        if codec and len( data ) >= self.threshold:
+            packed = self.compress( codec, data )
+            if len( packed ) < len( data ):
+                return packed, codec, self.advertisement()
+        return data, Compression.NONE, self.advertisement()
+
+    # Sets field, the payload of a Request or Response, as pack() says.
+    def encode( self, message, field, data ):
+        data, codec, codecs = self.pack( data )
+        if codec:
+            message.compression = codec
+        setattr( message, field, data )
+        if codecs:
+            message.accept_compression.extend( codecs )
+
+    # Negotiates from the codec list of an incoming Request or Response and
+    # leaves its payload field uncompressed. Raises ValueError if the payload
+    # cannot be decompressed.
+    def decode( self, message, field ):
+        if self.peer is None and len( message.accept_compression ):
+            self.negotiate( message.accept_compression )
+        if message.compression:
+            try:
+                data = self.decompress( message.compression, getattr( message, field ) )
+            except Exception as e:
+                raise ValueError( str( e ) )
+            setattr( message, field, data )
+            message.ClearField( 'compression' )
+
+# The Rpc envelope of protobufrpc.proto, written and read by hand so that a
+# call or a response costs no Rpc, Request or Response message. An Rpc is
+# nothing but its request (field 1) and response (field 2) entries one after
+# another, so a frame is the concatenation of encoded entries. Fields are
+# written in field number order, giving the bytes SerializeToString() would.
+_BYTES = [ bytes( bytearray( [ i ] ) ) for i in range( 256 ) ]
+
+def _varint( n ):
+    if n < 0x80:
+        return _BYTES[ n ]
+    out = bytearray()
+    while n >= 0x80:
+        out.append( ( n & 0x7f ) | 0x80 )
+        n >>= 7
+    out.append( n )
+    return bytes( out )
+
+def _read_varint( buf, i ):
+    b = buf[ i ]
+    if b < 0x80:
+        return b, i + 1
+    n = 0
+    shift = 0
+    while True:
+        b = buf[ i ]
+        i += 1
+        n |= ( b & 0x7f ) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def _utf8( text ):
+    if isinstance( text, bytes ):
+        return text
+    return text.encode( "utf-8" )
+
+# The method field of a Request, by method name (field 1) or compact method
+# id (field 4), encoded once per method.
+_methodFields = {}
+
+def _method_field( method ):
+    field = _methodFields.get( method )
+    if field is None:
+        if isinstance( method, int ):
+            field = b"\x20" + _varint( method )
+        else:
+            name = _utf8( method )
+            field = b"\x0a" + _varint( len( name ) ) + name
+        _methodFields[ method ] = field
+    return field
+
+# An Rpc request entry. method is a method name, or a compact method id;
+# data the serialized request, compressed with codec; codecs the codecs the
+# sender can decode.
+def encode_request( id, method=None, data=None, timeout=None, more=False, cancel=False,
+        codec=Compression.NONE, codecs=None ):
+    body = []
+    if method is not None and not isinstance( method, int ):
+        body.append( _method_field( method ) )
+    if data is not None:
+        body += [ b"\x12", _varint( len( data ) ), data ]
+    body += [ b"\x18", _varint( id ) ]
+    if method is not None and isinstance( method, int ):
+        body.append( _method_field( method ) )
+    if more:
+        body.append( b"\x28\x01" )
+    if codec:
+        body += [ b"\x30", _varint( codec ) ]
+    for c in codecs or ():
+        body += [ b"\x38", _varint( c ) ]
+    if timeout is not None:
+        body += [ b"\x40", _varint( timeout ) ]
+    if cancel:
+        body.append( b"\x48\x01" )
+    body = b"".join( body )
+    return b"\x0a" + _varint( len( body ) ) + body
+
+# An Rpc response entry. error is a ( code, text ) pair for a failed call.
+def encode_response( id, data=None, error=None, more=False, codec=Compression.NONE, codecs=None ):
+    body = []
+    if data is not None:
+        body += [ b"\x0a", _varint( len( data ) ), data ]
+    if error is not None:
+        code, text = error
+        # Error.code is a sint32, zigzag encoded.
+        e = b"\x08" + _varint( ( ( code << 1 ) ^ ( code >> 31 ) ) & 0xffffffff )
+        if text is not None:
+            text = _utf8( text )
+            e += b"\x12" + _varint( len( text ) ) + text
+        body += [ b"\x12", _varint( len( e ) ), e ]
+    body += [ b"\x18", _varint( id ) ]
+    if more:
+        body.append( b"\x20\x01" )
+    if codec:
+        body += [ b"\x28", _varint( codec ) ]
+    for c in codecs or ():
+        body += [ b"\x30", _varint( c ) ]
+    body = b"".join( body )
+    return b"\x12" + _varint( len( body ) ) + body
+
+# The Rpc response entry for a Response message, its payload packed by
+# compressor if given.
+def response_entry( serializedResponse, compressor=None ):
+    data = None
+    codec = Compression.NONE
+    codecs = None
+    if serializedResponse.HasField( 'serialized_response' ):
+        data = serializedResponse.serialized_response
+        if compressor is not None:
+            data, codec, codecs = compressor.pack( data )
+    error = None
+    if serializedResponse.HasField( 'error' ):
+        error = serializedResponse.error
+        error = ( error.code, error.text if error.HasField( 'text' ) else None )
+    return encode_response( serializedResponse.id, data, error, serializedResponse.more, codec, codecs )
+
+class ScannedError( object ):
+    def __init__( self, code, text ):
+        self.code = code
+        self.text = text
+
+# A response read by scan_responses(). It has the fields of a Response and
+# the HasField() and ClearField() the channels and Compressor use; fields
+# absent from the frame keep their defaults here.
+class ScannedResponse( object ):
+    id = 0
+    serialized_response = b""
+    error = None
+    more = False
+    compression = Compression.NONE
+    accept_compression = ()
+    _payload = False
+
+    def HasField( self, field ):
+        if field == 'serialized_response':
+            return self._payload
+        if field == 'error':
+            return self.error is not None
+        return bool( getattr( self, field ) )
+
+    def ClearField( self, field ):
+        if field not in ( 'compression', 'more' ):
+            raise ValueError( "cannot clear %s" % field )
+        setattr( self, field, getattr( ScannedResponse, field ) )
+
+# Reads a frame that holds only responses into ScannedResponses, without
+# building an Rpc. Returns None for a frame with requests, or anything else
+# this does not expect, which is left to Rpc.ParseFromString().
+def scan_responses( data ):
+    if data[ :1 ] == b"\x0a":
+        return None
+    if isinstance( data, memoryview ):
+        data = data.tobytes()
+    elif not isinstance( data, bytes ):
+        data = bytes( data )
+    buf = bytearray( data )
+    end = len( buf )
+    responses = []
+    i = 0
+    try:
+        while i < end:
+            if buf[ i ] != 0x12:
+                return None
+            stop = buf[ i + 1 ]
+            if stop < 0x80:
+                i += 2
+            else:
+                stop, i = _read_varint( buf, i + 1 )
+            stop += i
+            if stop > end:
+                return None
+            response = ScannedResponse()
+            while i < stop:
+                # Every field number here fits in a one byte key.
+                key = buf[ i ]
+                value = buf[ i + 1 ]
+                if value < 0x80:
+                    i += 2
+                else:
+                    value, i = _read_varint( buf, i + 1 )
+                if key == 0x18:
+                    response.id = value
+                elif key == 0x0a or key == 0x12:
+                    if i + value > stop:
+                        return None
+                    if key == 0x0a:
+                        response.serialized_response = data[ i:i + value ]
+                        response._payload = True
+                    else:
+                        response.error = _scan_error( buf, data, i, i + value )
+                        if response.error is None:
+                            return None
+                    i += value
+                elif key == 0x20:
+                    response.more = bool( value )
+                elif key == 0x28:
+                    response.compression = value
+                elif key == 0x30:
+                    if not response.accept_compression:
+                        response.accept_compression = []
+                    response.accept_compression.append( value )
+                else:
+                    return None
+            if i != stop:
+                return None
+            responses.append( response )
+    except ( IndexError, ValueError ):
+        return None
+    return responses
+
+# The responses of a frame as scan_responses() reads them, when protobuf
+# parses in pure Python; None when it has a C implementation, which parses
+# an Rpc faster than scanning it here.
+def quick_responses( data ):
+    if not _pythonProtobuf:
+        return None
+    return scan_responses( data )
+
+def _scan_error( buf, data, i, stop ):
+    code = 0
+    text = u""
+    while i < stop:
+        key, i = _read_varint( buf, i )
+        if key == 0x08:
+            value, i = _read_varint( buf, i )
+            code = ( value >> 1 ) ^ -( value & 1 )
+        elif key == 0x12:
+            length, i = _read_varint( buf, i )
+            text = data[ i:i + length ].decode( "utf-8" )
+            i += length
+        else:
+            return None
+    if i != stop:
+        return None
+    return ScannedError( code, text )
+
+# Wraps the done callback of a call made through a channel so that the call
+# is reported to metrics (see protobufrpc.metrics) when it finishes.
+def timed_call( metrics, name, rpcController, done ):
+    started = time.time()
+    def finished( response ):
+        code = RpcErrors.SUCCESS
+        if rpcController is not None and rpcController.Failed():
+            code = error_code( rpcController.ErrorText() )
+        metrics.called( name, time.time() - started, code )
+        if done is not None:
+            return done( response )
+    return finished
+
+# Serialized responses of methods that are pure functions of their request,
+# keyed on the method name and the serialized request, so that a hit skips
+# both the method and the serialization of its response. methods holds the
+# "Service.Method" or "Service" names to cache, as a list or as a dict
+# mapping each to its own ttl in seconds (None for the default ttl, which is
+# forever unless given). Least recently used entries are evicted once there
+# are more than max_entries of them or they hold more than max_bytes.
+# Methods that stream their responses must not be cached.
+#
+# Servers check the cache before dispatching; channels before sending, and
+# they parse a hit into a new message for each call.
+class ResponseCache( object ):
+    def __init__( self, methods, ttl=None, max_entries=1024, max_bytes=1 << 20 ):
+        if not isinstance( methods, dict ):
+            methods = dict( [ ( name, None ) for name in methods ] )
+        self.methods = methods
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def enabled( self, name ):
+        return name in self.methods or name.split( '.' )[ 0 ] in self.methods
+
+    def _ttl( self, name ):
+        ttl = self.methods.get( name, self.methods.get( name.split( '.' )[ 0 ] ) )
+        if ttl is None:
+            ttl = self.ttl
+        return ttl
+
+    def get( self, name, data ):
+        key = ( name, data )
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop( key, None )
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, response = entry
+            if expires is not None and expires <= time.time():
+                self.size -= len( data ) + len( response )
+                self.misses += 1
+                return None
+            self._entries[ key ] = entry
+            self.hits += 1
+            return response
+        finally:
+            self._lock.release()
+
+    def put( self, name, data, response ):
+        size = len( data ) + len( response )
+        if size > self.max_bytes:
+            return
+        ttl = self._ttl( name )
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+        key = ( name, data )
+        self._lock.acquire()
+        try:
+            old = self._entries.pop( key, None )
+            if old is not None:
+                self.size -= len( data ) + len( old[ 1 ] )
+            self._entries[ key ] = ( expires, response )
+            self.size += size
+            while len( self._entries ) > self.max_entries or self.size > self.max_bytes:
+                ( oldName, oldData ), ( oldExpires, oldResponse ) = self._entries.popitem( last=False )
+                self.size -= len( oldData ) + len( oldResponse )
+        finally:
+            self._lock.release()
+
+    def clear( self ):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    # For channels: returns the response to a call if it is cached, and the
+    # done callback to use otherwise, which caches the response.
+    def call( self, methodDescriptor, rpcController, request, responseClass, done ):
+        name = method_name( methodDescriptor )
+        if rpcController is None or not self.enabled( name ):
+            return None, done
+        data = request.SerializeToString()
+        cached = self.get( name, data )
+        if cached is not None:
+            response = responseClass()
+            response.ParseFromString( cached )
+            return response, done
+        def store( response ):
+            if not rpcController.Failed():
+                self.put( name, data, response.SerializeToString() )
+            if done is not None:
+                return done( response )
+        return None, store
+
+# Collapses identical calls that are in flight at the same time, keyed on
+# the method name and the serialized request: only the first is made and
+# the others wait for its result. methods holds the "Service.Method" or
+# "Service" names to collapse, None meaning every method. Waiters share the
+# first call's fate, including its timeout and any failure.
+class SingleFlight( object ):
+    def __init__( self, methods=None ):
+        self.methods = methods
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def enabled( self, name ):
+        return self.methods is None or name in self.methods or name.split( '.' )[ 0 ] in self.methods
+
+    # For servers: whether the request is the first of its kind in flight.
+    # If it is not, deliver will be called with whatever the first one
+    # finishes with.
+    def start( self, name, data, deliver ):
+        return self._start( ( "serve", name, data ), deliver )
+
+    def finish( self, name, data, result ):
+        self._finish( ( "serve", name, data ), result )
+
+    # For channels whose calls are futures: as start and finish, with
+    # deliver called with the first call's future once it is done.
+    def start_call( self, name, data, deliver ):
+        return self._start( ( "future", name, data ), deliver )
+
+    def finish_call( self, name, data, future ):
+        self._finish( ( "future", name, data ), future )
+
+    def _start( self, key, deliver ):
+        self._lock.acquire()
+        try:
+            waiters = self._flights.get( key )
+            if waiters is None:
+                self._flights[ key ] = []
+                return True
+            waiters.append( deliver )
+            self.shared += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def _finish( self, key, result ):
+        self._lock.acquire()
+        try:
+            waiters = self._flights.pop( key, [] )
+        finally:
+            self._lock.release()
+        for deliver in waiters:
+            deliver( result )
+
+    # For channels: returns None if an identical call is already in flight,
+    # in which case done will be called with a copy of its response, and
+    # otherwise the done callback to make the call with.
+    def join( self, methodDescriptor, rpcController, request, responseClass, done ):
+        name = method_name( methodDescriptor )
+        if rpcController is None or not self.enabled( name ):
+            return done
+        key = ( "call", name, request.SerializeToString() )
+        def deliver( result ):
+            response, error = result
+            if error is not None:
+                rpcController.SetFailed( error )
+            copy = responseClass()
+            if response is not None:
+                copy.CopyFrom( response )
+            if done is not None:
+                done( copy )
+        if not self._start( key, deliver ):
+            return None
+        def land( response ):
+            error = None
+            if rpcController.Failed():
+                error = rpcController.ErrorText()
+            self._finish( key, ( response, error ) )
+            if done is not None:
+                return done( response )
+        return land
 
 class ServiceContainer( dict ):
     def __getattr__( self, key ):
@@ -0,0 +1,280 @@
+# Copyright (c) 2008 Alan Kligman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import BaseHTTPServer
+from protobufrpc.common import RpcErrors
+
+__all__ = [ "Histogram", "Metrics", "metrics_server" ]
+
+# Counts values in buckets whose bounds double from unit up, so recording is
+# one division and one bit_length() and the relative error of a percentile
+# is at most a factor of two.
+class Histogram( object ):
+    def __init__( self, unit=1 ):
+        self.unit = unit
+        self.buckets = [ 0 ] * 64
+        self.count = 0
+        self.sum = 0
+
+    def add( self, value ):
+        self.buckets[ min( int( value / self.unit ).bit_length(), 63 ) ] += 1
+        self.count += 1
+        self.sum += value
+
+    # The upper bound of bucket i.
+    def bound( self, i ):
+        return self.unit * ( 1 << i )
+
+    def percentile( self, p ):
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate( self.buckets ):
+            seen += n
+            if n and seen >= rank:
+                return self.bound( i )
+        return self.bound( len( self.buckets ) - 1 )
+
+    def snapshot( self ):
+        return { "count": self.count, "sum": self.sum,
+            "p50": self.percentile( 50 ), "p90": self.percentile( 90 ), "p99": self.percentile( 99 ),
+            "buckets": [ ( self.bound( i ), n ) for i, n in enumerate( self.buckets ) if n ] }
+
+# The built-in collector. Channels and servers created with metrics=... call
+# these hooks, from several threads at once in the threaded servers; any
+# object with the same methods can be passed instead.
+#
+#   parsed( size, seconds, messages ): a frame of size bytes carrying
+#       messages requests and responses was parsed.
+#   dispatched( method, size ): a request of size bytes is about to be
+#       handed to its method.
+#   handled( method, seconds, queued ): the method called done, seconds
+#       after it was called; queued is how long the request waited for a
+#       worker before that.
+#   finished( method ): a dispatched request is over, whether it was
+#       answered, cancelled, expired or left behind by its connection;
+#       called once for each dispatched().
+#   serialized( method, size, seconds ): a response of size bytes was
+#       serialized.
+#   written( size ): a frame of size bytes was written.
+#   error( code ): an error response was sent, code being an RpcErrors code
+#       (failures set through the controller are sent with code 1, and
+#       labelled "application").
+#   called( method, seconds, code ): a call made through a channel finished,
+#       code being RpcErrors.SUCCESS if it succeeded.
+class Metrics( object ):
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self.framesIn = 0
+        self.bytesIn = 0
+        self.framesOut = 0
+        self.bytesOut = 0
+        self.inFlight = 0
+        self.parseTime = Histogram( 1e-6 )
+        self.batchSize = Histogram()
+        self.errors = {}
+        self.methods = {}
+        self.calls = {}
+
+    def _method( self, method ):
+        stats = self.methods.get( method )
+        if stats is None:
+            stats = self.methods[ method ] = { "in_flight": 0, "latency": Histogram( 1e-6 ),
+                "queued": Histogram( 1e-6 ), "request_size": Histogram(), "response_size": Histogram(),
+                "serialize": Histogram( 1e-6 ) }
+        return stats
+
+    def parsed( self, size, seconds, messages ):
+        self._lock.acquire()
+        try:
+            self.framesIn += 1
+            self.bytesIn += size
+            self.parseTime.add( seconds )
+            self.batchSize.add( messages )
+        finally:
+            self._lock.release()
+
+    def dispatched( self, method, size ):
+        self._lock.acquire()
+        try:
+            stats = self._method( method )
+            stats[ "in_flight" ] += 1
+            stats[ "request_size" ].add( size )
+            self.inFlight += 1
+        finally:
+            self._lock.release()
+
+    def handled( self, method, seconds, queued ):
+        self._lock.acquire()
+        try:
+            stats = self._method( method )
+            stats[ "latency" ].add( seconds )
+            stats[ "queued" ].add( queued )
+        finally:
+            self._lock.release()
+
+    def finished( self, method ):
+        self._lock.acquire()
+        try:
+            self._method( method )[ "in_flight" ] -= 1
+            self.inFlight -= 1
+        finally:
+            self._lock.release()
+
+    def serialized( self, method, size, seconds ):
+        self._lock.acquire()
+        try:
+            stats = self._method( method )
+            stats[ "response_size" ].add( size )
+            stats[ "serialize" ].add( seconds )
+        finally:
+            self._lock.release()
+
+    def written( self, size ):
+        self._lock.acquire()
+        try:
+            self.framesOut += 1
+            self.bytesOut += size
+        finally:
+            self._lock.release()
+
+    def error( self, code ):
+        self._lock.acquire()
+        try:
+            self.errors[ code ] = self.errors.get( code, 0 ) + 1
+        finally:
+            self._lock.release()
+
+    def called( self, method, seconds, code ):
+        self._lock.acquire()
+        try:
+            stats = self.calls.get( method )
+            if stats is None:
+                stats = self.calls[ method ] = { "latency": Histogram( 1e-6 ), "errors": {} }
+            stats[ "latency" ].add( seconds )
+            if code != RpcErrors.SUCCESS:
+                stats[ "errors" ][ code ] = stats[ "errors" ].get( code, 0 ) + 1
+        finally:
+            self._lock.release()
+
+    def snapshot( self ):
+        self._lock.acquire()
+        try:
+            methods = {}
+            for method, stats in self.methods.items():
+                methods[ method ] = dict( [ ( k, v if isinstance( v, int ) else v.snapshot() )
+                    for k, v in stats.items() ] )
+            calls = {}
+            for method, stats in self.calls.items():
+                calls[ method ] = { "latency": stats[ "latency" ].snapshot(), "errors": dict( stats[ "errors" ] ) }
+            return { "frames_in": self.framesIn, "bytes_in": self.bytesIn,
+                "frames_out": self.framesOut, "bytes_out": self.bytesOut,
+                "in_flight": self.inFlight, "parse_time": self.parseTime.snapshot(),
+                "batch_size": self.batchSize.snapshot(), "errors": dict( self.errors ),
+                "methods": methods, "calls": calls }
+        finally:
+            self._lock.release()
+
+    # The metrics in the Prometheus text exposition format.
+    def prometheus( self, prefix="protobufrpc" ):
+        lines = []
+        def metric( name, kind, samples ):
+            lines.append( "# TYPE %s_%s %s" % ( prefix, name, kind ) )
+            for labels, value in samples:
+                lines.append( "%s_%s%s %s" % ( prefix, name, _labels( labels ), _number( value ) ) )
+        def histogram( name, histograms ):
+            lines.append( "# TYPE %s_%s histogram" % ( prefix, name ) )
+            for labels, h in histograms:
+                seen = 0
+                for i, n in enumerate( h.buckets ):
+                    seen += n
+                    if n:
+                        lines.append( "%s_%s_bucket%s %d" % ( prefix, name,
+                            _labels( labels + [ ( "le", _number( h.bound( i ) ) ) ] ), seen ) )
+                lines.append( "%s_%s_bucket%s %d" % ( prefix, name, _labels( labels + [ ( "le", "+Inf" ) ] ), h.count ) )
+                lines.append( "%s_%s_sum%s %s" % ( prefix, name, _labels( labels ), _number( h.sum ) ) )
+                lines.append( "%s_%s_count%s %d" % ( prefix, name, _labels( labels ), h.count ) )
+
+        self._lock.acquire()
+        try:
+            metric( "frames_received_total", "counter", [ ( [], self.framesIn ) ] )
+            metric( "bytes_received_total", "counter", [ ( [], self.bytesIn ) ] )
+            metric( "frames_sent_total", "counter", [ ( [], self.framesOut ) ] )
+            metric( "bytes_sent_total", "counter", [ ( [], self.bytesOut ) ] )
+            metric( "in_flight", "gauge", [ ( [ ( "method", m ) ], s[ "in_flight" ] )
+                for m, s in sorted( self.methods.items() ) ] )
+            metric( "errors_total", "counter", [ ( [ ( "code", _codeName( c ) ) ], n )
+                for c, n in sorted( self.errors.items() ) ] )
+            histogram( "parse_seconds", [ ( [], self.parseTime ) ] )
+            histogram( "frame_messages", [ ( [], self.batchSize ) ] )
+            for name, key in [ ( "handler_seconds", "latency" ), ( "queue_seconds", "queued" ),
+                    ( "serialize_seconds", "serialize" ), ( "request_bytes", "request_size" ),
+                    ( "response_bytes", "response_size" ) ]:
+                histogram( name, [ ( [ ( "method", m ) ], s[ key ] ) for m, s in sorted( self.methods.items() ) ] )
+            histogram( "call_seconds", [ ( [ ( "method", m ) ], s[ "latency" ] )
+                for m, s in sorted( self.calls.items() ) ] )
+            metric( "call_errors_total", "counter", [ ( [ ( "method", m ), ( "code", _codeName( c ) ) ], n )
+                for m, s in sorted( self.calls.items() ) for c, n in sorted( s[ "errors" ].items() ) ] )
+        finally:
+            self._lock.release()
+        return "\n".join( lines ) + "\n"
+
+def _labels( labels ):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join( [ '%s="%s"' % ( k, str( v ).replace( "\\", "\\\\" ).replace( '"', '\\"' ) )
+        for k, v in labels ] )
+
+def _number( value ):
+    return repr( value ) if isinstance( value, float ) else str( value )
+
+def _codeName( code ):
+    # Servers send failures that services set themselves with code 1; see
+    # common.error_code.
+    if code == RpcErrors.UNSERIALIZE_RPC:
+        return "application"
+    for name, value in vars( RpcErrors ).items():
+        if value == code and name.isupper():
+            return name.lower()
+    return str( code )
+
+class _MetricsHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    def do_GET( self ):
+        body = self.server.metrics.prometheus()
+        self.send_response( 200 )
+        self.send_header( "Content-Type", "text/plain; version=0.0.4" )
+        self.send_header( "Content-Length", str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def log_message( self, format, *args ):
+        pass
+
+# Serves metrics in the Prometheus text format over HTTP at addr from a
+# daemon thread. Returns the HTTP server; shutdown() stops it.
+def metrics_server( metrics, addr ):
+    server = BaseHTTPServer.HTTPServer( addr, _MetricsHandler )
+    server.metrics = metrics
+    thread = threading.Thread( target=server.serve_forever )
+    thread.setDaemon( True )
+    thread.start()
+    return server
@@ -0,0 +1,223 @@
+# Copyright (c) 2008 Alan Kligman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import sys
+import errno
+import signal
+import socket
+import threading
+import time
+
+__all__ = [ "Supervisor", "tx_worker", "synchronous_worker" ]
+
+# Serves one port from several worker processes, to use more than one core.
+# With SO_REUSEPORT (where the platform has it) every worker listens on a
+# socket of its own and the kernel spreads connections across them; the
+# supervisor only keeps the port bound. Otherwise the workers accept from one
+# listening socket they inherit from the supervisor.
+#
+# worker is called in each worker process with its listening socket and
+# serves until it gets SIGTERM, when it should stop accepting, finish the
+# calls in progress and return; see tx_worker and synchronous_worker. Workers
+# that exit are started again, no sooner than restart_delay seconds after
+# they were last started. shutdown() drains the workers, killing any still
+# running drain_time seconds later.
+#
+# The process running a Supervisor of tx workers must not have imported
+# twisted.internet.reactor, nor run anything that uses the reactor: a reactor
+# installed before the fork would be shared by every worker, down to its
+# poller and waker. Importing protobufrpc.tx and building services is fine,
+# since it only imports the reactor once it is used. tx_worker raises
+# RuntimeError when the reactor has been imported.
+class Supervisor( object ):
+    def __init__( self, addr, worker, workers=4, reuse_port=None, backlog=128, drain_time=10,
+            restart_delay=1 ):
+        if reuse_port is None:
+            reuse_port = hasattr( socket, "SO_REUSEPORT" )
+        self.worker = worker
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.drain_time = drain_time
+        self.restart_delay = restart_delay
+        self.children = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._deadline = None
+        self._socket = self.listen_socket( addr, listen=not reuse_port )
+        self.server_address = self._socket.getsockname()
+
+    def listen_socket( self, addr, listen=True ):
+        sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        if self.reuse_port:
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+        sock.bind( addr )
+        if listen:
+            sock.listen( self.backlog )
+        return sock
+
+    # Installs SIGTERM and SIGINT handlers that shut down, then serves.
+    def run( self ):
+        for signum in ( signal.SIGTERM, signal.SIGINT ):
+            signal.signal( signum, lambda signum, frame: self.shutdown() )
+        self.serve_forever()
+
+    def serve_forever( self, poll_interval=0.1 ):
+        restarts = [ 0 ] * self.workers
+        while True:
+            self._lock.acquire()
+            try:
+                if self._stopping and not self.children:
+                    break
+                if self._deadline is not None and time.time() >= self._deadline:
+                    self._kill( signal.SIGKILL )
+                    self._deadline = None
+                now = time.time()
+                while not self._stopping and restarts and restarts[ 0 ] <= now:
+                    restarts.pop( 0 )
+                    self._start_worker()
+            finally:
+                self._lock.release()
+
+            try:
+                pid, status = os.waitpid( -1, os.WNOHANG )
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid:
+                self._lock.acquire()
+                try:
+                    started = self.children.pop( pid, None )
+                finally:
+                    self._lock.release()
+                if started is not None:
+                    restarts.append( started + self.restart_delay )
+                    restarts.sort()
+                continue
+            time.sleep( poll_interval )
+        self._socket.close()
+
+    def shutdown( self ):
+        self._lock.acquire()
+        try:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._deadline = time.time() + self.drain_time
+            self._kill( signal.SIGTERM )
+        finally:
+            self._lock.release()
+
+    # Runs in each worker, which drains if the supervisor goes away.
+    def _watch( self, supervisor ):
+        while os.getppid() == supervisor:
+            time.sleep( 1 )
+        os.kill( os.getpid(), signal.SIGTERM )
+
+    def _kill( self, signum ):
+        for pid in self.children.keys():
+            try:
+                os.kill( pid, signum )
+            except OSError:
+                pass
+
+    # Called with the lock held. As in PreForkTcpServer, the supervisor
+    # waits until the worker has dropped the signal handlers it inherited.
+    def _start_worker( self ):
+        ready, started = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal( signal.SIGTERM, signal.SIG_DFL )
+                signal.signal( signal.SIGINT, signal.SIG_IGN )
+                os.close( ready )
+                os.write( started, "." )
+                os.close( started )
+                if self.reuse_port:
+                    sock = self.listen_socket( self.server_address )
+                    self._socket.close()
+                else:
+                    sock = self._socket
+                watchdog = threading.Thread( target=self._watch, args=( os.getppid(), ) )
+                watchdog.setDaemon( True )
+                watchdog.start()
+                self.worker( sock )
+            finally:
+                os._exit( 0 )
+        os.close( started )
+        os.read( ready, 1 )
+        os.close( ready )
+        self.children[ pid ] = time.time()
+
+def _check_no_reactor():
+    if "twisted.internet.reactor" in sys.modules:
+        raise RuntimeError( "tx_worker needs a supervisor that has not imported twisted.internet.reactor" )
+
+# A worker running a tx.Factory for services on its own reactor. On SIGTERM
+# it stops listening, waits for the requests in flight and closes its
+# connections. Keyword arguments go to the Factory. Each worker installs its
+# reactor after the fork; see Supervisor for what that asks of the supervisor.
+def tx_worker( *services, **kwargs ):
+    _check_no_reactor()
+
+    def serve( sock ):
+        _check_no_reactor()
+        from twisted.internet import reactor
+        from protobufrpc.tx import Factory
+
+        factory = Factory( *services, **kwargs )
+        sock.setblocking( 0 )
+        port = reactor.adoptStreamPort( sock.fileno(), sock.family, factory )
+        sock.close()
+
+        def drain():
+            factory.drain( port ).addCallback( lambda _: reactor.stop() )
+
+        signal.signal( signal.SIGTERM, lambda signum, frame: reactor.callFromThread( drain ) )
+        reactor.run( installSignalHandlers=False )
+    return serve
+
+# A worker running a synchronous server, a ThreadPoolTcpServer unless
+# server_class says otherwise. On SIGTERM it stops accepting and drains its
+# connections. Keyword arguments go to the server.
+def synchronous_worker( *services, **kwargs ):
+    def serve( sock ):
+        from protobufrpc import synchronous
+
+        args = dict( kwargs )
+        serverClass = args.pop( "server_class", synchronous.ThreadPoolTcpServer )
+        server = serverClass( sock.getsockname(), *services, **dict( args, bind_and_activate=False ) )
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
+
+        def stop( signum, frame ):
+            threading.Thread( target=server.shutdown ).start()
+
+        signal.signal( signal.SIGTERM, stop )
+        server.serve_forever()
+        server.server_close()
+        server.drain()
+    return serve
@@ -21,62 +21,368 @@
 import socket
 import google.protobuf.service
 import threading
-from protobufrpc.common import Controller
+from protobufrpc.common import Controller, RpcErrors, RpcError, DispatchTable, PendingCalls, EndpointHealth, balancers
+from protobufrpc.common import transport_failed, method_name, method_number, Compressor, timed_call, decoder
+from protobufrpc.common import request_timeout, Compression, encode_request, encode_response, quick_responses
 from protobufrpc.protobufrpc_pb2 import Rpc, Request, Response, Error
 import struct
 import SocketServer
+import Queue
+import select
+import errno
+import os
+import signal
+import time
+import mmap
+import tempfile
+import stat
+from collections import deque
 
-__all__ = [ "TcpChannel", "TcpServer", "Proxy" ]
+__all__ = [ "TcpChannel", "PipelinedTcpChannel", "PooledChannel", "Stream", "Future", "TcpServer",
+	"ThreadPoolTcpServer", "PreForkTcpServer", "SelectTcpServer", "Proxy", "FrameReader", "send_frame",
+	"ShmChannel", "ShmServer" ]
 
+_header = struct.Struct( "!I" )
+
+# Payloads up to this size are sent in one piece with their length prefix;
+# larger ones are sent straight from the caller's buffer after it.
+_coalesceLimit = 16384
+
+def send_frame( sock, buffer ):
+	header = _header.pack( len( buffer ) )
+	if len( buffer ) <= _coalesceLimit:
+		sock.sendall( header + buffer )
+	elif hasattr( sock, "sendmsg" ):
+		sent = sock.sendmsg( [ header, buffer ] )
+		if sent < len( header ):
+			sock.sendall( header[ sent: ] )
+			sock.sendall( buffer )
+		elif sent < len( header ) + len( buffer ):
+			sock.sendall( memoryview( buffer )[ sent - len( header ): ] )
+	else:
+		sock.sendall( header )
+		sock.sendall( buffer )
+
+# Addresses given as a string are the paths of Unix domain sockets; any
+# other address is a ( host, port ) pair.
+def address_family( addr ):
+	if isinstance( addr, basestring ):
+		return socket.AF_UNIX
+	return socket.AF_INET
+
+# Reads length-prefixed frames from a socket into one reusable buffer with
+# recv_into, growing the buffer to fit the largest frame seen. Frames are
+# memoryviews into that buffer and are only valid until the reader is next
+# used; call tobytes() on them to keep one for longer.
+class FrameReader( object ):
+	def __init__( self, sock, size=65536 ):
+		self._sock = sock
+		self._buffer = bytearray( size )
+		self._view = memoryview( self._buffer )
+		self._start = 0
+		self._end = 0
+
+	def _needed( self ):
+		needed = _header.size
+		if self._end - self._start >= needed:
+			needed += _header.unpack_from( self._buffer, self._start )[ 0 ]
+		return needed
+
+	def has_frame( self ):
+		return self._end - self._start >= self._needed()
+
+	def frame( self ):
+		if not self.has_frame():
+			return None
+		start = self._start + _header.size
+		self._start = self._start + self._needed()
+		return self._view[ start:self._start ]
+
+	def fill( self ):
+		available = self._end - self._start
+		needed = self._needed()
+		if self._start + needed > len( self._buffer ):
+			if needed > len( self._buffer ):
+				buffer = bytearray( max( needed, 2 * len( self._buffer ) ) )
+				buffer[ :available ] = self._view[ self._start:self._end ]
+				self._buffer = buffer
+				self._view = memoryview( buffer )
+			elif available:
+				self._buffer[ :available ] = self._view[ self._start:self._end ].tobytes()
+			self._start = 0
+			self._end = available
+		received = self._sock.recv_into( self._view[ self._end: ] )
+		self._end += received
+		if self._start == self._end:
+			self._start = self._end = 0
+		return received
+
+	# Blocks until a whole frame has arrived. Returns None if the socket is
+	# closed between frames.
+	def read_frame( self ):
+		while not self.has_frame():
+			if not self.fill():
+				if self._start != self._end:
+					raise RuntimeError( "socket connection broken" )
+				return None
+		return self.frame()
+
+# A blocking channel: CallMethod (or flush, for a batch) sends the requests
+# and reads until their responses are in. Calls that outlive their timeout
+# fail through the controller with RpcErrors.TIMEOUT and their responses are
+# discarded if they turn up later. addr may be the path of a Unix domain
+# socket, for a server on the same host.
 class TcpChannel( google.protobuf.service.RpcChannel ):
 	id = 0
-	def __init__( self, addr ):
+	def __init__( self, addr, compact_methods=False, timeout=None, max_pending=None, block=True,
+			compression=None, compression_threshold=1024, metrics=None, cache=None, single_flight=None,
+			decoding=None ):
 		google.protobuf.service.RpcChannel.__init__( self )
-		self._pending = {}
+		self._pending = PendingCalls( timeout, max_pending )
+		# How responses are decoded; see common.decoder.
+		self._decoding = decoding
+		self._metrics = metrics
+		self._cache = cache
+		self._singleFlight = single_flight
+		self._compressor = Compressor( compression, compression_threshold )
+		self._block = block
+		self._compactMethods = compact_methods
 		self._tcpSocket = None
+		self._reader = None
+		self._sendFrame = send_frame
+		self._batch = None
+		self._held = 0
 		self.connect( addr )
 	
 	def connect( self, addr ):
-		self._tcpSocket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+		self._tcpSocket = socket.socket( address_family( addr ), socket.SOCK_STREAM )
 		self._tcpSocket.connect( addr )
+		self._reader = FrameReader( self._tcpSocket )
+
+	def close( self ):
+		self._tcpSocket.close()
 	
 	def send_string( self, buffer ):
-		networkOrderBufferLen = struct.pack( "!I", len( buffer ) )
+		if self._metrics is not None:
+			self._metrics.written( len( buffer ) )
+		self._sendFrame( self._tcpSocket, buffer )
 
-		buffer = networkOrderBufferLen + buffer
-		bytesSent = 0
-		while bytesSent < len( buffer ):
-			sent = self._tcpSocket.send( buffer[ bytesSent: ] )
-			if sent == 0:
-				raise RuntimeError( "socket connection broken" )
-			bytesSent += sent
+	def recv_string( self ):
+		buffer = self._reader.read_frame()
+		if buffer is None:
+			raise RuntimeError( "socket connection broken" )
+		return buffer
+
+	def _readable( self, deadline ):
+		if deadline is None or self._reader.has_frame():
+			return True
+		return bool( select.select( [ self._tcpSocket ], [], [], deadline - time.time() )[ 0 ] )
 
 	def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done=None ):
+		if self._decoding is not None:
+			responseClass = decoder( responseClass, self._decoding, method_name( methodDescriptor ) )
+		if self._metrics is not None:
+			done = timed_call( self._metrics, method_name( methodDescriptor ), rpcController, done )
+		if self._cache is not None:
+			response, done = self._cache.call( methodDescriptor, rpcController, request, responseClass, done )
+			if response is not None:
+				if done is not None:
+					done( response )
+				return
+		if self._singleFlight is not None:
+			done = self._singleFlight.join( methodDescriptor, rpcController, request, responseClass, done )
+			if done is None:
+				return
+		call = ( responseClass, rpcController, done )
+		if self._pending.full() and self._block and self._batch is not None:
+			self.flush()
+		if self._pending.full():
+			self.complete_call( call, self.error_response( 0, RpcErrors.TOO_MANY_PENDING ) )
+			return
+
 		self.id += 1
-		self._pending[ self.id ] = ( responseClass, done )
+		deadline = self.add_pending( self.id, call, rpcController )
 
-		rpc = Rpc()
+		if self._batch is not None:
+			self.serialize_request( self._batch, methodDescriptor, request, self.id, deadline )
+			return
+
+		self.send_string( self.encode_request( methodDescriptor, request, self.id, deadline ) )
+		self.wait_for( [ self.id ] )
+
+	def serialize_request( self, rpc, methodDescriptor, request, id, deadline=None ):
 		rpcRequest = rpc.request.add()
-		rpcRequest.method = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
-		rpcRequest.serialized_request = request.SerializeToString()
-		rpcRequest.id = self.id
+		if methodDescriptor is not None:
+			if self._compactMethods:
+				rpcRequest.method_id = method_number( method_name( methodDescriptor ) )
+			else:
+				rpcRequest.method = method_name( methodDescriptor )
+		if request is not None:
+			self._compressor.encode( rpcRequest, 'serialized_request', request.SerializeToString() )
+		rpcRequest.id = id
+		if deadline is not None:
+			rpcRequest.timeout = request_timeout( deadline, time.time() )
+		return rpc
+
+	# The same request as serialize_request adds, encoded straight into an
+	# Rpc of its own; see common.encode_request.
+	def encode_request( self, methodDescriptor, request, id, deadline=None ):
+		method = None
+		if methodDescriptor is not None:
+			method = method_name( methodDescriptor )
+			if self._compactMethods:
+				method = method_number( method )
+		data = None
+		codec = Compression.NONE
+		codecs = None
+		if request is not None:
+			data, codec, codecs = self._compressor.pack( request.SerializeToString() )
+		timeout = None
+		if deadline is not None:
+			timeout = request_timeout( deadline, time.time() )
+		return encode_request( id, method, data, timeout, codec=codec, codecs=codecs )
+
+	def open_stream( self, methodDescriptor, responseClass, rpcController=None ):
+		if self._decoding is not None:
+			responseClass = decoder( responseClass, self._decoding, method_name( methodDescriptor ) )
+		self.id += 1
+		stream = Stream( self, self.id, methodDescriptor, responseClass, rpcController )
+		self.add_pending( self.id, stream, rpcController )
+		return stream
+
+	def call_stream( self, methodDescriptor, request, responseClass, rpcController=None ):
+		stream = self.open_stream( methodDescriptor, responseClass, rpcController )
+		stream.close( request )
+		return stream
+
+	# Stream requests are sent straight away, never held in a batch, and
+	# only the first one names the method.
+	def send_stream_request( self, stream, request, more ):
+		rpc = self.serialize_request( Rpc(), stream.method, request, stream.id )
+		stream.method = None
+		if more:
+			rpc.request[ 0 ].more = True
+		self.send_string( rpc.SerializeToString() )
+
+	def wait_stream( self, stream ):
+		while not stream.ready():
+			self.receive()
+
+	def start_batch( self ):
+		self._held += 1
+		if self._batch is None:
+			self._batch = Rpc()
+
+	def end_batch( self ):
+		self._held -= 1
+		if not self._held:
+			self.flush()
+
+	def flush( self ):
+		rpc = self._batch
+		if self._held:
+			self._batch = Rpc()
+		else:
+			self._batch = None
+		if rpc is None or not len( rpc.request ):
+			return
+
 		self.send_string( rpc.SerializeToString() )
+		self.wait_for( [ rpcRequest.id for rpcRequest in rpc.request ] )
+
+	def wait_for( self, ids ):
+		for id in ids:
+			while id in self._pending:
+				self.receive()
+
+	def receive( self ):
+		deadline = self._pending.next_deadline()
+		if deadline is not None and deadline <= time.time():
+			self.expire_calls()
+		elif self._readable( deadline ):
+			self.string_received( self.recv_string() )
+
+	def add_pending( self, id, call, rpcController ):
+		if isinstance( rpcController, Controller ):
+			rpcController.canceller = lambda: self.cancel_call( id )
+		return self._pending.add( id, call, time.time(), getattr( rpcController, "timeout", None ) )
+
+	def pop_pending( self, id ):
+		return self._pending.pop( id )
+
+	def expire_calls( self ):
+		expired = self._pending.expire( time.time() )
+		for id, call in expired:
+			self.deliver( call, self.error_response( id, RpcErrors.TIMEOUT ) )
+		self.send_cancels( [ id for id, call in expired ] )
 
-		buffer = self._tcpSocket.recv( struct.calcsize( "!I" ) )
-		bufferLen = int( struct.unpack( "!I", buffer )[0] )
-		buffer = self._tcpSocket.recv( bufferLen )
-		r = self.string_received( buffer )
-		return r
+	# Fails call id with RpcErrors.CANCELLED and tells the server to stop
+	# working on it.
+	def cancel_call( self, id ):
+		call = self.pop_pending( id )
+		if call is None:
+			return
+		self.send_cancels( [ id ] )
+		self.deliver( call, self.error_response( id, RpcErrors.CANCELLED ) )
 
+	# Cancels are only a hint to the server, so failing to send them is not
+	# an error.
+	def send_cancels( self, ids ):
+		if not ids:
+			return
+		try:
+			self.send_string( "".join( [ encode_request( id, cancel=True ) for id in ids ] ) )
+		except socket.error:
+			pass
+
+	def outstanding( self ):
+		return len( self._pending )
+
+	# Frames of responses alone may be read without building an Rpc; see
+	# common.quick_responses.
 	def string_received( self, data ):
-		rpc = Rpc()
-		rpc.ParseFromString( data )
-		for serializedResponse in rpc.response:
+		responses = quick_responses( data )
+		if responses is None:
+			rpc = Rpc()
+			rpc.ParseFromString( data )
+			responses = rpc.response
+		for serializedResponse in responses:
 			id = serializedResponse.id
-			if self._pending.has_key( id ) and self._pending[ id ] != None:
-				responseClass = self._pending[ id ][ 0 ]
-				done = self._pending[ id ][ 1 ]
-				done( self.unserialize_response( serializedResponse, responseClass ) )
+			if serializedResponse.more and isinstance( self._pending.get( id ), Stream ):
+				call = self._pending.get( id )
+			else:
+				call = self.pop_pending( id )
+			if call is None:
+				continue
+			try:
+				self._compressor.decode( serializedResponse, 'serialized_response' )
+			except ValueError:
+				if serializedResponse.more:
+					self.pop_pending( id )
+				serializedResponse = self.error_response( id, RpcErrors.CANNOT_DECOMPRESS )
+			self.deliver( call, serializedResponse )
+		return len( responses )
+
+	def deliver( self, call, serializedResponse ):
+		if isinstance( call, Stream ):
+			call.callback( serializedResponse )
+		else:
+			self.complete_call( call, serializedResponse )
+
+	def complete_call( self, call, serializedResponse ):
+		responseClass, rpcController, done = call[ :3 ]
+		if serializedResponse.HasField( 'error' ):
+			# Calls made without a controller get None instead.
+			if rpcController is None:
+				response = None
+			else:
+				rpcController.SetFailed( serializedResponse.error.text )
+				response = responseClass()
+		else:
+			response = self.unserialize_response( serializedResponse, responseClass )
+		if done is not None:
+			done( response )
+		return response
 	
 	def unserialize_response( self, serializedResponse, responseClass ):
 		response = responseClass()
@@ -89,92 +395,1257 @@ class TcpChannel( google.protobuf.service.RpcChannel ):
 		serializedResponse.serialized_response = response.SerializeToString()
 		return serializedResponse
 
+	def error_response( self, id, code ):
+		serializedResponse = Response()
+		serializedResponse.id = id
+		serializedResponse.error.code = code
+		serializedResponse.error.text = RpcErrors.msgs[ code ]
+		return serializedResponse
+
 	def serialize_rpc( self, serializedResponse ):
 		rpc = Rpc()
 		rpcResponse = rpc.response.add()
 		rpcResponse.serialized_response = serializedResponse.serialized_response
 		rpcResponse.id = serializedResponse.id
 		return rpc
+
+# The client end of a streamed call, from open_stream or call_stream: an
+# iterator over the responses which raises RpcError if the call failed.
+# Methods that take a stream of requests are fed with write(), and close()
+# ends the stream, optionally with one last request.
+class Stream( object ):
+	def __init__( self, channel, id, methodDescriptor, responseClass, rpcController ):
+		self.id = id
+		self.method = methodDescriptor
+		self._channel = channel
+		self._responseClass = responseClass
+		self._controller = rpcController
+		self._condition = threading.Condition()
+		self._responses = deque()
+		self._finished = False
+		self._error = None
+
+	def write( self, request ):
+		self._channel.send_stream_request( self, request, True )
+
+	def close( self, request=None ):
+		self._channel.send_stream_request( self, request, False )
+
+	def __iter__( self ):
+		return self
+
+	def next( self ):
+		self._channel.wait_stream( self )
+		self._condition.acquire()
+		try:
+			if self._responses:
+				return self._responses.popleft()
+			if self._error is not None:
+				raise self._error
+			raise StopIteration
+		finally:
+			self._condition.release()
+
+	def ready( self ):
+		return bool( self._responses ) or self._finished
+
+	def wait( self ):
+		self._condition.acquire()
+		try:
+			while not self.ready():
+				self._condition.wait()
+		finally:
+			self._condition.release()
+
+	def callback( self, serializedResponse ):
+		response = None
+		if serializedResponse.HasField( 'error' ):
+			if self._controller is not None:
+				self._controller.SetFailed( serializedResponse.error.text )
+			error = RpcError( serializedResponse.error.code, serializedResponse.error.text )
+		else:
+			error = None
+			if serializedResponse.HasField( 'serialized_response' ):
+				response = self._responseClass()
+				response.ParseFromString( serializedResponse.serialized_response )
+		self._condition.acquire()
+		try:
+			if response is not None:
+				self._responses.append( response )
+			if not serializedResponse.more:
+				self._error = error
+				self._finished = True
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+
+	def fail( self, exception ):
+		self._condition.acquire()
+		try:
+			self._error = exception
+			self._finished = True
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+
+class Future( object ):
+	def __init__( self ):
+		self._condition = threading.Condition()
+		self._done = False
+		self._result = None
+		self._exception = None
+
+	def done( self ):
+		return self._done
+
+	def wait( self, timeout=None ):
+		self._condition.acquire()
+		try:
+			if not self._done:
+				self._condition.wait( timeout )
+			return self._done
+		finally:
+			self._condition.release()
+
+	def result( self, timeout=None ):
+		if not self.wait( timeout ):
+			raise RuntimeError( "timed out waiting for response" )
+		if self._exception is not None:
+			raise self._exception
+		return self._result
+
+	def exception( self, timeout=None ):
+		if not self.wait( timeout ):
+			raise RuntimeError( "timed out waiting for response" )
+		return self._exception
+
+	def set_result( self, result ):
+		self._set( result, None )
+
+	def set_exception( self, exception ):
+		self._set( None, exception )
+
+	def _set( self, result, exception ):
+		self._condition.acquire()
+		try:
+			self._result = result
+			self._exception = exception
+			self._done = True
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+
+# A TcpChannel that may be shared between threads. Requests are written as
+# soon as they are made and a reader thread matches responses to callers by
+# id and expires calls that time out, woken through a pipe when a call with
+# an earlier deadline is made. CallMethod returns a Future; done is called
+# from the reader thread before the Future resolves. With max_pending set,
+# callers block (or fail fast) while that many calls are outstanding.
+class PipelinedTcpChannel( TcpChannel ):
+	def __init__( self, addr, **kwargs ):
+		self._lock = threading.Lock()
+		self._slotFreed = threading.Condition( self._lock )
+		self._sendLock = threading.Lock()
+		self._batchFutures = []
+		self._error = None
+		self._readerThread = None
+		self._wakeup = None
+		self._readerDeadline = None
+		TcpChannel.__init__( self, addr, **kwargs )
+
+	def connect( self, addr ):
+		TcpChannel.connect( self, addr )
+		self._error = None
+		self._wakeup = os.pipe()
+		self._readerThread = threading.Thread( target=self._read_loop )
+		self._readerThread.setDaemon( True )
+		self._readerThread.start()
+
+	def close( self ):
+		try:
+			self._tcpSocket.shutdown( socket.SHUT_RDWR )
+		except socket.error:
+			pass
+		self._tcpSocket.close()
+		if self._readerThread is not threading.currentThread():
+			self._readerThread.join()
+			for fd in self._wakeup:
+				os.close( fd )
+
+	def send_string( self, buffer ):
+		self._sendLock.acquire()
+		try:
+			TcpChannel.send_string( self, buffer )
+		finally:
+			self._sendLock.release()
+
+	def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done=None ):
+		future = Future()
+		if self._decoding is not None:
+			responseClass = decoder( responseClass, self._decoding, method_name( methodDescriptor ) )
+		if self._metrics is not None:
+			done = timed_call( self._metrics, method_name( methodDescriptor ), rpcController, done )
+		if self._cache is not None:
+			response, done = self._cache.call( methodDescriptor, rpcController, request, responseClass, done )
+			if response is not None:
+				if done is not None:
+					done( response )
+				future.set_result( response )
+				return future
+		if self._singleFlight is not None:
+			# Calls that share another's response resolve their Future here;
+			# the first call's is also set by complete_call, to the same
+			# response.
+			def settle( response, done=done ):
+				if done is not None:
+					done( response )
+				future.set_result( response )
+			done = self._singleFlight.join( methodDescriptor, rpcController, request, responseClass, settle )
+			if done is None:
+				return future
+		call = ( responseClass, rpcController, done, future )
+		self._lock.acquire()
+		try:
+			if self._error is not None:
+				raise self._error
+			code = self._wait_for_slot( rpcController )
+			if code is None:
+				self.id += 1
+				id = self.id
+				deadline = self.add_pending( id, call, rpcController )
+				if self._batch is not None:
+					self.serialize_request( self._batch, methodDescriptor, request, id, deadline )
+					self._batchFutures.append( future )
+					return future
+		finally:
+			self._lock.release()
+
+		if code is not None:
+			self.complete_call( call, self.error_response( 0, code ) )
+			return future
+		self.send_string( self.encode_request( methodDescriptor, request, id, deadline ) )
+		return future
+
+	# Called with self._lock held.
+	def add_pending( self, id, call, rpcController ):
+		deadline = TcpChannel.add_pending( self, id, call, rpcController )
+		if deadline is not None and ( self._readerDeadline is None or deadline < self._readerDeadline ):
+			self._readerDeadline = deadline
+			os.write( self._wakeup[ 1 ], "x" )
+		return deadline
+
+	def open_stream( self, methodDescriptor, responseClass, rpcController=None ):
+		self._lock.acquire()
+		try:
+			if self._error is not None:
+				raise self._error
+			return TcpChannel.open_stream( self, methodDescriptor, responseClass, rpcController )
+		finally:
+			self._lock.release()
+
+	def wait_stream( self, stream ):
+		stream.wait()
+
+	# Called with self._lock held. Requests held back in an open batch are
+	# sent first, since their responses are what frees the slots.
+	def _wait_for_slot( self, rpcController ):
+		if not self._pending.full():
+			return None
+		if not self._block:
+			return RpcErrors.TOO_MANY_PENDING
+		timeout = getattr( rpcController, "timeout", None )
+		if timeout is None:
+			timeout = self._pending.timeout
+		if timeout is not None:
+			deadline = time.time() + timeout
+		while self._pending.full():
+			if self._error is not None:
+				raise self._error
+			if self._batch is not None and len( self._batch.request ):
+				rpc, self._batch = self._batch, Rpc()
+				self._lock.release()
+				try:
+					self.send_string( rpc.SerializeToString() )
+				finally:
+					self._lock.acquire()
+				continue
+			if timeout is None:
+				self._slotFreed.wait()
+			else:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return RpcErrors.TIMEOUT
+				self._slotFreed.wait( remaining )
+		return None
+
+	def start_batch( self ):
+		self._lock.acquire()
+		try:
+			TcpChannel.start_batch( self )
+		finally:
+			self._lock.release()
+
+	def flush( self ):
+		self._lock.acquire()
+		try:
+			rpc, futures = self._batch, self._batchFutures
+			if self._held:
+				self._batch = Rpc()
+			else:
+				self._batch = None
+			self._batchFutures = []
+		finally:
+			self._lock.release()
+		if rpc is not None and len( rpc.request ):
+			self.send_string( rpc.SerializeToString() )
+		for future in futures:
+			future.wait()
+
+	def pop_pending( self, id ):
+		self._lock.acquire()
+		try:
+			call = self._pending.pop( id )
+			if call is not None:
+				self._slotFreed.notify()
+			return call
+		finally:
+			self._lock.release()
+
+	def expire_calls( self ):
+		self._lock.acquire()
+		try:
+			expired = self._pending.expire( time.time() )
+			self._slotFreed.notifyAll()
+		finally:
+			self._lock.release()
+		for id, call in expired:
+			self.deliver( call, self.error_response( id, RpcErrors.TIMEOUT ) )
+		self.send_cancels( [ id for id, call in expired ] )
+
+	def complete_call( self, call, serializedResponse ):
+		response = TcpChannel.complete_call( self, call, serializedResponse )
+		call[ 3 ].set_result( response )
+		return response
+
+	def _readable( self, deadline ):
+		if self._reader.has_frame():
+			return True
+		timeout = None
+		if deadline is not None:
+			timeout = max( deadline - time.time(), 0 )
+		readable = select.select( [ self._tcpSocket, self._wakeup[ 0 ] ], [], [], timeout )[ 0 ]
+		if self._wakeup[ 0 ] in readable:
+			os.read( self._wakeup[ 0 ], 512 )
+		return self._tcpSocket in readable
+
+	def _read_loop( self ):
+		try:
+			while True:
+				self._lock.acquire()
+				try:
+					deadline = self._readerDeadline = self._pending.next_deadline()
+				finally:
+					self._lock.release()
+				if deadline is not None and deadline <= time.time():
+					self.expire_calls()
+				elif self._readable( deadline ):
+					self.string_received( self.recv_string() )
+		except Exception, e:
+			self._lock.acquire()
+			try:
+				self._error = e
+				pending = self._pending.clear()
+				self._slotFreed.notifyAll()
+			finally:
+				self._lock.release()
+			for id, call in pending:
+				if isinstance( call, Stream ):
+					call.fail( e )
+				else:
+					call[ 3 ].set_exception( e )
 	
+class _Endpoint( object ):
+	def __init__( self, addr, health ):
+		self.addr = addr
+		self.health = health
+		self.channels = []
+
+# The synchronous counterpart of tx.PooledChannel. It is built on
+# PipelinedTcpChannel, so it may be shared between threads and CallMethod
+# returns the chosen connection's Future. Endpoints are dialled by the
+# constructor; a background thread replaces connections that die, trying
+# again every retry_interval seconds.
+class PooledChannel( google.protobuf.service.RpcChannel ):
+	def __init__( self, endpoints, size=1, balance="least_outstanding", max_failures=3,
+			eject_time=10, retry_interval=1, **kwargs ):
+		google.protobuf.service.RpcChannel.__init__( self )
+		self._kwargs = kwargs
+		self._size = size
+		self._balance = balancers[ balance ]
+		self._retryInterval = retry_interval
+		self._lock = threading.Lock()
+		self._closed = threading.Event()
+		self._batches = []
+		self._endpoints = [ _Endpoint( addr, EndpointHealth( max_failures, eject_time ) )
+			for addr in endpoints ]
+		for endpoint in self._endpoints:
+			self._fill( endpoint )
+		self._maintainer = threading.Thread( target=self._maintain )
+		self._maintainer.setDaemon( True )
+		self._maintainer.start()
+
+	def _fill( self, endpoint ):
+		while len( endpoint.channels ) < self._size and not self._closed.isSet():
+			if endpoint.health.ejected( time.time() ):
+				return
+			try:
+				channel = PipelinedTcpChannel( endpoint.addr, **self._kwargs )
+			except socket.error:
+				self._lock.acquire()
+				try:
+					endpoint.health.failed( time.time() )
+				finally:
+					self._lock.release()
+				return
+			channel.endpoint = endpoint
+			self._lock.acquire()
+			try:
+				if not self._closed.isSet():
+					endpoint.channels.append( channel )
+					channel = None
+			finally:
+				self._lock.release()
+			if channel is not None:
+				channel.close()
+
+	def _maintain( self ):
+		while not self._closed.isSet():
+			for endpoint in self._endpoints:
+				self._lock.acquire()
+				try:
+					dead = [ c for c in endpoint.channels if c._error is not None ]
+					for channel in dead:
+						endpoint.channels.remove( channel )
+						endpoint.health.failed( time.time() )
+				finally:
+					self._lock.release()
+				for channel in dead:
+					channel.close()
+				self._fill( endpoint )
+			self._closed.wait( self._retryInterval )
+
+	# Called with self._lock held.
+	def connections( self ):
+		now = time.time()
+		channels = []
+		for endpoint in self._endpoints:
+			if not endpoint.health.ejected( now ):
+				channels.extend( [ c for c in endpoint.channels if c._error is None ] )
+		if not channels:
+			for endpoint in self._endpoints:
+				channels.extend( [ c for c in endpoint.channels if c._error is None ] )
+		return channels
+
+	def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done=None ):
+		self._lock.acquire()
+		try:
+			channels = self.connections()
+			if channels:
+				channel = self._balance( channels )
+		finally:
+			self._lock.release()
+
+		if not channels:
+			future = Future()
+			if rpcController is not None:
+				rpcController.SetFailed( RpcErrors.msgs[ RpcErrors.CONNECTION_LOST ] )
+			response = responseClass()
+			if done is not None:
+				done( response )
+			future.set_result( response )
+			return future
+		return channel.CallMethod( methodDescriptor, rpcController, request, responseClass,
+			self._call_done( channel.endpoint, rpcController, done ) )
+
+	def open_stream( self, methodDescriptor, responseClass, rpcController=None ):
+		self._lock.acquire()
+		try:
+			channels = self.connections()
+			if channels:
+				channel = self._balance( channels )
+		finally:
+			self._lock.release()
+		if not channels:
+			raise RpcError( RpcErrors.CONNECTION_LOST )
+		return channel.open_stream( methodDescriptor, responseClass, rpcController )
+
+	def call_stream( self, methodDescriptor, request, responseClass, rpcController=None ):
+		stream = self.open_stream( methodDescriptor, responseClass, rpcController )
+		stream.close( request )
+		return stream
+
+	def _call_done( self, endpoint, rpcController, done ):
+		def call_done( response ):
+			self._lock.acquire()
+			try:
+				if transport_failed( rpcController ):
+					endpoint.health.failed( time.time() )
+				else:
+					endpoint.health.succeeded()
+			finally:
+				self._lock.release()
+			if done is not None:
+				done( response )
+		return call_done
+
+	def start_batch( self ):
+		self._lock.acquire()
+		try:
+			channels = self.connections()
+		finally:
+			self._lock.release()
+		for channel in channels:
+			channel.start_batch()
+		self._batches.append( channels )
+
+	def end_batch( self ):
+		for channel in self._batches.pop():
+			channel.end_batch()
+
+	def close( self ):
+		self._closed.set()
+		self._maintainer.join()
+		self._lock.acquire()
+		try:
+			channels = []
+			for endpoint in self._endpoints:
+				channels.extend( endpoint.channels )
+				endpoint.channels = []
+		finally:
+			self._lock.release()
+		for channel in channels:
+			channel.close()
+
 class Proxy( object ):
+	# Holds a _Method for each method of the stub's service, built once from
+	# its descriptor.
 	class _Proxy( object ):
-		def __init__( self, stub ):
+		def __init__( self, stub, calls=None, decoding=None ):
 			self._stub = stub
-		
+			for method in stub.GetDescriptor().methods:
+				setattr( self, method.name, Proxy._Method( stub, method, calls, decoding ) )
+
+	# proxy.Service.Method( request ) returns the response in a tuple;
+	# proxy.Service.Method.stream( request ) a Stream of responses, and
+	# proxy.Service.Method.open() a Stream to write requests to.
+	# proxy.Service.Method.call( request ) returns the response itself, or
+	# None if there was none or the call failed, without a Controller; a
+	# controller given is told why, and may be Reset() and passed again.
+	class _Method( object ):
+		def __init__( self, stub, method, calls, decoding=None ):
+			self._channel = stub.rpc_channel
+			self._method = method
+			self._calls = calls
+			self._responseClass = decoder( stub.GetResponseClass( method ), decoding, method_name( method ) )
+
+		def __call__( self, request ):
+			response = []
+			future = self._channel.CallMethod( self._method, Controller(), request, self._responseClass,
+				response.append )
+			if self._calls is not None:
+				self._calls.append( response )
+				return
+			if isinstance( future, Future ):
+				future.result()
+			return tuple( response )
+
+		def call( self, request, controller=None ):
+			response = []
+			future = self._channel.CallMethod( self._method, controller, request, self._responseClass,
+				response.append )
+			if isinstance( future, Future ):
+				future.result()
+			return response[ 0 ] if response else None
+
+		def stream( self, request ):
+			stream = self.open()
+			stream.close( request )
+			return stream
+
+		def open( self ):
+			return self._channel.open_stream( self._method, self._responseClass, Controller() )
+
+	class _Batch( object ):
+		def __init__( self, stubs, decoding=None ):
+			self._calls = []
+			self._channels = []
+			self._stubs = {}
+			for name, stub in stubs.items():
+				self._stubs[ name ] = Proxy._Proxy( stub, self._calls, decoding )
+				if stub.rpc_channel not in self._channels:
+					self._channels.append( stub.rpc_channel )
+			for channel in self._channels:
+				channel.start_batch()
+
 		def __getattr__( self, key ):
-			def call( method, request ):
-				class callbackClass( object ):
-					def __init__( self ):
-						self.response = []
-					def __call__( self, response ):
-						self.response.append( response )
-				controller = Controller()
-				callback = callbackClass()
-				method( controller, request, callback )
-				return tuple( callback.response )
-			return lambda request: call( getattr( self._stub, key ), request )
+			return self._stubs[ key ]
+
+		def __enter__( self ):
+			return self
+
+		def __exit__( self, *exc_info ):
+			self.flush()
+
+		def flush( self ):
+			channels, self._channels = self._channels, []
+			for channel in channels:
+				channel.end_batch()
+			return [ tuple( response ) for response in self._calls ]
 	
-	def __init__( self, *stubs ):
+	# Responses are decoded as decoding says, if given; see common.decoder.
+	# Requests may be RawMessages as well as messages.
+	def __init__( self, *stubs, **kwargs ):
 		self._stubs = {}
+		self._rawStubs = {}
+		self._decoding = kwargs.get( "decoding" )
 		for s in stubs:
-			self._stubs[ s.GetDescriptor().name ] = self._Proxy( s )
+			self._stubs[ s.GetDescriptor().name ] = self._Proxy( s, decoding=self._decoding )
+			self._rawStubs[ s.GetDescriptor().name ] = s
 	
 	def __getattr__( self, key ):
 		return self._stubs[ key ]
 
+	def batch( self ):
+		return self._Batch( self._rawStubs, self._decoding )
+
+# Serves one connection at a time. host may be the path of a Unix domain
+# socket instead of a ( host, port ) pair; a socket left at that path by a
+# server that is no longer running is replaced, and server_close() removes
+# it.
 class TcpServer( SocketServer.TCPServer ):
-	def __init__( self, host, *services ):
-		self.services = {}
-		for s in services:
-			self.services[ s.GetDescriptor().name ] = s
-		self.channel = TcpChannel()
-		SocketServer.TCPServer.__init__( self, host, TcpRequestHandler )
+	allow_reuse_address = True
+
+	def __init__( self, host, *services, **kwargs ):
+		self.address_family = address_family( host )
+		# How requests are decoded, for instance { "Router": "raw" }; see
+		# common.decoder.
+		self.dispatch = DispatchTable( services, kwargs.get( "decoding" ) )
+		self.services = self.dispatch.services
+		self.max_in_flight = kwargs.get( "max_in_flight" )
+		# Codecs offered to clients that ask for compressed responses; see
+		# Compressor.
+		self.compression = kwargs.get( "compression" )
+		self.compression_threshold = kwargs.get( "compression_threshold", 1024 )
+		# A protobufrpc.metrics.Metrics, or anything with its hooks.
+		self.metrics = kwargs.get( "metrics" )
+		# A ResponseCache for idempotent methods.
+		self.cache = kwargs.get( "cache" )
+		# A SingleFlight, so that threads handling identical requests at the
+		# same time wait for the first one's response.
+		self.single_flight = kwargs.get( "single_flight" )
+		if self.max_in_flight:
+			self._slots = threading.BoundedSemaphore( self.max_in_flight )
+		else:
+			self._slots = None
+		# Connections being served by a handler thread.
+		self.handlers = set()
+		self._handlersChanged = threading.Condition()
+		SocketServer.TCPServer.__init__( self, host, TcpRequestHandler,
+			kwargs.get( "bind_and_activate", True ) )
+
+	def server_bind( self ):
+		if self.address_family == socket.AF_UNIX and os.path.exists( self.server_address ):
+			probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+			try:
+				try:
+					probe.connect( self.server_address )
+				except socket.error, e:
+					if e.args[ 0 ] != errno.ECONNREFUSED:
+						raise
+					os.unlink( self.server_address )
+				else:
+					raise socket.error( errno.EADDRINUSE, os.strerror( errno.EADDRINUSE ) )
+			finally:
+				probe.close()
+		SocketServer.TCPServer.server_bind( self )
+
+	def server_close( self ):
+		SocketServer.TCPServer.server_close( self )
+		if self.address_family == socket.AF_UNIX:
+			try:
+				os.unlink( self.server_address )
+			except OSError:
+				pass
+
+	def process_string( self, handler, data ):
+		self.acquire_slot()
+		try:
+			handler.string_received( data )
+		finally:
+			self.release_slot()
+
+	def compressor( self ):
+		return Compressor( self.compression, self.compression_threshold )
+
+	def parse_rpc( self, data ):
+		rpc = Rpc()
+		if self.metrics is None:
+			rpc.ParseFromString( data )
+			return rpc
+		started = time.time()
+		rpc.ParseFromString( data )
+		self.metrics.parsed( len( data ), time.time() - started, len( rpc.request ) + len( rpc.response ) )
+		return rpc
+
+	def add_handler( self, handler ):
+		self._handlersChanged.acquire()
+		self.handlers.add( handler )
+		self._handlersChanged.release()
+
+	def remove_handler( self, handler ):
+		self._handlersChanged.acquire()
+		self.handlers.discard( handler )
+		self._handlersChanged.notifyAll()
+		self._handlersChanged.release()
+
+	# Stops reading from the open connections, once shutdown() has stopped
+	# accepting new ones. Each connection finishes the calls it has started
+	# and closes. Returns whether they all did within timeout seconds.
+	def drain( self, timeout=None ):
+		if timeout is not None:
+			deadline = time.time() + timeout
+		self._handlersChanged.acquire()
+		try:
+			for handler in self.handlers:
+				try:
+					handler.request.shutdown( socket.SHUT_RD )
+				except socket.error:
+					pass
+			while self.handlers:
+				if timeout is None:
+					self._handlersChanged.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+					self._handlersChanged.wait( remaining )
+			return True
+		finally:
+			self._handlersChanged.release()
+
+	def acquire_slot( self ):
+		if self._slots is not None:
+			self._slots.acquire()
+
+	def release_slot( self ):
+		if self._slots is not None:
+			self._slots.release()
+
+# Connections are read by a thread each and every received frame is handed
+# to a fixed pool of worker threads, so one slow method only holds up its
+# own worker. With max_in_flight set, readers block once that many frames
+# are queued or running.
+class ThreadPoolTcpServer( SocketServer.ThreadingMixIn, TcpServer ):
+	daemon_threads = True
+
+	def __init__( self, host, *services, **kwargs ):
+		self.pool_size = kwargs.get( "pool_size", 8 )
+		self._jobs = Queue.Queue()
+		self._workers = []
+		TcpServer.__init__( self, host, *services, **kwargs )
+
+	def serve_forever( self, *args ):
+		self.start_workers()
+		TcpServer.serve_forever( self, *args )
+
+	def start_workers( self ):
+		while len( self._workers ) < self.pool_size:
+			worker = threading.Thread( target=self._work )
+			worker.setDaemon( True )
+			worker.start()
+			self._workers.append( worker )
+
+	# Frames are parsed on the connection's thread; those carrying part of
+	# a client-streamed call are dispatched there too, to keep them in order.
+	# Cancels are acted on there and then, ahead of any queued requests.
+	def process_string( self, handler, data ):
+		rpc = self.parse_rpc( data )
+		handler.take_cancels( rpc )
+		if not len( rpc.request ):
+			return
+		if handler.in_stream( rpc ):
+			self.acquire_slot()
+			try:
+				handler.rpc_received( rpc )
+			finally:
+				self.release_slot()
+			return
+		self.acquire_slot()
+		handler.job_started()
+		self._jobs.put( ( handler, rpc, time.time() ) )
+
+	def _work( self ):
+		while True:
+			handler, rpc, queued = self._jobs.get()
+			try:
+				try:
+					handler.rpc_received( rpc, time.time() - queued )
+				except Exception:
+					self.handle_error( handler.request, handler.client_address )
+			finally:
+				handler.job_finished()
+				self.release_slot()
+
+# Forks processes children after binding, each of which accepts from the
+# shared listening socket and serves its connections with its own pool of
+# worker threads.
+class PreForkTcpServer( ThreadPoolTcpServer ):
+	def __init__( self, host, *services, **kwargs ):
+		self.processes = kwargs.get( "processes", 4 )
+		self.children = []
+		self._childrenLock = threading.Lock()
+		self._stopping = False
+		ThreadPoolTcpServer.__init__( self, host, *services, **kwargs )
+
+	def serve_forever( self, *args ):
+		for i in range( self.processes ):
+			self._childrenLock.acquire()
+			try:
+				if self._stopping:
+					break
+				# The parent waits until the child has dropped any inherited
+				# SIGTERM handler, so that shutdown() can always stop it.
+				ready, started = os.pipe()
+				pid = os.fork()
+				if pid == 0:
+					try:
+						signal.signal( signal.SIGTERM, signal.SIG_DFL )
+						os.close( ready )
+						os.write( started, "." )
+						os.close( started )
+						ThreadPoolTcpServer.serve_forever( self, *args )
+					finally:
+						os._exit( 0 )
+				os.close( started )
+				os.read( ready, 1 )
+				os.close( ready )
+				self.children.append( pid )
+			finally:
+				self._childrenLock.release()
+
+		while self.children:
+			try:
+				pid, status = os.wait()
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				if e.errno == errno.ECHILD:
+					break
+				raise
+			if pid in self.children:
+				self.children.remove( pid )
+
+	def shutdown( self ):
+		self._childrenLock.acquire()
+		try:
+			self._stopping = True
+			for pid in self.children[:]:
+				try:
+					os.kill( pid, signal.SIGTERM )
+				except OSError:
+					pass
+		finally:
+			self._childrenLock.release()
+
+# A single-threaded event loop over non-blocking sockets (epoll where the
+# platform has it, select otherwise). Methods run inline on the loop, so
+# there is never more than one call in flight.
+class SelectTcpServer( TcpServer ):
+	def __init__( self, host, *services, **kwargs ):
+		self._connections = {}
+		self._running = False
+		TcpServer.__init__( self, host, *services, **kwargs )
+
+	def serve_forever( self, poll_interval=0.5 ):
+		self.socket.setblocking( 0 )
+		if hasattr( select, "epoll" ):
+			poller = _EpollPoller()
+		else:
+			poller = _SelectPoller()
+		poller.register( self.socket.fileno(), True, False )
+		self._running = True
+		try:
+			while self._running:
+				for fd, readable, writable in poller.poll( poll_interval ):
+					if fd == self.socket.fileno():
+						self._accept( poller )
+						continue
+					connection = self._connections.get( fd )
+					if connection is None:
+						continue
+					if readable:
+						connection.handle_read()
+					if writable and not connection.closed:
+						connection.handle_write()
+					if connection.closed:
+						poller.unregister( fd )
+						del self._connections[ fd ]
+						connection.request.close()
+					else:
+						poller.modify( fd, True, connection.wants_write() )
+		finally:
+			poller.close()
+			for connection in self._connections.values():
+				connection.request.close()
+			self._connections = {}
+
+	def shutdown( self ):
+		self._running = False
+
+	def _accept( self, poller ):
+		try:
+			request, clientAddress = self.socket.accept()
+		except socket.error, e:
+			if e.args[ 0 ] in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+				return
+			raise
+		request.setblocking( 0 )
+		connection = _SelectConnection( request, clientAddress, self )
+		self._connections[ request.fileno() ] = connection
+		poller.register( request.fileno(), True, False )
+
+class _SelectPoller( object ):
+	def __init__( self ):
+		self._readers = set()
+		self._writers = set()
+
+	def register( self, fd, readable, writable ):
+		self.modify( fd, readable, writable )
+
+	def modify( self, fd, readable, writable ):
+		for fds, wanted in ( ( self._readers, readable ), ( self._writers, writable ) ):
+			if wanted:
+				fds.add( fd )
+			else:
+				fds.discard( fd )
+
+	def unregister( self, fd ):
+		self._readers.discard( fd )
+		self._writers.discard( fd )
+
+	def poll( self, timeout ):
+		try:
+			readable, writable, _ = select.select( self._readers, self._writers, [], timeout )
+		except select.error, e:
+			if e.args[ 0 ] == errno.EINTR:
+				return []
+			raise
+		readable = set( readable )
+		writable = set( writable )
+		return [ ( fd, fd in readable, fd in writable ) for fd in readable | writable ]
+
+	def close( self ):
+		pass
+
+class _EpollPoller( object ):
+	def __init__( self ):
+		self._epoll = select.epoll()
+
+	def _mask( self, readable, writable ):
+		mask = 0
+		if readable:
+			mask |= select.EPOLLIN
+		if writable:
+			mask |= select.EPOLLOUT
+		return mask
+
+	def register( self, fd, readable, writable ):
+		self._epoll.register( fd, self._mask( readable, writable ) )
+
+	def modify( self, fd, readable, writable ):
+		self._epoll.modify( fd, self._mask( readable, writable ) )
+
+	def unregister( self, fd ):
+		self._epoll.unregister( fd )
+
+	def poll( self, timeout ):
+		try:
+			events = self._epoll.poll( timeout )
+		except IOError, e:
+			if e.errno == errno.EINTR:
+				return []
+			raise
+		errorMask = select.EPOLLERR | select.EPOLLHUP
+		return [ ( fd, bool( mask & ( select.EPOLLIN | errorMask ) ), bool( mask & select.EPOLLOUT ) )
+			for fd, mask in events ]
+
+	def close( self ):
+		self._epoll.close()
 
 class TcpRequestHandler( SocketServer.BaseRequestHandler ):
+	def setup( self ):
+		self._reader = FrameReader( self.request )
+		self._streams = {}
+		self._compressor = self.server.compressor()
+		self._serving = {}
+		self._cancelled = set()
+		self._servingLock = threading.Lock()
+		self._sendLock = threading.Lock()
+		self._sendFrame = send_frame
+		self._jobs = 0
+		self._idle = threading.Condition()
+		self.server.add_handler( self )
+
+	def finish( self ):
+		self.server.remove_handler( self )
+
 	def handle( self ):
-		print self.server
-		buffer = self.request.recv( struct.calcsize( "!I" ) )
-		bufferLen = int( struct.unpack( "!I", buffer )[0] )
-		buffer = self.request.recv( bufferLen )
-		self.string_received( buffer )
+		while True:
+			data = self.recv_string()
+			if data is None:
+				break
+			self.server.process_string( self, data )
+		self.wait_for_jobs()
+
+	def recv_string( self ):
+		return self._reader.read_frame()
 
 	def send_string( self, buffer ):
-		networkOrderBufferLen = struct.pack( "!I", len( buffer ) )
+		if self.server.metrics is not None:
+			self.server.metrics.written( len( buffer ) )
+		self._sendLock.acquire()
+		try:
+			self._sendFrame( self.request, buffer )
+		finally:
+			self._sendLock.release()
 
-		buffer = networkOrderBufferLen + buffer
-		bytesSent = 0
-		while bytesSent < len( buffer ):
-			sent = self.request.send( buffer[ bytesSent: ] )
-			if sent == 0:
-				raise RuntimeError( "socket connection broken" )
-			bytesSent += sent
+	def job_started( self ):
+		self._idle.acquire()
+		self._jobs += 1
+		self._idle.release()
+
+	def job_finished( self ):
+		self._idle.acquire()
+		self._jobs -= 1
+		self._idle.notifyAll()
+		self._idle.release()
+
+	def wait_for_jobs( self ):
+		self._idle.acquire()
+		try:
+			while self._jobs:
+				self._idle.wait()
+		finally:
+			self._idle.release()
 
 	def string_received( self, data ):
-		rpc = Rpc()
-		rpc.ParseFromString( data )
+		self.rpc_received( self.server.parse_rpc( data ) )
+
+	# Cancels the requests being served that the client has given up on.
+	# Cancels for requests that have not been started yet are remembered,
+	# a limited number of them.
+	def cancel_request( self, id ):
+		self._servingLock.acquire()
+		try:
+			controller = self._serving.pop( id, None )
+			if controller is None:
+				if len( self._cancelled ) >= 1024:
+					self._cancelled.clear()
+				self._cancelled.add( id )
+		finally:
+			self._servingLock.release()
+		if controller is not None:
+			controller.StartCancel()
+
+	# Acts on the cancels in rpc, and takes them out of it.
+	def take_cancels( self, rpc ):
+		for i in reversed( range( len( rpc.request ) ) ):
+			if rpc.request[ i ].cancel:
+				self.cancel_request( rpc.request[ i ].id )
+				del rpc.request[ i ]
+
+	def _was_cancelled( self, id ):
+		self._servingLock.acquire()
+		try:
+			if id not in self._cancelled:
+				return False
+			self._cancelled.discard( id )
+			return True
+		finally:
+			self._servingLock.release()
+
+	def _start_serving( self, id, controller ):
+		self._servingLock.acquire()
+		try:
+			self._serving[ id ] = controller
+		finally:
+			self._servingLock.release()
+
+	def _stop_serving( self, id ):
+		self._servingLock.acquire()
+		try:
+			self._serving.pop( id, None )
+		finally:
+			self._servingLock.release()
+
+	# Whether rpc carries part of a client-streamed call. Such frames must
+	# be handled in the order they arrive.
+	def in_stream( self, rpc ):
 		for serializedRequest in rpc.request:
-			service = self.server.services[ serializedRequest.method.split( '.' )[ 0 ] ]
-			method = service.GetDescriptor().FindMethodByName( serializedRequest.method.split( '.' )[ 1 ] )
-			if method:
-				request = service.GetRequestClass( method )()
-				request.ParseFromString( serializedRequest.serialized_request )
+			if serializedRequest.more or serializedRequest.id in self._streams:
+				return True
+		return False
+
+	# queued is how long rpc waited for a worker thread.
+	def rpc_received( self, rpc, queued=0 ):
+		metrics = self.server.metrics
+		# The Rpc response entries to send back; see common.encode_response.
+		entries = []
+		for serializedRequest in rpc.request:
+			if serializedRequest.cancel:
+				self.cancel_request( serializedRequest.id )
+				continue
+			stream = self._streams.get( serializedRequest.id )
+			if stream is not None:
+				entry, controller = stream
+				if not serializedRequest.more:
+					del self._streams[ serializedRequest.id ]
+			else:
+				entry = self.server.dispatch.lookup( serializedRequest )
+				if entry is None:
+					entries.append( self.error_entry( serializedRequest.id,
+						self.server.dispatch.error_code( serializedRequest ) ) )
+					continue
 				controller = Controller()
+				controller.writer = self._stream_writer( serializedRequest.id )
+				if serializedRequest.more:
+					self._streams[ serializedRequest.id ] = ( entry, controller )
+			controller.more = serializedRequest.more
 
-				class callbackClass( object ):
-					def __init__( self ):
-						self.response = None
-					def __call__( self, response ):
-						self.response = response
-				callback = callbackClass()
-				service.CallMethod( method, controller, request, callback )
-				responseRpc = self.serialize_rpc( self.serialize_response( callback.response, serializedRequest ) )
-				self.send_string( responseRpc.SerializeToString() )
+			try:
+				self._compressor.decode( serializedRequest, 'serialized_request' )
+			except ValueError:
+				self._streams.pop( serializedRequest.id, None )
+				entries.append( self.error_entry( serializedRequest.id, RpcErrors.CANNOT_DECOMPRESS ) )
+				continue
 
-	def serialize_response( self, response, serializedRequest ):
-		serializedResponse = Response ()
-		serializedResponse.id = serializedRequest.id
-		serializedResponse.serialized_response = response.SerializeToString()
-		return serializedResponse
+			# Requests the client has cancelled, or that have waited past
+			# its timeout, are dropped without an answer.
+			if serializedRequest.HasField( 'timeout' ):
+				controller.deadline = time.time() - queued + serializedRequest.timeout / 1000.0
+			if not serializedRequest.more and ( self._was_cancelled( serializedRequest.id ) or
+					controller.IsCancelled() ):
+				self._streams.pop( serializedRequest.id, None )
+				continue
+
+			cache = self.server.cache
+			if cache is not None and ( stream is not None or serializedRequest.more or not cache.enabled( entry.name ) ):
+				cache = None
+			if cache is not None:
+				data = cache.get( entry.name, serializedRequest.serialized_request )
+				if data is not None:
+					data, codec, codecs = self._compressor.pack( data )
+					entries.append( encode_response( serializedRequest.id, data, codec=codec, codecs=codecs ) )
+					continue
+
+			flight = self.server.single_flight
+			if flight is not None and ( stream is not None or serializedRequest.more or not flight.enabled( entry.name ) ):
+				flight = None
+			if flight is not None:
+				shared = self._join_flight( flight, entry.name, serializedRequest.serialized_request )
+				if shared is None:
+					leader = True
+				else:
+					leader = False
+					response, error = shared
+					if response is not None or error is not None:
+						if error is not None:
+							controller.SetFailed( error )
+						entries.append( self.serialize_response( response, serializedRequest, controller, entry.name ) )
+						continue
+
+			if stream is not None and not serializedRequest.HasField( 'serialized_request' ):
+				request = None
+			else:
+				request = entry.requestClass()
+				request.ParseFromString( serializedRequest.serialized_request )
+
+			class callbackClass( object ):
+				def __init__( self ):
+					self.called = False
+					self.response = None
+				def __call__( self, response ):
+					self.called = True
+					self.response = response
+			callback = callbackClass()
+			if metrics is not None and not serializedRequest.more:
+				metrics.dispatched( entry.name, len( serializedRequest.serialized_request ) )
+				started = time.time()
+			if not serializedRequest.more:
+				self._start_serving( serializedRequest.id, controller )
+			try:
+				entry.service.CallMethod( entry.method, controller, request, callback )
+			finally:
+				if not serializedRequest.more:
+					self._stop_serving( serializedRequest.id )
+					if metrics is not None:
+						metrics.finished( entry.name )
+				if flight is not None and leader:
+					error = None
+					if callback.called and controller.Failed():
+						error = controller.ErrorText()
+					flight.finish( entry.name, serializedRequest.serialized_request, ( callback.response, error ) )
+			if callback.called:
+				if metrics is not None and not serializedRequest.more:
+					metrics.handled( entry.name, time.time() - started, queued )
+				if controller.IsCancelled():
+					continue
+				entries.append( self.serialize_response( callback.response, serializedRequest, controller,
+					entry.name, cache ) )
+		if entries:
+			self.send_string( "".join( entries ) )
+
+	def error_entry( self, id, code ):
+		if self.server.metrics is not None:
+			self.server.metrics.error( code )
+		return encode_response( id, error=( code, RpcErrors.msgs[ code ] ) )
+
+	# Waits for the result of an identical request that another thread is
+	# handling, if there is one. Returns None if there is not, and this
+	# thread must finish the flight.
+	def _join_flight( self, flight, name, data ):
+		results = []
+		arrived = threading.Event()
+		def deliver( result ):
+			results.append( result )
+			arrived.set()
+		if flight.start( name, data, deliver ):
+			return None
+		arrived.wait()
+		return results[ 0 ]
+
+	def _stream_writer( self, id ):
+		def write( message ):
+			data, codec, codecs = self._compressor.pack( message.SerializeToString() )
+			self.send_string( encode_response( id, data, more=True, codec=codec, codecs=codecs ) )
+		return write
+
+	# Returns the Rpc response entry for a call's response.
+	def serialize_response( self, response, serializedRequest, controller=None, name=None, cache=None ):
+		if controller is not None and controller.Failed():
+			if self.server.metrics is not None:
+				self.server.metrics.error( 1 )
+			return encode_response( serializedRequest.id, error=( 1, controller.ErrorText() ) )
+		if response is None:
+			return encode_response( serializedRequest.id )
+		started = time.time()
+		data = response.SerializeToString()
+		if self.server.metrics is not None:
+			self.server.metrics.serialized( name, len( data ), time.time() - started )
+		if cache is not None:
+			cache.put( name, serializedRequest.serialized_request, data )
+		data, codec, codecs = self._compressor.pack( data )
+		return encode_response( serializedRequest.id, data, codec=codec, codecs=codecs )
 
 	def serialize_rpc( self, serializedResponse ):
 		rpc = Rpc()
@@ -182,3 +1653,286 @@ class TcpRequestHandler( SocketServer.BaseRequestHandler ):
 		rpcResponse.serialized_response = serializedResponse.serialized_response
 		rpcResponse.id = serializedResponse.id
 		return rpc
+
+# The per-connection state of a SelectTcpServer: frames are cut out of a
+# FrameReader as data arrives and replies are queued until the socket is
+# writable, then written without joining them into one string.
+class _SelectConnection( TcpRequestHandler ):
+	def __init__( self, request, clientAddress, server ):
+		self.request = request
+		self.client_address = clientAddress
+		self.server = server
+		self.closed = False
+		self._reader = FrameReader( request )
+		self._streams = {}
+		self._compressor = server.compressor()
+		self._serving = {}
+		self._cancelled = set()
+		self._servingLock = threading.Lock()
+		self._outBuffer = deque()
+		self._outOffset = 0
+
+	def handle_read( self ):
+		try:
+			received = self._reader.fill()
+		except socket.error, e:
+			if e.args[ 0 ] in ( errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR ):
+				return
+			self.close()
+			return
+		if not received:
+			self.close()
+			return
+
+		while True:
+			frame = self._reader.frame()
+			if frame is None:
+				break
+			try:
+				self.server.process_string( self, frame )
+			except Exception:
+				self.server.handle_error( self.request, self.client_address )
+		if self._outBuffer:
+			self.handle_write()
+
+	def send_string( self, buffer ):
+		if self.server.metrics is not None:
+			self.server.metrics.written( len( buffer ) )
+		header = _header.pack( len( buffer ) )
+		if len( buffer ) <= _coalesceLimit:
+			self._outBuffer.append( header + buffer )
+		else:
+			self._outBuffer.append( header )
+			self._outBuffer.append( buffer )
+
+	def wants_write( self ):
+		return bool( self._outBuffer )
+
+	def handle_write( self ):
+		while self._outBuffer:
+			buffer = self._outBuffer[ 0 ]
+			try:
+				sent = self.request.send( memoryview( buffer )[ self._outOffset: ] )
+			except socket.error, e:
+				if e.args[ 0 ] in ( errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR ):
+					return
+				self.close()
+				return
+			self._outOffset += sent
+			if self._outOffset < len( buffer ):
+				return
+			self._outBuffer.popleft()
+			self._outOffset = 0
+
+	def close( self ):
+		self.closed = True
+
+# One direction of a SharedRings: frames are copied into a ring of capacity
+# bytes after a four byte length, wrapping around its end. The ring's first
+# eight bytes count how far its reader has got, so the writer knows how much
+# room there is; everything else is written by one side only.
+class _Ring( object ):
+	def __init__( self, mm, offset, capacity ):
+		self._mm = mm
+		self._offset = offset
+		self._data = offset + 8
+		self._capacity = capacity
+		self._head = 0
+		self._tail = 0
+
+	def _put( self, position, data ):
+		index = position % self._capacity
+		first = min( len( data ), self._capacity - index )
+		self._mm[ self._data + index:self._data + index + first ] = data[ :first ]
+		if first < len( data ):
+			self._mm[ self._data:self._data + len( data ) - first ] = data[ first: ]
+
+	def _get( self, position, size ):
+		index = position % self._capacity
+		first = min( size, self._capacity - index )
+		data = self._mm[ self._data + index:self._data + index + first ]
+		if first < size:
+			data += self._mm[ self._data:self._data + size - first ]
+		return data
+
+	# Returns False if there is no room for data.
+	def write( self, data ):
+		size = _header.size + len( data )
+		tail = struct.unpack_from( "Q", self._mm, self._offset )[ 0 ]
+		if self._head + size - tail > self._capacity:
+			return False
+		if isinstance( data, memoryview ):
+			data = data.tobytes()
+		elif not isinstance( data, str ):
+			data = str( data )
+		self._put( self._head, _header.pack( len( data ) ) )
+		self._put( self._head + _header.size, data )
+		self._head += size
+		return True
+
+	def read( self ):
+		size = _header.unpack( self._get( self._tail, _header.size ) )[ 0 ]
+		if _header.size + size > self._capacity:
+			raise RuntimeError( "corrupt shared memory ring" )
+		data = self._get( self._tail + _header.size, size )
+		self._tail += _header.size + size
+		struct.pack_into( "Q", self._mm, self._offset, self._tail )
+		return data
+
+# Where SharedRings files are made, and the only place the server maps them
+# from.
+def _shm_directory():
+	if os.path.isdir( "/dev/shm" ):
+		return "/dev/shm"
+	return tempfile.gettempdir()
+
+_shmPrefix = "protobufrpc-"
+_peerCred = struct.Struct( "3i" )
+
+# The uid of the process at the other end of a Unix domain socket.
+def peer_uid( sock ):
+	cred = sock.getsockopt( socket.SOL_SOCKET, getattr( socket, "SO_PEERCRED", 17 ), _peerCred.size )
+	return _peerCred.unpack( cred )[ 1 ]
+
+# A pair of rings in a file mapped by both ends of a ShmChannel connection.
+# Payloads go through the rings; the connection's Unix domain socket only
+# carries an empty frame per payload to wake the reader. Frames that do not
+# fit in the ring are sent on the socket after a one byte marker, so that
+# an empty frame is always a doorbell.
+class SharedRings( object ):
+	def __init__( self, fd, capacity, client ):
+		self._mm = mmap.mmap( fd, 2 * ( 8 + capacity ) )
+		rings = [ _Ring( self._mm, 0, capacity ), _Ring( self._mm, 8 + capacity, capacity ) ]
+		if not client:
+			rings.reverse()
+		self._out, self._in = rings
+
+	# Creates the shared file, in /dev/shm where there is one. The caller
+	# removes it once the other end has mapped it.
+	@classmethod
+	def create( cls, capacity ):
+		fd, path = tempfile.mkstemp( prefix=_shmPrefix, dir=_shm_directory() )
+		try:
+			os.ftruncate( fd, 2 * ( 8 + capacity ) )
+			return cls( fd, capacity, True ), path
+		finally:
+			os.close( fd )
+
+	# Maps the file a client made with create(), at path as the client sent
+	# it. Only a regular file of the right size made by create(), and owned
+	# by uid, the client's user, is accepted; anything else raises
+	# ValueError, so a client cannot have the server write to other files.
+	@classmethod
+	def open( cls, path, uid ):
+		directory = _shm_directory()
+		name = os.path.basename( path )
+		if path != os.path.join( directory, name ) or not name.startswith( _shmPrefix ):
+			raise ValueError( "not a shared memory ring: %r" % path )
+		fd = os.open( path, os.O_RDWR | os.O_NOFOLLOW | getattr( os, "O_NONBLOCK", 0 ) )
+		try:
+			info = os.fstat( fd )
+			capacity = info.st_size // 2 - 8
+			if not stat.S_ISREG( info.st_mode ) or info.st_uid != uid or capacity <= _header.size or \
+					info.st_size != 2 * ( 8 + capacity ):
+				raise ValueError( "not a shared memory ring: %r" % path )
+			return cls( fd, capacity, False )
+		finally:
+			os.close( fd )
+
+	def send_frame( self, sock, buffer ):
+		if self._out.write( buffer ):
+			send_frame( sock, "" )
+		else:
+			if isinstance( buffer, memoryview ):
+				buffer = buffer.tobytes()
+			send_frame( sock, _inlineFrame + str( buffer ) )
+
+	def reader( self, frames ):
+		return _RingReader( frames, self._in )
+
+	def close( self ):
+		self._mm.close()
+
+_inlineFrame = "\x01"
+
+# Reads frames as a FrameReader does, taking the payload of each empty frame
+# from the ring and dropping the marker of the others.
+class _RingReader( object ):
+	def __init__( self, frames, ring ):
+		self._frames = frames
+		self._ring = ring
+
+	def has_frame( self ):
+		return self._frames.has_frame()
+
+	def fill( self ):
+		return self._frames.fill()
+
+	def _payload( self, frame ):
+		if frame is None:
+			return None
+		if not len( frame ):
+			return self._ring.read()
+		return frame[ 1: ]
+
+	def frame( self ):
+		return self._payload( self._frames.frame() )
+
+	def read_frame( self ):
+		return self._payload( self._frames.read_frame() )
+
+# A TcpChannel to a ShmServer on the same host, at the path of its Unix
+# domain socket. Requests and responses are passed through rings of
+# ring_size bytes each way in shared memory rather than through the kernel.
+class ShmChannel( TcpChannel ):
+	def __init__( self, path, ring_size=1 << 22, **kwargs ):
+		self._ringSize = ring_size
+		self._rings = None
+		TcpChannel.__init__( self, path, **kwargs )
+
+	def connect( self, path ):
+		TcpChannel.connect( self, path )
+		rings, ringPath = SharedRings.create( self._ringSize )
+		try:
+			send_frame( self._tcpSocket, ringPath )
+			if self._reader.read_frame() is None:
+				raise RuntimeError( "socket connection broken" )
+		finally:
+			os.unlink( ringPath )
+		self._rings = rings
+		self._reader = rings.reader( self._reader )
+		self._sendFrame = rings.send_frame
+
+	def close( self ):
+		TcpChannel.close( self )
+		self._rings.close()
+
+class _ShmRequestHandler( TcpRequestHandler ):
+	def setup( self ):
+		TcpRequestHandler.setup( self )
+		self._rings = None
+		path = self._reader.read_frame()
+		if path is None:
+			return
+		try:
+			self._rings = SharedRings.open( path.tobytes(), peer_uid( self.request ) )
+		except ( ValueError, OSError, socket.error ):
+			# handle() finds the connection closed.
+			self.request.shutdown( socket.SHUT_RDWR )
+			self._reader = FrameReader( self.request )
+			return
+		send_frame( self.request, "" )
+		self._reader = self._rings.reader( self._reader )
+		self._sendFrame = self._rings.send_frame
+
+	def finish( self ):
+		TcpRequestHandler.finish( self )
+		if self._rings is not None:
+			self._rings.close()
+
+# A ThreadPoolTcpServer for ShmChannels, listening on the Unix domain socket
+# at path.
+class ShmServer( ThreadPoolTcpServer ):
+	def __init__( self, path, *services, **kwargs ):
+		ThreadPoolTcpServer.__init__( self, path, *services, **kwargs )
+		self.RequestHandlerClass = _ShmRequestHandler
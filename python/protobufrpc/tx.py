@@ -21,44 +21,161 @@
 # THE SOFTWARE.
 
 import twisted.internet.protocol
-from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, DeferredList
 from twisted.protocols.basic import Int32StringReceiver
-from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.protocol import DatagramProtocol, ReconnectingClientFactory
+from twisted.internet.threads import blockingCallFromThread
+from twisted.internet.task import LoopingCall
+from twisted.python.threadpool import ThreadPool
+from collections import deque, OrderedDict
+import multiprocessing
+import time
 import google.protobuf.service
-from protobufrpc_pb2 import Rpc, Request, Response, Error
-from common import Controller
+from protobufrpc_pb2 import Rpc, Request, Response, Error, Fragment
+from common import Controller, RpcErrors, RpcError, DispatchTable, PendingCalls, EndpointHealth, balancers, transport_failed
+from common import Compressor
+from common import method_name, method_number, timed_call, decoder, request_timeout
+from common import Compression, encode_request, response_entry, quick_responses
 
-__all__ = [ "TcpChannel", "UdpChannel", "Proxy", "Factory" ]
+__all__ = [ "TcpChannel", "UdpChannel", "PooledChannel", "Stream", "Proxy", "Factory" ]
+
+# The reactor is imported when it is first used rather than with this module,
+# so that a supervisor can import this module and build its services before
+# forking tx workers, which each install a reactor of their own; see
+# supervisor.tx_worker. The first use binds the real reactor in its place.
+class _Reactor( object ):
+    def __getattr__( self, name ):
+        global reactor
+        from twisted.internet import reactor
+        return getattr( reactor, name )
+
+reactor = _Reactor()
+
+# Fails a call with RpcErrors code. done gets an empty response once the
+# controller is marked failed, or None for a call made without a controller.
+def _fail_call( rpcController, responseClass, done, code ):
+    if rpcController is None:
+        done( None )
+        return
+    rpcController.SetFailed( RpcErrors.msgs[ code ] )
+    done( responseClass() )
 
 class BaseChannel( google.protobuf.service.RpcChannel ):
     id = 0
-    def __init__( self ):
+    def __init__( self, batch=False, batch_window=0, batch_bytes=65536, compact_methods=False,
+            timeout=None, max_pending=None, block=True, max_waiting=1024, compression=None,
+            compression_threshold=1024, metrics=None, cache=None, single_flight=None, decoding=None ):
         google.protobuf.service.RpcChannel.__init__( self )
-        self._pending = {}
-        self._services = {}
+        # Instrumentation hooks; see protobufrpc.metrics.
+        self._metrics = metrics
+        # Serialized responses of idempotent methods, for the calls this
+        # channel makes and the requests it serves; see ResponseCache.
+        self._cache = cache
+        # Collapses identical calls and requests in flight; see SingleFlight.
+        self._singleFlight = single_flight
+        # Calls are dropped from self._pending when their response arrives or
+        # when they time out. Once max_pending calls are outstanding, further
+        # calls either wait in self._waiting for a free slot or, if block is
+        # false, fail straight away with RpcErrors.TOO_MANY_PENDING. Waiting
+        # calls keep the deadline armed when they were made, and beyond
+        # max_waiting of them calls fail with RpcErrors.TOO_MANY_PENDING too.
+        self._pending = PendingCalls( timeout, max_pending )
+        self._block = block
+        self._maxWaiting = max_waiting
+        self._waiting = deque()
+        self._expireCall = None
+        # How the responses to calls and the requests served are decoded;
+        # see common.decoder.
+        self._decoding = decoding
+        self._dispatch = DispatchTable( decoding=decoding )
+        # Methods run anywhere but inline, by method name; see Factory.
+        self._executors = {}
+        self._compactMethods = compact_methods
+        # Outgoing requests are gathered into self._batch when batching is
+        # enabled (flushed after batch_window seconds, 0 being the current
+        # reactor tick) or while a batch is explicitly held open.
+        self._batching = batch
+        # Calls sent on their own skip the Rpc message and are encoded
+        # straight into a frame; see common.encode_request.
+        self._encodeCalls = True
+        self._batchWindow = batch_window
+        self._batchBytes = batch_bytes
+        self._batch = None
+        self._batchSize = 0
+        self._held = 0
+        self._flushCall = None
+        # Responses are coalesced per destination address and written once
+        # the current incoming Rpc has been dispatched, or at the end of the
+        # reactor tick for handlers that finish later.
+        self._responses = {}
+        self._dispatching = False
+        self._flushResponsesCall = None
+        # Client-streamed calls being received, by ( addr, id ).
+        self._streams = {}
+        # The controllers and method names of requests being served, by
+        # ( addr, id ), so that the client can cancel them, and the last few
+        # cancelled requests that had not arrived yet.
+        self._serving = {}
+        self._cancelled = set()
+        # Payload compression is negotiated per peer address; see Compressor.
+        self._compression = compression
+        self._compressionThreshold = compression_threshold
+        self._compressors = {}
     
     def add_service(self, service):
-        self._services[ service.GetDescriptor().name ] = service
+        self._dispatch.add_service( service )
+
+    def outstanding( self ):
+        return len( self._pending ) + len( self._waiting )
 
+    def compressor( self, addr=None ):
+        compressor = self._compressors.get( addr )
+        if compressor is None:
+            # A UDP server hears from any number of addresses; forgotten
+            # peers go on uncompressed.
+            if len( self._compressors ) >= 1024:
+                self._compressors.clear()
+            compressor = Compressor( self._compression, self._compressionThreshold )
+            self._compressors[ addr ] = compressor
+        return compressor
+
+    # A failed call made without a controller gets None.
     def unserialize_response( self, serializedResponse, responseClass, rpcController ):
         response = responseClass()
-        if serializedResponse.error:
-            rpcController.setFailed(serializedResponse.error.text)
+        if serializedResponse.HasField( 'error' ):
+            if rpcController is None:
+                return None
+            rpcController.SetFailed( serializedResponse.error.text )
         else:
             response.ParseFromString( serializedResponse.serialized_response )
 
-        return response, rpcController
+        return response
     
-    def serialize_response( self, response, serializedRequest, controller ):
+    # Returns None, and skips serializing the response, for calls that the
+    # client has cancelled or stopped waiting for.
+    def serialize_response( self, response, serializedRequest, controller, name=None ):
+        if controller.IsCancelled():
+            return None
+        if response is not None and not controller.Failed():
+            if self._metrics is not None:
+                started = time.time()
+                response = response.SerializeToString()
+                self._metrics.serialized( name, len( response ), time.time() - started )
+            else:
+                response = response.SerializeToString()
+        return self.wrap_response( response, serializedRequest, controller )
+
+    def wrap_response( self, data, serializedRequest, controller ):
+        if controller.IsCancelled():
+            return None
         serializedResponse = Response()
         serializedResponse.id = serializedRequest.id
 
         if controller.Failed():
             serializedResponse.error.code = 1
             serializedResponse.error.text = controller.ErrorText()
-        else:
-            serializedResponse.serialized_response = response.SerializeToString()
+        elif data is not None:
+            serializedResponse.serialized_response = data
 
         return serializedResponse
     
@@ -72,119 +189,875 @@ class BaseChannel( google.protobuf.service.RpcChannel ):
             rpcResponse.error.text = serializedResponse.error.text
         return rpc
     
-    def _call_method( self, methodDescriptor, rpcController, request, responseClass, done ):
+    def _call_method( self, methodDescriptor, rpcController, request, responseClass, done, deadline=None ):
+        deadline = self._start_call( rpcController, responseClass, done, deadline )
+        if self._batch is not None:
+            rpc = self._batch
+        else:
+            rpc = Rpc()
+        self._add_request( rpc, methodDescriptor, request, self.id, deadline )
+        return rpc
+
+    # Takes the next id for a call and waits for its response, until
+    # deadline if the call already has one. Returns the call's deadline.
+    def _start_call( self, rpcController, responseClass, done, deadline=None ):
         self.id += 1
         d = Deferred()
         d.addCallback( self.unserialize_response, responseClass, rpcController)
         d.addCallback( done )
-        self._pending[ self.id ] = d
-        rpc = Rpc()
+        return self._add_pending( self.id, d, rpcController, deadline )
+
+    def _add_pending( self, id, call, rpcController, deadline=None ):
+        deadline = self._pending.add( id, call, reactor.seconds(), getattr( rpcController, "timeout", None ),
+            deadline )
+        if deadline is not None:
+            self._schedule_expiry( deadline )
+        if isinstance( rpcController, Controller ):
+            rpcController.canceller = lambda: self.cancel_call( id )
+        return deadline
+
+    # Fails call id with RpcErrors.CANCELLED and tells the server to stop
+    # working on it.
+    def cancel_call( self, id ):
+        call = self._pending.pop( id )
+        if call is None:
+            return
+        self.send_cancels( [ id ] )
+        call.callback( self.error_response( id, RpcErrors.CANCELLED ) )
+        self._release_waiting()
+
+    def send_cancels( self, ids ):
+        self.send_frame( b"".join( [ encode_request( id, cancel=True ) for id in ids ] ) )
+
+    def _add_request( self, rpc, methodDescriptor, request, id, deadline=None ):
         rpcRequest = rpc.request.add()
-        rpcRequest.method = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
-        rpcRequest.serialized_request = request.SerializeToString()
-        rpcRequest.id = self.id
-        return rpc
-    
+        if methodDescriptor is not None:
+            if self._compactMethods:
+                rpcRequest.method_id = method_number( method_name( methodDescriptor ) )
+            else:
+                rpcRequest.method = method_name( methodDescriptor )
+        if request is not None:
+            self.compressor().encode( rpcRequest, 'serialized_request', request.SerializeToString() )
+        rpcRequest.id = id
+        if deadline is not None:
+            rpcRequest.timeout = request_timeout( deadline, reactor.seconds() )
+        return rpcRequest
+
+    # The same request as _add_request adds, as an Rpc of its own.
+    def _encode_request( self, methodDescriptor, request, id, deadline=None ):
+        method = None
+        if methodDescriptor is not None:
+            method = method_name( methodDescriptor )
+            if self._compactMethods:
+                method = method_number( method )
+        data = None
+        codec = Compression.NONE
+        codecs = None
+        if request is not None:
+            data, codec, codecs = self.compressor().pack( request.SerializeToString() )
+        timeout = None
+        if deadline is not None:
+            timeout = request_timeout( deadline, reactor.seconds() )
+        return encode_request( id, method, data, timeout, codec=codec, codecs=codecs )
+
     def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done ):
+        if self._decoding is not None:
+            responseClass = decoder( responseClass, self._decoding, method_name( methodDescriptor ) )
+        if self._metrics is not None:
+            done = timed_call( self._metrics, method_name( methodDescriptor ), rpcController, done )
+        if self._cache is not None:
+            response, done = self._cache.call( methodDescriptor, rpcController, request, responseClass, done )
+            if response is not None:
+                done( response )
+                return
+        if self._singleFlight is not None:
+            done = self._singleFlight.join( methodDescriptor, rpcController, request, responseClass, done )
+            if done is None:
+                return
+        self._submit( methodDescriptor, rpcController, request, responseClass, done )
+
+    def _submit( self, methodDescriptor, rpcController, request, responseClass, done, deadline=None ):
+        if self._pending.full():
+            if self._block and ( self._maxWaiting is None or len( self._waiting ) < self._maxWaiting ):
+                deadline = self._pending.deadline( reactor.seconds(), getattr( rpcController, "timeout", None ) )
+                self._waiting.append( ( methodDescriptor, rpcController, request, responseClass, done, deadline ) )
+                if deadline is not None:
+                    self._schedule_expiry( deadline )
+            else:
+                _fail_call( rpcController, responseClass, done, RpcErrors.TOO_MANY_PENDING )
+            return
+
+        if self._batch is None and not self._batching:
+            if self._encodeCalls:
+                deadline = self._start_call( rpcController, responseClass, done, deadline )
+                self.send_frame( self._encode_request( methodDescriptor, request, self.id, deadline ) )
+            else:
+                self.send_rpc( self._call_method( methodDescriptor, rpcController, request, responseClass, done,
+                    deadline ) )
+            return
+
+        if self._batch is None:
+            self._batch = Rpc()
+            self._batchSize = 0
+        if not self._held and self._flushCall is None:
+            self._flushCall = reactor.callLater( self._batchWindow, self.flush )
+        rpc = self._call_method( methodDescriptor, rpcController, request, responseClass, done, deadline )
+        self._batchSize += rpc.request[ -1 ].ByteSize()
+        if self._batchSize >= self._batchBytes:
+            self.flush()
+
+    def open_stream( self, methodDescriptor, responseClass, rpcController=None ):
+        if self._decoding is not None:
+            responseClass = decoder( responseClass, self._decoding, method_name( methodDescriptor ) )
+        self.id += 1
+        stream = Stream( self, self.id, methodDescriptor, responseClass, rpcController )
+        self._add_pending( self.id, stream, rpcController )
+        return stream
+
+    def call_stream( self, methodDescriptor, request, responseClass, rpcController=None ):
+        stream = self.open_stream( methodDescriptor, responseClass, rpcController )
+        stream.close( request )
+        return stream
+
+    def send_stream_request( self, stream, request, more ):
+        if self._batch is not None:
+            rpc = self._batch
+        else:
+            rpc = Rpc()
+        # Only the first request of a stream names the method.
+        rpcRequest = self._add_request( rpc, stream.method, request, stream.id )
+        stream.method = None
+        if more:
+            rpcRequest.more = True
+        if rpc is not self._batch:
+            self.send_rpc( rpc )
+
+    def start_batch( self ):
+        self._held += 1
+        if self._batch is None:
+            self._batch = Rpc()
+            self._batchSize = 0
+
+    def end_batch( self ):
+        self._held -= 1
+        if not self._held:
+            self.flush()
+
+    def flush( self ):
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        rpc = self._batch
+        if self._held:
+            self._batch = Rpc()
+        else:
+            self._batch = None
+        self._batchSize = 0
+        if rpc is not None and len( rpc.request ):
+            self.send_rpc( rpc )
+
+    def _schedule_expiry( self, deadline ):
+        if self._expireCall is not None:
+            if self._expireCall.getTime() <= deadline:
+                return
+            self._expireCall.cancel()
+        self._expireCall = reactor.callLater( max( deadline - reactor.seconds(), 0 ), self.expire_calls )
+
+    def expire_calls( self ):
+        if self._expireCall is not None:
+            if self._expireCall.active():
+                self._expireCall.cancel()
+            self._expireCall = None
+        now = reactor.seconds()
+        expired = self._pending.expire( now )
+        for id, d in expired:
+            d.callback( self.error_response( id, RpcErrors.TIMEOUT ) )
+        if expired:
+            self.send_cancels( [ id for id, d in expired ] )
+        # Waiting calls have no id yet, so there is nothing to cancel.
+        waiting, late = deque(), []
+        for call in self._waiting:
+            if call[ 5 ] is not None and call[ 5 ] <= now:
+                late.append( call )
+            else:
+                waiting.append( call )
+        self._waiting = waiting
+        deadlines = [ call[ 5 ] for call in waiting if call[ 5 ] is not None ]
+        deadline = self._pending.next_deadline()
+        if deadline is not None:
+            deadlines.append( deadline )
+        if deadlines:
+            self._schedule_expiry( min( deadlines ) )
+        for methodDescriptor, rpcController, request, responseClass, done, deadline in late:
+            _fail_call( rpcController, responseClass, done, RpcErrors.TIMEOUT )
+        self._release_waiting()
+
+    def _release_waiting( self ):
+        while self._waiting and not self._pending.full():
+            call = self._waiting.popleft()
+            if call[ 5 ] is not None and call[ 5 ] <= reactor.seconds():
+                _fail_call( call[ 1 ], call[ 3 ], call[ 4 ], RpcErrors.TIMEOUT )
+            else:
+                self._submit( *call )
+
+    def fail_pending( self, code ):
+        if self._expireCall is not None:
+            if self._expireCall.active():
+                self._expireCall.cancel()
+            self._expireCall = None
+        for id, d in self._pending.clear():
+            d.callback( self.error_response( id, code ) )
+        waiting, self._waiting = self._waiting, deque()
+        for methodDescriptor, rpcController, request, responseClass, done, deadline in waiting:
+            _fail_call( rpcController, responseClass, done, code )
+
+    def queue_response( self, serializedResponse, addr=None ):
+        if serializedResponse is None:
+            return
+        entries = self._responses.get( addr )
+        if entries is None:
+            entries = self._responses[ addr ] = []
+        if self._metrics is not None and serializedResponse.HasField( 'error' ):
+            self._metrics.error( serializedResponse.error.code )
+        entries.append( response_entry( serializedResponse, self.compressor( addr ) ) )
+        if not self._dispatching and self._flushResponsesCall is None:
+            self._flushResponsesCall = reactor.callLater( 0, self.flush_responses )
+
+    def flush_responses( self ):
+        if self._flushResponsesCall is not None:
+            if self._flushResponsesCall.active():
+                self._flushResponsesCall.cancel()
+            self._flushResponsesCall = None
+        responses, self._responses = self._responses, {}
+        for addr, entries in responses.items():
+            self.send_frame( b"".join( entries ), addr )
+
+    # Frames of responses alone may be read without building an Rpc; see
+    # common.quick_responses.
+    def rpc_received( self, data, addr=None ):
+        if self._metrics is not None:
+            started = time.time()
+        rpc = None
+        responses = quick_responses( data )
+        if responses is None:
+            rpc = Rpc()
+            rpc.ParseFromString( data )
+            responses = rpc.response
+        if self._metrics is not None:
+            requests = len( rpc.request ) if rpc is not None else 0
+            self._metrics.parsed( len( data ), time.time() - started, requests + len( responses ) )
+
+        if rpc is not None:
+            self._dispatching = True
+            try:
+                self.dispatch_requests( rpc, addr )
+            finally:
+                self._dispatching = False
+            if self._responses:
+                self.flush_responses()
+
+        for serializedResponse in responses:
+            id = serializedResponse.id
+            self.response_received( serializedResponse, addr )
+            call = self._pending.get( id )
+            if call is None:
+                continue
+            if not ( serializedResponse.more and isinstance( call, Stream ) ):
+                self._pending.pop( id )
+            # Responses answer our own requests, which are packed with the
+            # compressor of the peer we call, kept under None; a UDP reply
+            # comes from an address that may not even be spelled as ours.
+            try:
+                self.compressor().decode( serializedResponse, 'serialized_response' )
+            except ValueError:
+                self._pending.pop( id, None )
+                serializedResponse = self.error_response( id, RpcErrors.CANNOT_DECOMPRESS )
+            call.callback( serializedResponse )
+        if self._waiting:
+            self._release_waiting()
+
+    def dispatch_requests( self, rpc, addr=None ):
+        compressor = self.compressor( addr )
+        for serializedRequest in rpc.request:
+            key = ( addr, serializedRequest.id )
+            if serializedRequest.cancel:
+                self._cancel_request( key )
+                continue
+            if key in self._cancelled:
+                self._cancelled.discard( key )
+                self._streams.pop( key, None )
+                continue
+            stream = self._streams.get( key )
+            if stream is not None:
+                entry, controller = stream
+                if not serializedRequest.more:
+                    del self._streams[ key ]
+            else:
+                entry = self._dispatch.lookup( serializedRequest )
+                if entry is None:
+                    code = self._dispatch.error_code( serializedRequest )
+                    self.queue_response( self.error_response( serializedRequest.id, code ), addr )
+                    continue
+                controller = Controller()
+                controller.writer = self._stream_writer( serializedRequest.id, addr )
+                if serializedRequest.more:
+                    self._streams[ key ] = ( entry, controller )
+            controller.more = serializedRequest.more
+            if serializedRequest.HasField( 'timeout' ):
+                controller.deadline = time.time() + serializedRequest.timeout / 1000.0
+
+            try:
+                compressor.decode( serializedRequest, 'serialized_request' )
+            except ValueError:
+                self._streams.pop( key, None )
+                self.queue_response( self.error_response( serializedRequest.id, RpcErrors.CANNOT_DECOMPRESS ), addr )
+                continue
+
+            cached = self._cache is not None and stream is None and not serializedRequest.more and \
+                self._cache.enabled( entry.name )
+            if cached:
+                response = self._cache.get( entry.name, serializedRequest.serialized_request )
+                if response is not None:
+                    self.queue_response( self.wrap_response( response, serializedRequest, controller ), addr )
+                    continue
+            shared = self._singleFlight is not None and stream is None and not serializedRequest.more and \
+                self._singleFlight.enabled( entry.name )
+            if shared:
+                if not self._singleFlight.start( entry.name, serializedRequest.serialized_request,
+                        self._shared_response( serializedRequest.id, addr ) ):
+                    continue
+                # The leader's response is built even past its own deadline,
+                # for the identical requests it answers; only its own reply
+                # is dropped then.
+                deadline, controller.deadline = controller.deadline, None
+
+            # Client-streamed calls always run inline, so that their parts
+            # reach the method in order.
+            executor = self._executors.get( entry.name )
+            if stream is not None or serializedRequest.more:
+                executor = None
+            d = Deferred()
+            if executor is None:
+                if stream is not None and not serializedRequest.HasField( 'serialized_request' ):
+                    request = None
+                else:
+                    request = entry.requestClass()
+                    request.ParseFromString( serializedRequest.serialized_request )
+                if self._metrics is not None and not serializedRequest.more:
+                    d.addCallback( self._handled, entry.name, time.time() )
+                d.addCallback( self.serialize_response, serializedRequest, controller, entry.name )
+            else:
+                d.addCallback( self.wrap_response, serializedRequest, controller )
+            if cached:
+                d.addCallback( self._cache_response, entry.name, serializedRequest.serialized_request )
+            if shared:
+                d.addCallback( self._share_response, entry.name, serializedRequest.serialized_request, deadline )
+            d.addCallback( self.queue_response, addr )
+            # Only the last call of a client-streamed request is expected to
+            # call done, so only that one counts as in flight.
+            if not serializedRequest.more:
+                self.request_started()
+                # The leader of a single flight answers the other requests
+                # too, so it runs to the end even if its own client gives up.
+                self._serving[ key ] = ( None if shared else controller, entry.name )
+                d.addBoth( self._request_done, key )
+                if self._metrics is not None:
+                    self._metrics.dispatched( entry.name, len( serializedRequest.serialized_request ) )
+            if executor is None:
+                entry.service.CallMethod( entry.method, controller, request, d.callback )
+            else:
+                executor.call( entry, controller, serializedRequest.serialized_request, d )
+
+    def _request_done( self, result, key ):
+        if key in self._serving:
+            self._finish_request( key )
+        return result
+
+    # Every request being served ends here once, answered or not.
+    def _finish_request( self, key ):
+        controller, name = self._serving.pop( key )
+        if self._metrics is not None:
+            self._metrics.finished( name )
+        self.request_finished()
+        return controller
+
+    # The requests of a connection that has gone are finished with, whether
+    # or not their methods go on to call done.
+    def abandon_requests( self ):
+        for key in list( self._serving ):
+            self._finish_request( key )
+
+    # A cancelled request is finished with straight away, whether or not its
+    # method goes on to call done.
+    def _cancel_request( self, key ):
+        if key not in self._serving:
+            if len( self._cancelled ) >= 1024:
+                self._cancelled.clear()
+            self._cancelled.add( key )
+            return
+        if self._serving[ key ][ 0 ] is None:
+            return
+        self._finish_request( key ).StartCancel()
+
+    def _cache_response( self, serializedResponse, name, data ):
+        if serializedResponse is None:
+            return None
+        if serializedResponse.HasField( 'serialized_response' ) and not serializedResponse.HasField( 'error' ):
+            self._cache.put( name, data, serializedResponse.serialized_response )
+        return serializedResponse
+
+    def _share_response( self, serializedResponse, name, data, deadline ):
+        self._singleFlight.finish( name, data, serializedResponse )
+        if deadline is not None and time.time() >= deadline:
+            return None
+        return serializedResponse
+
+    # Answers request id with the response to an identical request.
+    def _shared_response( self, id, addr ):
+        def deliver( serializedResponse ):
+            if serializedResponse is None:
+                return
+            response = Response()
+            response.CopyFrom( serializedResponse )
+            response.id = id
+            self.queue_response( response, addr )
+        return deliver
+
+    def _handled( self, response, name, started ):
+        self._metrics.handled( name, time.time() - started, 0 )
+        return response
+
+    # Flow control hooks, called as requests are handed to a service and as
+    # their responses are queued.
+    def request_started( self ):
+        pass
+
+    def request_finished( self, result=None ):
+        return result
+
+    # Called for each response that arrives, before it is matched to a call.
+    def response_received( self, serializedResponse, addr ):
+        pass
+
+    # Each streamed response is written as a frame of its own, after any
+    # responses already queued, so a long stream is never held in memory.
+    def _stream_writer( self, id, addr ):
+        def write( message ):
+            serializedResponse = Response()
+            serializedResponse.id = id
+            serializedResponse.more = True
+            serializedResponse.serialized_response = message.SerializeToString()
+            self.queue_response( serializedResponse, addr )
+            self.flush_responses()
+        return write
+
+    def error_response( self, id, code ):
+        serializedResponse = Response()
+        serializedResponse.id = id
+        serializedResponse.error.code = code
+        serializedResponse.error.text = RpcErrors.msgs[ code ]
+        return serializedResponse
+
+    def send_rpc( self, rpc, addr=None ):
+        self.send_frame( rpc.SerializeToString(), addr )
+
+    # Sends data, a serialized Rpc.
+    def send_frame( self, data, addr=None ):
         # This method must be overridden.
         pass
 
-class RpcErrors:
-    SUCCESS = 0
-    UNSERIALIZE_RPC = 1
-    SERVICE_NOT_FOUND = 2
-    METHOD_NOT_FOUND = 3
-    CANNOT_DESERIALIZE_REQUEST = 4
+# The client end of a streamed call, from BaseChannel.open_stream or
+# call_stream. next() returns a Deferred for each response in turn, which
+# fires with None once the stream has ended and fails with RpcError if the
+# call did. Methods that take a stream of requests are fed with write(),
+# and close() ends the stream, optionally with one last request.
+class Stream( object ):
+    def __init__( self, channel, id, methodDescriptor, responseClass, rpcController ):
+        self.id = id
+        self.method = methodDescriptor
+        self._channel = channel
+        self._responseClass = responseClass
+        self._controller = rpcController
+        self._responses = deque()
+        self._waiters = deque()
+        self._finished = False
+        self._error = None
+
+    def write( self, request ):
+        self._channel.send_stream_request( self, request, True )
+
+    def close( self, request=None ):
+        self._channel.send_stream_request( self, request, False )
 
-    msgs = ['Success',
-            'Error when unserializing Rpc message',
-            'Service not found',
-            'Method not found',
-            'Cannot deserialized request']
+    def next( self ):
+        d = Deferred()
+        if self._responses:
+            d.callback( self._responses.popleft() )
+        elif self._error is not None:
+            d.errback( self._error )
+        elif self._finished:
+            d.callback( None )
+        else:
+            self._waiters.append( d )
+        return d
+
+    def callback( self, serializedResponse ):
+        if serializedResponse.HasField( 'error' ):
+            if self._controller is not None:
+                self._controller.SetFailed( serializedResponse.error.text )
+            self._error = RpcError( serializedResponse.error.code, serializedResponse.error.text )
+        elif serializedResponse.HasField( 'serialized_response' ):
+            response = self._responseClass()
+            response.ParseFromString( serializedResponse.serialized_response )
+            if self._waiters:
+                self._waiters.popleft().callback( response )
+            else:
+                self._responses.append( response )
+        if not serializedResponse.more:
+            self._finished = True
+            waiters, self._waiters = self._waiters, deque()
+            for d in waiters:
+                if self._error is not None:
+                    d.errback( self._error )
+                else:
+                    d.callback( None )
 
+# On the server side (built by a Factory) the channel stops reading from its
+# socket while max_in_flight requests are being handled, while its Factory
+# is over max_total_in_flight, or while the transport's write buffer is
+# full: the channel is registered as the transport's producer, so the
+# pauseProducing and resumeProducing calls it gets are about the buffer.
+# Reading resumes once the requests in flight are down to half the limit
+# and the buffer has drained. Frames already received wait unparsed. While
+# the Factory drains, the channel stops reading and closes once it has no
+# requests left to answer.
 class TcpChannel( BaseChannel, Int32StringReceiver ):
-    def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done ):
-        rpc = self._call_method( methodDescriptor, rpcController, request, responseClass, done )
-        self.sendString( rpc.SerializeToString() )
-    
+    _server = None
+
+    def __init__( self, max_in_flight=None, **kwargs ):
+        BaseChannel.__init__( self, **kwargs )
+        self._maxInFlight = max_in_flight
+        self._inFlight = 0
+        self._readingPaused = False
+        self._writingPaused = False
+        self.lastReceived = None
+
+    def connectionMade( self ):
+        Int32StringReceiver.connectionMade( self )
+        self.lastReceived = reactor.seconds()
+        if self._server is not None:
+            self.transport.registerProducer( self, True )
+
+    def send_frame( self, data, addr=None ):
+        if self._metrics is not None:
+            self._metrics.written( len( data ) )
+        self.sendString( data )
+
     def stringReceived( self, data ):
-        rpc = Rpc()
-        rpc.ParseFromString( data )
+        self.lastReceived = reactor.seconds()
+        self.rpc_received( data )
 
-        for serializedRequest in rpc.request:
-            service = self._services[ serializedRequest.method.split( '.' )[ 0 ] ]
-            if not service:
-                self.sendError( serializedRequest.id, RpcErrors.SERVICE_NOT_FOUND )
-                return
+    def connectionLost( self, reason ):
+        self.fail_pending( RpcErrors.CONNECTION_LOST )
+        self.abandon_requests()
+        Int32StringReceiver.connectionLost( self, reason )
+        if self._server is not None:
+            self._server.connection_lost( self )
 
-            method = service.GetDescriptor().FindMethodByName( serializedRequest.method.split( '.' )[ 1 ] )
-            if not method:
-                self.sendError( serializedRequest.id, RpcErrors.METHOD_NOT_FOUND )
-                return
+    # Whether the channel has nothing to answer and nothing to wait for.
+    def idle( self ):
+        return not self._inFlight and not len( self._pending ) and not self._streams
 
-            request = service.GetRequestClass( method )()
-            request.ParseFromString( serializedRequest.serialized_request )
-            controller = Controller()
-            d = Deferred()
-            d.addCallback( self.serialize_response, serializedRequest, controller )
-            d.addCallback( self.serialize_rpc )
-            d.addCallback( lambda rpc: self.sendString( rpc.SerializeToString() ) )
-            service.CallMethod( method, controller, request, d.callback )
+    def close_if_drained( self ):
+        if self._server is not None and self._server.draining and self.idle() and self.transport is not None:
+            self.flush_responses()
+            self.transport.loseConnection()
 
-        for serializedResponse in rpc.response:
-            id = serializedResponse.id
-            if self._pending.has_key( id ):
-                self._pending[ id ].callback( serializedResponse )
+    def request_started( self ):
+        self._inFlight += 1
+        if self._server is not None:
+            self._server.request_started()
+        self.update_reading()
+
+    def request_finished( self, result=None ):
+        self._inFlight -= 1
+        if self._server is not None:
+            self._server.request_finished()
+        self.update_reading()
+        self.close_if_drained()
+        return result
+
+    def pauseProducing( self ):
+        self._writingPaused = True
+        self.update_reading()
+
+    def resumeProducing( self ):
+        self._writingPaused = False
+        self.update_reading()
+
+    def stopProducing( self ):
+        pass
+
+    def update_reading( self ):
+        if self.transport is None:
+            return
+        limit = self._maxInFlight
+        if limit is not None and self._readingPaused:
+            limit = limit // 2 + 1
+        overloaded = ( self._writingPaused or ( limit is not None and self._inFlight >= limit )
+            or ( self._server is not None and ( self._server.overloaded or self._server.draining ) ) )
+        if overloaded and not self._readingPaused:
+            self._readingPaused = True
+            Int32StringReceiver.pauseProducing( self )
+        elif not overloaded and self._readingPaused:
+            self._readingPaused = False
+            Int32StringReceiver.resumeProducing( self )
 
     def sendError( self, id, code ):
-        rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.id = id
-        rpcResponse.error.code = code 
-        rpcResponse.error.text = RpcErrors.msgs[code]
-        self.sendString( rpc.SerializeToString() )
+        self.queue_response( self.error_response( id, code ) )
 
     
+# Retransmission timeout for one peer, from smoothed round trip times as in
+# RFC 6298.
+class RetransmitTimeout( object ):
+    def __init__( self, initial=0.2, minimum=0.005, maximum=2.0 ):
+        self.rto = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    def sample( self, rtt ):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs( self.srtt - rtt )
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min( max( self.srtt + 4 * self.rttvar, self.minimum ), self.maximum )
+
+    # The timeout for the given retransmission of a request.
+    def timeout( self, attempts ):
+        return min( self.rto * ( 1 << attempts ), self.maximum )
+
+# A request sent by a reliable UdpChannel and not answered yet.
+class _Unanswered( object ):
+    def __init__( self, addr, request, sent ):
+        self.addr = addr
+        self.request = request
+        self.sent = sent
+        self.attempts = 0
+        self.timer = None
+
+# With reliable set, every datagram is a Fragment and both ends must be
+# reliable. Requests are sent again, after a timeout that adapts to the
+# measured round trip time and doubles with each retry, until their response
+# arrives or max_retries retries have gone unanswered, when the call fails
+# with RpcErrors.TIMEOUT. The server answers a request it has already
+# answered with the same response, remembering the last dedup_entries of
+# them for up to dedup_time seconds, and ignores requests it is still
+# handling. Rpcs bigger than datagram_size are sent in pieces, and small
+# calls are batched into one datagram unless batch is given. Messages of more
+# than max_fragments pieces, or whose pieces disagree on how many there are,
+# are dropped. Streamed calls are not retried.
 class UdpChannel( BaseChannel, DatagramProtocol ):
-    def __init__( self, host=None, port=None ):
+    def __init__( self, host=None, port=None, reliable=False, datagram_size=1400, rto=0.2, min_rto=0.005,
+            max_rto=2.0, max_retries=8, dedup_entries=4096, dedup_time=30, max_fragments=1024, **kwargs ):
         self._host = host
         self._port = port
         self.connected = False
-        BaseChannel.__init__( self )
+        self.reliable = reliable
+        if reliable:
+            kwargs.setdefault( "batch", True )
+            kwargs.setdefault( "batch_bytes", datagram_size )
+        BaseChannel.__init__( self, **kwargs )
+        # Requests are kept as Request messages to be sent again.
+        self._encodeCalls = not reliable
+        self.datagram_size = datagram_size
+        self.max_retries = max_retries
+        self.max_fragments = max_fragments
+        self.dedup_entries = dedup_entries
+        self.dedup_time = dedup_time
+        self._rto = ( rto, min_rto, max_rto )
+        self._timeouts = {}
+        self._messages = 0
+        self._pieces = OrderedDict()
+        self._unanswered = {}
+        self._retransmits = {}
+        self._retransmitCall = None
+        self._handling = set()
+        self._answered = OrderedDict()
     
     def startProtocol(self):
         if self._host and self._port:
             self.transport.connect(self._host, self._port)
             self.connected = True
 
-    def datagramReceived( self, data, (host, port) ):
-        rpc = Rpc()
-        rpc.ParseFromString( data )
-        for serializedRequest in rpc.request:
-            service = self._services[ serializedRequest.method.split( '.' )[ 0 ] ]
+    def stopProtocol( self ):
+        for unanswered in self._unanswered.values():
+            if unanswered.timer.active():
+                unanswered.timer.cancel()
+        self._unanswered = {}
+        if self._retransmitCall is not None and self._retransmitCall.active():
+            self._retransmitCall.cancel()
+        self.fail_pending( RpcErrors.CONNECTION_LOST )
+        self.abandon_requests()
 
-            if not service:
-                self.sendError( serializedRequest.id, RpcErrors.SERVICE_NOT_FOUND, host, port )
+    def datagramReceived( self, data, (host, port) ):
+        if self.reliable:
+            data = self.reassemble( data, ( host, port ) )
+            if data is None:
                 return
+        self.rpc_received( data, ( host, port ) )
 
-            method = service.GetDescriptor().FindMethodByName( serializedRequest.method.split( '.' )[ 1 ] )
-            if not method:
-                self.sendError( serializedRequest.id, RpcErrors.METHOD_NOT_FOUND, host, port )
-                return
+    def retransmit_timeout( self, addr ):
+        timeout = self._timeouts.get( addr )
+        if timeout is None:
+            if len( self._timeouts ) >= 1024:
+                self._timeouts.clear()
+            timeout = self._timeouts[ addr ] = RetransmitTimeout( *self._rto )
+        return timeout
 
-            request = service.GetRequestClass( method )()
-            request.ParseFromString( serializedRequest.serialized_request )
-            controller = Controller()
-            d = Deferred()
-            d.addCallback( self.serialize_response, serializedRequest )
-            d.addCallback( self.serialize_rpc )
-            d.addCallback( lambda rpc: self.send_string( rpc.SerializeToString(), host, port ) )
-            service.CallMethod( method, controller, request, d.callback )
+    # Returns the Rpc data once every piece of it has arrived.
+    def reassemble( self, data, addr ):
+        fragment = Fragment()
+        try:
+            fragment.ParseFromString( data )
+        except Exception:
+            return None
+        if fragment.count <= 1:
+            return fragment.data
+        if fragment.count > self.max_fragments or fragment.index >= fragment.count:
+            return None
+        key = ( addr, fragment.message )
+        message = self._pieces.get( key )
+        if message is None:
+            while len( self._pieces ) >= 256:
+                self._pieces.popitem( last=False )
+            message = self._pieces[ key ] = ( fragment.count, {} )
+        count, pieces = message
+        if fragment.count != count:
+            return None
+        # Every index is below count, so count pieces are all of them.
+        pieces[ fragment.index ] = fragment.data
+        if len( pieces ) < count:
+            return None
+        del self._pieces[ key ]
+        return "".join( [ pieces[ i ] for i in range( count ) ] )
 
-        for serializedResponse in rpc.response:
-            id = serializedResponse.id
-            if self._pending.has_key( id ):
-                self._pending[ id ].callback( serializedResponse )
+    def fragments( self, data ):
+        self._messages = ( self._messages + 1 ) & 0xffffffff
+        size = max( self.datagram_size - 32, 1 )
+        count = max( ( len( data ) + size - 1 ) // size, 1 )
+        fragments = []
+        for index in range( count ):
+            fragment = Fragment()
+            fragment.message = self._messages
+            if count > 1:
+                fragment.index = index
+                fragment.count = count
+            fragment.data = data[ index * size:( index + 1 ) * size ]
+            fragments.append( fragment.SerializeToString() )
+        return fragments
+
+    # Requests already answered get the same response again, and those
+    # still being handled are dropped.
+    def dispatch_requests( self, rpc, addr=None ):
+        if self.reliable:
+            self._expire_answered()
+            for i in reversed( range( len( rpc.request ) ) ):
+                serializedRequest = rpc.request[ i ]
+                key = ( addr, serializedRequest.id )
+                if serializedRequest.more or serializedRequest.cancel or key in self._streams or \
+                        key in self._cancelled:
+                    continue
+                answered = self._answered.get( key )
+                if answered is not None:
+                    self.queue_response( answered[ 1 ], addr )
+                elif key not in self._handling:
+                    self._handling.add( key )
+                    continue
+                del rpc.request[ i ]
+        BaseChannel.dispatch_requests( self, rpc, addr )
+
+    def queue_response( self, serializedResponse, addr=None ):
+        if serializedResponse is None:
+            return
+        key = ( addr, serializedResponse.id )
+        if key in self._handling and not serializedResponse.more:
+            self._handling.discard( key )
+            self._answered[ key ] = ( time.time(), serializedResponse )
+            while len( self._answered ) > self.dedup_entries:
+                self._answered.popitem( last=False )
+        BaseChannel.queue_response( self, serializedResponse, addr )
+
+    # Requests that end without a response, having been cancelled, are
+    # handled again if they are sent again.
+    def _request_done( self, result, key ):
+        self._handling.discard( key )
+        return BaseChannel._request_done( self, result, key )
+
+    def _cancel_request( self, key ):
+        self._handling.discard( key )
+        BaseChannel._cancel_request( self, key )
+
+    def _expire_answered( self ):
+        expired = time.time() - self.dedup_time
+        while self._answered:
+            key, ( answered, serializedResponse ) = next( iter( self._answered.items() ) )
+            if answered > expired:
+                break
+            del self._answered[ key ]
+
+    def response_received( self, serializedResponse, addr ):
+        unanswered = self._unanswered.pop( serializedResponse.id, None )
+        if unanswered is None:
+            return
+        if unanswered.timer.active():
+            unanswered.timer.cancel()
+        # Only requests that were sent once give a true round trip time.
+        if not unanswered.attempts:
+            self.retransmit_timeout( unanswered.addr ).sample( time.time() - unanswered.sent )
+
+    def _track( self, rpc, addr ):
+        now = time.time()
+        for serializedRequest in rpc.request:
+            id = serializedRequest.id
+            if serializedRequest.more or isinstance( self._pending.get( id ), Stream ) or id not in self._pending:
+                continue
+            unanswered = self._unanswered.get( id )
+            if unanswered is None:
+                unanswered = self._unanswered[ id ] = _Unanswered( addr, serializedRequest, now )
+            unanswered.timer = reactor.callLater( self.retransmit_timeout( addr ).timeout( unanswered.attempts ),
+                self._expired, id )
+
+    # Requests that time out together are sent again in one Rpc, at the end
+    # of the reactor tick.
+    def _expired( self, id ):
+        unanswered = self._unanswered.get( id )
+        if unanswered is None:
+            return
+        if id not in self._pending:
+            del self._unanswered[ id ]
+            return
+        if unanswered.attempts >= self.max_retries:
+            del self._unanswered[ id ]
+            self._pending.pop( id ).callback( self.error_response( id, RpcErrors.TIMEOUT ) )
+            return
+        unanswered.attempts += 1
+        rpc = self._retransmits.get( unanswered.addr )
+        if rpc is None:
+            rpc = self._retransmits[ unanswered.addr ] = Rpc()
+        rpc.request.add().CopyFrom( unanswered.request )
+        if self._retransmitCall is None:
+            self._retransmitCall = reactor.callLater( 0, self._retransmit )
+
+    def _retransmit( self ):
+        self._retransmitCall = None
+        retransmits, self._retransmits = self._retransmits, {}
+        for addr, rpc in retransmits.items():
+            self.send_rpc( rpc, addr )
 
     def send_string( self, data, host=None, port=None ):
         if host and port:
@@ -192,52 +1065,539 @@ class UdpChannel( BaseChannel, DatagramProtocol ):
         else:
             self.transport.write( data )
     
-    def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done ):
-        rpc = self._call_method( methodDescriptor, request, responseClass, done )
-        self.send_string( rpc.SerializeToString() )
+    def send_rpc( self, rpc, addr=None ):
+        self.send_frame( rpc.SerializeToString(), addr )
+        if self.reliable and len( rpc.request ):
+            self._track( rpc, addr )
+
+    def send_frame( self, data, addr=None ):
+        if self._metrics is not None:
+            self._metrics.written( len( data ) )
+        if not self.reliable:
+            self.send_string( data, *( addr or ( None, None ) ) )
+            return
+        for fragment in self.fragments( data ):
+            self.send_string( fragment, *( addr or ( None, None ) ) )
 
     def sendError( self, id, code, host, port):
-        rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.id = id
-        rpcResponse.error.code = code 
-        rpcResponse.error.text = RpcErrors.msgs[code]
-        self.sendString( rpc.SerializeToString(), host, port )
+        self.queue_response( self.error_response( id, code ), ( host, port ) )
+
+
+# A TcpChannel that reports to the _PoolConnector that built it when it
+# connects and disconnects.
+class _PooledTcpChannel( TcpChannel ):
+    def connectionMade( self ):
+        TcpChannel.connectionMade( self )
+        self.factory.connection_made( self )
+
+    def connectionLost( self, reason ):
+        self.factory.connection_lost( self )
+        TcpChannel.connectionLost( self, reason )
+
+class _Endpoint( object ):
+    def __init__( self, addr, health ):
+        self.addr = addr
+        self.health = health
+        self.slots = []
+
+    def connections( self ):
+        return [ slot.channel for slot in self.slots if slot.channel is not None ]
+
+# Keeps one of a PooledChannel's connections open, dialling again with
+# exponential backoff whenever it fails or drops.
+class _PoolConnector( ReconnectingClientFactory ):
+    protocol = _PooledTcpChannel
+    maxDelay = 30
+
+    def __init__( self, pool, endpoint ):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.channel = None
+
+    def buildProtocol( self, addr ):
+        p = self.protocol( **self.pool._kwargs )
+        p.factory = self
+        return p
+
+    def connection_made( self, channel ):
+        self.resetDelay()
+        self.channel = channel
+        self.pool.connection_made( channel )
+
+    def connection_lost( self, channel ):
+        self.channel = None
+
+    def clientConnectionFailed( self, connector, reason ):
+        self.pool.endpoint_failed( self.endpoint )
+        ReconnectingClientFactory.clientConnectionFailed( self, connector, reason )
+
+# An RpcChannel spreading calls over size connections to each of a list of
+# (host, port) endpoints, or paths of Unix domain sockets for servers on
+# the same host, so stubs need not be tied to a single server. A
+# call goes to the connection with the fewest outstanding calls, or with
+# balance="p2c" to the less busy of two picked at random. An endpoint that
+# fails max_failures times in a row (refused connections, calls timing out
+# or cut off) is ejected for eject_time seconds. Calls made while no
+# connection is up wait for one. Other keyword arguments are passed on to
+# each TcpChannel.
+class PooledChannel( google.protobuf.service.RpcChannel ):
+    def __init__( self, endpoints, size=1, balance="least_outstanding", max_failures=3,
+            eject_time=10, **kwargs ):
+        google.protobuf.service.RpcChannel.__init__( self )
+        self._kwargs = kwargs
+        self._balance = balancers[ balance ]
+        self._endpoints = []
+        self._waiting = deque()
+        self._batches = []
+        for addr in endpoints:
+            endpoint = _Endpoint( addr, EndpointHealth( max_failures, eject_time ) )
+            for i in range( size ):
+                slot = _PoolConnector( self, endpoint )
+                if isinstance( addr, basestring ):
+                    slot.connector = reactor.connectUNIX( addr, slot )
+                else:
+                    slot.connector = reactor.connectTCP( addr[ 0 ], addr[ 1 ], slot )
+                endpoint.slots.append( slot )
+            self._endpoints.append( endpoint )
+
+    def connections( self ):
+        now = reactor.seconds()
+        channels = []
+        for endpoint in self._endpoints:
+            if not endpoint.health.ejected( now ):
+                channels.extend( endpoint.connections() )
+        if not channels:
+            for endpoint in self._endpoints:
+                channels.extend( endpoint.connections() )
+        return channels
+
+    def CallMethod( self, methodDescriptor, rpcController, request, responseClass, done ):
+        channels = self.connections()
+        if not channels:
+            self._waiting.append( ( methodDescriptor, rpcController, request, responseClass, done ) )
+            return
+        channel = self._balance( channels )
+        channel.CallMethod( methodDescriptor, rpcController, request, responseClass,
+            self._call_done( channel.factory.endpoint, rpcController, done ) )
+
+    def open_stream( self, methodDescriptor, responseClass, rpcController=None ):
+        channels = self.connections()
+        if not channels:
+            raise RpcError( RpcErrors.CONNECTION_LOST )
+        return self._balance( channels ).open_stream( methodDescriptor, responseClass, rpcController )
+
+    def call_stream( self, methodDescriptor, request, responseClass, rpcController=None ):
+        stream = self.open_stream( methodDescriptor, responseClass, rpcController )
+        stream.close( request )
+        return stream
+
+    def _call_done( self, endpoint, rpcController, done ):
+        def call_done( response ):
+            if transport_failed( rpcController ):
+                endpoint.health.failed( reactor.seconds() )
+            else:
+                endpoint.health.succeeded()
+            done( response )
+        return call_done
+
+    def connection_made( self, channel ):
+        waiting, self._waiting = self._waiting, deque()
+        for call in waiting:
+            self.CallMethod( *call )
+
+    def endpoint_failed( self, endpoint ):
+        now = reactor.seconds()
+        endpoint.health.failed( now )
+        for endpoint in self._endpoints:
+            if endpoint.connections() or not endpoint.health.ejected( now ):
+                return
+        self._fail_waiting()
 
+    def _fail_waiting( self ):
+        waiting, self._waiting = self._waiting, deque()
+        for methodDescriptor, rpcController, request, responseClass, done in waiting:
+            _fail_call( rpcController, responseClass, done, RpcErrors.CONNECTION_LOST )
 
+    def start_batch( self ):
+        channels = self.connections()
+        for channel in channels:
+            channel.start_batch()
+        self._batches.append( channels )
+
+    def end_batch( self ):
+        for channel in self._batches.pop():
+            channel.end_batch()
+
+    def close( self ):
+        for endpoint in self._endpoints:
+            for slot in endpoint.slots:
+                slot.stopTrying()
+                if slot.channel is not None:
+                    slot.channel.transport.loseConnection()
+        self._fail_waiting()
+
+# Runs service methods on a pool of threads, so that blocking methods do not
+# hold up the reactor. The request is parsed and the response serialized on
+# the worker thread, and done may be called later from any thread. Streamed
+# responses are written through the reactor, which the worker waits for.
+class ThreadExecutor( object ):
+    def __init__( self, size=10 ):
+        self.pool = ThreadPool( 0, size, "protobufrpc" )
+        self.metrics = None
+
+    def start( self ):
+        self.pool.start()
+
+    def stop( self ):
+        self.pool.stop()
+
+    def call( self, entry, controller, data, d ):
+        writer = controller.writer
+        controller.writer = lambda message: blockingCallFromThread( reactor, writer, message )
+        self.pool.callInThread( self._run, entry, controller, data, d, time.time() )
+
+    def _run( self, entry, controller, data, d, queued ):
+        if controller.IsCancelled():
+            reactor.callFromThread( d.callback, None )
+            return
+        called = []
+        started = time.time()
+        def done( response ):
+            called.append( True )
+            metrics = self.metrics
+            if metrics is not None:
+                finished = time.time()
+                metrics.handled( entry.name, finished - started, started - queued )
+            if response is not None and not controller.Failed():
+                response = response.SerializeToString()
+                if metrics is not None:
+                    metrics.serialized( entry.name, len( response ), time.time() - finished )
+            reactor.callFromThread( d.callback, response )
+        try:
+            request = entry.requestClass()
+            request.ParseFromString( data )
+            entry.service.CallMethod( entry.method, controller, request, done )
+        except Exception, e:
+            if not called:
+                controller.SetFailed( str( e ) )
+                done( None )
+
+_workerDispatch = None
+
+def _start_worker( dispatch ):
+    global _workerDispatch
+    _workerDispatch = dispatch
+
+# Returns the serialized response, the error and when the call started and
+# finished. Calls whose deadline has passed are not started.
+def _run_in_worker( name, data, deadline=None ):
+    entry = _workerDispatch.methods[ name ]
+    controller = Controller()
+    responses = []
+    started = time.time()
+    if deadline is not None and started >= deadline:
+        return None, None, started, started
+    try:
+        request = entry.requestClass()
+        request.ParseFromString( data )
+        entry.service.CallMethod( entry.method, controller, request, responses.append )
+    except Exception, e:
+        return None, str( e ), started, time.time()
+    finished = time.time()
+    if controller.Failed():
+        return None, controller.ErrorText(), started, finished
+    if not responses:
+        return None, "method did not call done", started, finished
+    if responses[ 0 ] is None:
+        return None, None, started, finished
+    return responses[ 0 ].SerializeToString(), None, started, finished
+
+# Runs service methods in a pool of processes, for CPU-bound methods. The
+# pool is forked when the Factory starts, so each worker has its own copy of
+# the services, and requests and responses cross over in serialized form.
+# Methods must call done before they return and cannot stream.
+class ProcessExecutor( object ):
+    def __init__( self, dispatch, size=None ):
+        self.dispatch = dispatch
+        self.size = size
+        self.pool = None
+        self.metrics = None
+
+    def start( self ):
+        self.pool = multiprocessing.Pool( self.size, _start_worker, ( self.dispatch, ) )
+
+    def stop( self ):
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def call( self, entry, controller, data, d ):
+        queued = time.time()
+        def finished( result ):
+            reactor.callFromThread( self._finished, result, entry, controller, d, queued )
+        self.pool.apply_async( _run_in_worker, ( entry.name, data, controller.deadline ), callback=finished )
+
+    def _finished( self, result, entry, controller, d, queued ):
+        data, error, started, finished = result
+        if self.metrics is not None:
+            self.metrics.handled( entry.name, finished - started, started - queued )
+        if error is not None:
+            controller.SetFailed( error )
+        d.callback( data )
+
+# The factory serves Unix domain sockets as well as TCP, for clients on the
+# same host: reactor.listenUNIX( path, Factory( ... ) ), with TcpChannels
+# connected by ClientCreator( reactor, TcpChannel ).connectUNIX( path ).
+#
+# Keyword arguments are passed on to each TcpChannel, except for:
+#
+# max_total_in_flight: the number of requests all connections together may
+# have in flight before every connection stops reading, until the total is
+# down to half of it.
+#
+# execution: where methods run, by service name or "Service.Method" name:
+# "inline" on the reactor (the default), "thread" on a pool of threads
+# (threads of them, 10 by default) or "process" on a pool of processes
+# (processes of them, one per CPU by default). The pools run while the
+# factory is listening.
+#
+# metrics: a protobufrpc.metrics.Metrics, or anything with its hooks, shared
+# by every connection and pool.
+#
+# cache: a ResponseCache shared by every connection.
+#
+# single_flight: a SingleFlight shared by every connection, so identical
+# requests arriving on any of them while one is being handled wait for its
+# response.
+#
+# decoding: how the requests served are decoded, for instance
+# { "Router": "raw" } to hand the Router service's methods RawMessages; see
+# common.decoder.
+#
+# idle_timeout: seconds after which a connection that has received nothing
+# and has no requests in flight is closed.
+#
+# max_connections: the number of connections to serve at once; further
+# connections are closed as soon as they are accepted.
 class Factory( twisted.internet.protocol.Factory ):
     protocol = TcpChannel
 
-    def __init__( self, *services ):
-        self._protocols = []
-        self._services = {}
-        for s in services:
-            self._services[ s.GetDescriptor().name ] = s
+    def __init__( self, *services, **kwargs ):
+        # The open connections, each dropped when it is lost.
+        self._protocols = set()
+        self._dispatch = DispatchTable( services, kwargs.get( "decoding" ) )
+        self._executors = {}
+        self._pools = []
+        execution = kwargs.pop( "execution", {} )
+        threads = kwargs.pop( "threads", 10 )
+        processes = kwargs.pop( "processes", None )
+        pools = { "inline": None }
+        for name, entry in self._dispatch.methods.items():
+            policy = execution.get( name, execution.get( name.split( '.' )[ 0 ], "inline" ) )
+            if policy not in pools:
+                if policy == "thread":
+                    pools[ policy ] = ThreadExecutor( threads )
+                elif policy == "process":
+                    pools[ policy ] = ProcessExecutor( self._dispatch, processes )
+                else:
+                    raise ValueError( "unknown execution policy %r" % policy )
+                pools[ policy ].metrics = kwargs.get( "metrics" )
+                self._pools.append( pools[ policy ] )
+            if pools[ policy ] is not None:
+                self._executors[ name ] = pools[ policy ]
+        self.max_total_in_flight = kwargs.pop( "max_total_in_flight", None )
+        self.idle_timeout = kwargs.pop( "idle_timeout", None )
+        self.max_connections = kwargs.pop( "max_connections", None )
+        self.inFlight = 0
+        self.overloaded = False
+        self.draining = False
+        self._reaper = None
+        self._drained = None
+        self._drainTimeout = None
+        self._kwargs = kwargs
     
     def buildProtocol( self, addr ):
-        p = self.protocol()
+        if self.draining or ( self.max_connections is not None and len( self._protocols ) >= self.max_connections ):
+            return None
+        p = self.protocol( **self._kwargs )
         p.factory = self
-        p._services = self._services
-        self._protocols.append( p )
+        p._server = self
+        p._dispatch = self._dispatch
+        p._executors = self._executors
+        self._protocols.add( p )
         return p
 
+    def connection_lost( self, p ):
+        self._protocols.discard( p )
+        if self._drained is not None and not self._protocols:
+            self._finish_drain()
+
+    def startFactory( self ):
+        for pool in self._pools:
+            pool.start()
+        if self.idle_timeout is not None:
+            self._reaper = LoopingCall( self.reap_idle )
+            self._reaper.start( self.idle_timeout / 2.0, now=False )
+
+    # While draining, the pools are kept for the requests in flight and
+    # stopped once the last connection has closed.
+    def stopFactory( self ):
+        if self._drained is None:
+            self._stop()
+
+    def _stop( self ):
+        for pool in self._pools:
+            pool.stop()
+        if self._reaper is not None:
+            if self._reaper.running:
+                self._reaper.stop()
+            self._reaper = None
+
+    def reap_idle( self ):
+        since = reactor.seconds() - self.idle_timeout
+        for p in list( self._protocols ):
+            if p.idle() and p.lastReceived is not None and p.lastReceived <= since:
+                p.transport.loseConnection()
+
+    # Stops listening on ports, and has each connection answer the requests
+    # it has in flight, read no more and close. Connections still open
+    # after timeout seconds are dropped. Returns a Deferred that fires once
+    # every connection has closed.
+    def drain( self, *ports, **kwargs ):
+        timeout = kwargs.get( "timeout" )
+        self.draining = True
+        if self._drained is None:
+            self._drained = Deferred()
+        d = self._drained
+        for port in ports:
+            port.stopListening()
+        if timeout is not None and self._drainTimeout is None:
+            self._drainTimeout = reactor.callLater( timeout, self._abort_drain )
+        for p in list( self._protocols ):
+            p.update_reading()
+            p.close_if_drained()
+        if not self._protocols and self._drained is not None:
+            self._finish_drain()
+        return d
+
+    def _abort_drain( self ):
+        self._drainTimeout = None
+        for p in list( self._protocols ):
+            if hasattr( p.transport, "abortConnection" ):
+                p.transport.abortConnection()
+            else:
+                p.transport.loseConnection()
+
+    def _finish_drain( self ):
+        if self._drainTimeout is not None:
+            if self._drainTimeout.active():
+                self._drainTimeout.cancel()
+            self._drainTimeout = None
+        d, self._drained = self._drained, None
+        if not self.numPorts:
+            self._stop()
+        d.callback( None )
+
+    def request_started( self ):
+        self.inFlight += 1
+        self._update_overloaded()
+
+    def request_finished( self ):
+        self.inFlight -= 1
+        self._update_overloaded()
+
+    def _update_overloaded( self ):
+        limit = self.max_total_in_flight
+        if limit is None:
+            return
+        if self.overloaded:
+            overloaded = self.inFlight > limit // 2
+        else:
+            overloaded = self.inFlight >= limit
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            for p in self._protocols:
+                p.update_reading()
+
 class Proxy( object ):
+    # Holds a _Method for each method of the stub's service, built once from
+    # its descriptor.
     class _Proxy( object ):
-        def __init__( self, stub ):
+        def __init__( self, stub, calls=None, decoding=None ):
             self._stub = stub
+            for method in stub.GetDescriptor().methods:
+                setattr( self, method.name, Proxy._Method( stub, method, calls, decoding ) )
+
+    # proxy.Service.Method( request ) returns a Deferred for the response;
+    # proxy.Service.Method.stream( request ) a Stream of responses, and
+    # proxy.Service.Method.open() a Stream to write requests to.
+    # proxy.Service.Method.call( request, done ) calls done( response )
+    # without a Deferred or a Controller, with None if the call failed; a
+    # controller given is told why, and may be Reset() and passed again.
+    class _Method( object ):
+        def __init__( self, stub, method, calls, decoding=None ):
+            self._channel = stub.rpc_channel
+            self._method = method
+            self._calls = calls
+            self._responseClass = decoder( stub.GetResponseClass( method ), decoding, method_name( method ) )
+
+        def __call__( self, request ):
+            d = Deferred()
+            self._channel.CallMethod( self._method, Controller(), request, self._responseClass, d.callback )
+            if self._calls is not None:
+                self._calls.append( d )
+            return d
+
+        def call( self, request, done, controller=None ):
+            self._channel.CallMethod( self._method, controller, request, self._responseClass, done )
+
+        def stream( self, request ):
+            stream = self.open()
+            stream.close( request )
+            return stream
+
+        def open( self ):
+            return self._channel.open_stream( self._method, self._responseClass, Controller() )
+
+    class _Batch( object ):
+        def __init__( self, stubs, decoding=None ):
+            self._calls = []
+            self._channels = []
+            self._stubs = {}
+            for name, stub in stubs.items():
+                self._stubs[ name ] = Proxy._Proxy( stub, self._calls, decoding )
+                if stub.rpc_channel not in self._channels:
+                    self._channels.append( stub.rpc_channel )
+            for channel in self._channels:
+                channel.start_batch()
 
         def __getattr__( self, key ):
-            def call( method, request ):
-                d = Deferred()
-                controller = Controller()
-                method( controller, request, d.callback )
-                return d
-            return lambda request: call( getattr( self._stub, key ), request )
+            return self._stubs[ key ]
+
+        def __enter__( self ):
+            return self
 
-    def __init__( self, *stubs ):
+        def __exit__( self, *exc_info ):
+            self.flush()
+
+        def flush( self ):
+            channels, self._channels = self._channels, []
+            for channel in channels:
+                channel.end_batch()
+            return DeferredList( self._calls, fireOnOneErrback=True, consumeErrors=True )
+
+    # Responses are decoded as decoding says, if given; see common.decoder.
+    # Requests may be RawMessages as well as messages.
+    def __init__( self, *stubs, **kwargs ):
         self._stubs = {}
+        self._rawStubs = {}
+        self._decoding = kwargs.get( "decoding" )
         for s in stubs:
-            self._stubs[ s.GetDescriptor().name ] = self._Proxy( s )
+            self._stubs[ s.GetDescriptor().name ] = self._Proxy( s, decoding=self._decoding )
+            self._rawStubs[ s.GetDescriptor().name ] = s
     
     def __getattr__( self, key ):
         return self._stubs[ key ]
+
+    def batch( self ):
+        return self._Batch( self._rawStubs, self._decoding )
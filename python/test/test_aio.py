@@ -0,0 +1,200 @@
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+import unittest
+try:
+	from protobufrpc import aio
+except ImportError:
+	aio = None
+from protobufrpc.common import Compression, SingleFlight
+from test_suite_pb2 import Test, Test_Stub, EchoRequest, EchoResponse
+
+class LaterService( Test ):
+	def __init__( self, loop ):
+		self.loop = loop
+
+	def Echo( self, rpc_controller, request, done ):
+		response = EchoResponse()
+		response.text = request.text
+		self.loop.call_later( 0.001, done, response )
+
+	def Split( self, rpc_controller, request, done ):
+		for word in request.text.split():
+			response = EchoResponse()
+			response.text = word
+			rpc_controller.write( response )
+		self.loop.call_later( 0.001, done, None )
+
+# Counts the calls to Echo.
+class CountingService( LaterService ):
+	def __init__( self, loop ):
+		LaterService.__init__( self, loop )
+		self.calls = 0
+
+	def Echo( self, rpc_controller, request, done ):
+		self.calls += 1
+		LaterService.Echo( self, rpc_controller, request, done )
+
+class SilentService( Test ):
+	def Echo( self, rpc_controller, request, done ):
+		pass
+
+class HeldService( Test ):
+	def __init__( self ):
+		self.controllers = []
+
+	def Echo( self, rpc_controller, request, done ):
+		self.controllers.append( rpc_controller )
+
+class AioTestCase( unittest.TestCase ):
+	def setUp( self ):
+		if aio is None:
+			raise unittest.SkipTest( "asyncio is not available" )
+		self.loop = aio.asyncio.new_event_loop()
+		self.server = self.loop.run_until_complete( self.loop.create_server(
+			aio.Factory( LaterService( self.loop ), max_in_flight=4, loop=self.loop ),
+			"127.0.0.1", 0 ) )
+		port = self.server.sockets[ 0 ].getsockname()[ 1 ]
+		self.transport, self.channel = self.loop.run_until_complete(
+			self.loop.create_connection( lambda: aio.TcpChannel( loop=self.loop ), "127.0.0.1", port ) )
+
+	def tearDown( self ):
+		self.doCleanups()
+		self.transport.close()
+		self.server.close()
+		self.loop.run_until_complete( self.server.wait_closed() )
+		self.loop.close()
+
+	def echo( self, proxy, text ):
+		request = EchoRequest()
+		request.text = text
+		return proxy.Test.Echo( request )
+
+	def testProxy( self ):
+		proxy = aio.Proxy( Test_Stub( self.channel ) )
+		response = self.loop.run_until_complete( self.echo( proxy, "aio" ) )
+		self.assertEqual( response.text, "aio" )
+
+	def testPipelined( self ):
+		proxy = aio.Proxy( Test_Stub( self.channel ) )
+		calls = [ self.echo( proxy, str( i ) ) for i in range( 100 ) ]
+		responses = self.loop.run_until_complete( aio.asyncio.gather( *calls ) )
+		self.assertEqual( [ r.text for r in responses ], [ str( i ) for i in range( 100 ) ] )
+		self.assertEqual( len( self.channel._pending ), 0 )
+
+	def otherServer( self, *services, **kwargs ):
+		server = self.loop.run_until_complete( self.loop.create_server(
+			aio.Factory( *services, loop=self.loop, **kwargs ), "127.0.0.1", 0 ) )
+		port = server.sockets[ 0 ].getsockname()[ 1 ]
+		transport, channel = self.loop.run_until_complete( self.loop.create_connection(
+			lambda: aio.TcpChannel( loop=self.loop, **kwargs ), "127.0.0.1", port ) )
+		def close():
+			transport.close()
+			server.close()
+			self.loop.run_until_complete( server.wait_closed() )
+		self.addCleanup( close )
+		return channel
+
+	def testServiceNotFound( self ):
+		proxy = aio.Proxy( Test_Stub( self.otherServer() ) )
+		self.assertRaises( aio.RpcError, self.loop.run_until_complete, self.echo( proxy, "x" ) )
+
+	def testTimeout( self ):
+		channel = self.otherServer( SilentService(), timeout=0.05, max_pending=1, block=False )
+		proxy = aio.Proxy( Test_Stub( channel ) )
+		first = self.echo( proxy, "lost" )
+		second = self.echo( proxy, "full" )
+		self.assertEqual( second.exception().code, aio.RpcErrors.TOO_MANY_PENDING )
+		self.assertRaises( aio.RpcError, self.loop.run_until_complete, first )
+		self.assertEqual( first.exception().code, aio.RpcErrors.TIMEOUT )
+		self.assertEqual( len( channel._pending ), 0 )
+
+	def testStreaming( self ):
+		proxy = aio.Proxy( Test_Stub( self.channel ) )
+		request = EchoRequest()
+		request.text = "one two three"
+		stream = proxy.Test.Split.stream( request )
+		texts = []
+		while True:
+			response = self.loop.run_until_complete( stream.next() )
+			if response is None:
+				break
+			texts.append( response.text )
+		self.assertEqual( texts, [ "one", "two", "three" ] )
+		self.assertEqual( len( self.channel._pending ), 0 )
+
+	def testCompression( self ):
+		channel = self.otherServer( LaterService( self.loop ), compression=True, compression_threshold=64 )
+		proxy = aio.Proxy( Test_Stub( channel ) )
+		text = "compressible " * 100
+		for i in range( 3 ):
+			self.assertEqual( self.loop.run_until_complete( self.echo( proxy, text ) ).text, text )
+		self.assertEqual( channel._compressor.codec, Compression.available[ 0 ] )
+
+	def settle( self ):
+		self.loop.run_until_complete( aio.asyncio.sleep( 0.05 ) )
+
+	def testCancel( self ):
+		service = HeldService()
+		channel = self.otherServer( service, timeout=10 )
+		proxy = aio.Proxy( Test_Stub( channel ) )
+		call = self.echo( proxy, "held" )
+		self.settle()
+		controller, = service.controllers
+		self.assertTrue( 9 < controller.deadline - time.time() <= 10 )
+		self.assertFalse( controller.IsCancelled() )
+		call.cancel()
+		self.settle()
+		self.assertTrue( controller.cancelled )
+		self.assertEqual( len( channel._pending ), 0 )
+
+	def testExpiryCancels( self ):
+		service = HeldService()
+		channel = self.otherServer( service, timeout=0.05 )
+		proxy = aio.Proxy( Test_Stub( channel ) )
+		call = self.echo( proxy, "held" )
+		self.assertRaises( aio.RpcError, self.loop.run_until_complete, call )
+		self.settle()
+		controller, = service.controllers
+		self.assertTrue( controller.cancelled )
+
+	def testSingleFlight( self ):
+		service = CountingService( self.loop )
+		serverFlight = SingleFlight()
+		clientFlight = SingleFlight( [ "Test" ] )
+		server = self.loop.run_until_complete( self.loop.create_server(
+			aio.Factory( service, single_flight=serverFlight, loop=self.loop ), "127.0.0.1", 0 ) )
+		port = server.sockets[ 0 ].getsockname()[ 1 ]
+		channels = []
+		for flight in [ None, clientFlight ]:
+			transport, channel = self.loop.run_until_complete( self.loop.create_connection(
+				lambda: aio.TcpChannel( single_flight=flight, loop=self.loop ), "127.0.0.1", port ) )
+			self.addCleanup( transport.close )
+			channels.append( channel )
+		def close():
+			server.close()
+			self.loop.run_until_complete( server.wait_closed() )
+		self.addCleanup( close )
+		plain, collapsing = [ aio.Proxy( Test_Stub( channel ) ) for channel in channels ]
+		texts = [ "herd", "herd", "herd", "other" ]
+		calls = [ self.echo( collapsing, text ) for text in texts ] + [ self.echo( plain, "herd" ) ]
+		responses = self.loop.run_until_complete( aio.asyncio.gather( *calls ) )
+		self.assertEqual( [ r.text for r in responses ], texts + [ "herd" ] )
+		self.assertEqual( len( set( [ id( r ) for r in responses ] ) ), 5 )
+		self.assertEqual( ( service.calls, clientFlight.shared, serverFlight.shared ), ( 2, 2, 1 ) )
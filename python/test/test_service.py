@@ -18,11 +18,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from protobufrpc import tx
+import threading
+from protobufrpc import tx, synchronous
+from protobufrpc.common import Controller, RpcErrors, Compression, ResponseCache, SingleFlight, RawMessage, LazyMessage
+from protobufrpc.common import encode_request, encode_response, scan_responses
+from protobufrpc.protobufrpc_pb2 import Rpc, Fragment
+from protobufrpc.metrics import Metrics
+from protobufrpc.supervisor import tx_worker
 from twisted.trial import unittest
 from twisted.internet import reactor
 from twisted.internet.protocol import ClientCreator
-from test_suite_pb2 import Test, Test_Stub, EchoRequest, EchoResponse
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.threads import deferToThread
+from test_suite_pb2 import Test, Test_Stub, EchoRequest, EchoResponse, Note
 
 class TestService( Test ):
 	def Echo( self, rpc_controller, request, done ):
@@ -30,6 +38,115 @@ class TestService( Test ):
 		response.text = request.text
 		done( response )
 
+	def Split( self, rpc_controller, request, done ):
+		for word in request.text.split():
+			response = EchoResponse()
+			response.text = word
+			rpc_controller.write( response )
+		done( None )
+
+	def Join( self, rpc_controller, request, done ):
+		if not hasattr( rpc_controller, "words" ):
+			rpc_controller.words = []
+		if request is not None:
+			rpc_controller.words.append( request.text )
+		if not rpc_controller.more:
+			response = EchoResponse()
+			response.text = " ".join( rpc_controller.words )
+			done( response )
+
+class SilentService( Test ):
+	def Echo( self, rpc_controller, request, done ):
+		pass
+
+# Blocks in Echo until released.
+class BlockingService( TestService ):
+	def __init__( self ):
+		self.release = threading.Event()
+
+	def Echo( self, rpc_controller, request, done ):
+		self.release.wait( 5 )
+		TestService.Echo( self, rpc_controller, request, done )
+
+# Counts the calls to Echo.
+class CountingService( TestService ):
+	def __init__( self ):
+		self.calls = 0
+
+	def Echo( self, rpc_controller, request, done ):
+		self.calls += 1
+		TestService.Echo( self, rpc_controller, request, done )
+
+# Answers each call a little later, keeping track of how many calls it had
+# running at once.
+class SlowService( Test ):
+	def __init__( self ):
+		self.running = 0
+		self.most = 0
+		self.calls = 0
+
+	def Echo( self, rpc_controller, request, done ):
+		self.calls += 1
+		self.running += 1
+		self.most = max( self.most, self.running )
+		def finish():
+			self.running -= 1
+			response = EchoResponse()
+			response.text = request.text
+			done( response )
+		reactor.callLater( 0.01, finish )
+
+# Answers Echo after delay seconds.
+class DelayedService( CountingService ):
+	def __init__( self, delay ):
+		CountingService.__init__( self )
+		self.delay = delay
+
+	def Echo( self, rpc_controller, request, done ):
+		reactor.callLater( self.delay, CountingService.Echo, self, rpc_controller, request, done )
+
+# Never answers Echo; started fires when it is called and cancelled when the
+# call is cancelled.
+class CancellableService( Test ):
+	def __init__( self ):
+		self.started = Deferred()
+		self.cancelled = Deferred()
+
+	def Echo( self, rpc_controller, request, done ):
+		rpc_controller.NotifyOnCancel( lambda: self.cancelled.callback( request.text ) )
+		self.started.callback( request.text )
+
+# Passes Echo calls on to another server through proxy.
+class ForwardingService( Test ):
+	def __init__( self, proxy ):
+		self.proxy = proxy
+		self.requests = []
+
+	def Echo( self, rpc_controller, request, done ):
+		self.requests.append( request )
+		self.proxy.Test.Echo( request ).addCallback( done )
+
+# Fires once condition() holds, checking every 10ms.
+def waitFor( condition ):
+	d = Deferred()
+	def check():
+		if condition():
+			d.callback( None )
+		else:
+			reactor.callLater( 0.01, check )
+	check()
+	return d
+
+# A client channel whose closed Deferred fires when the connection is lost.
+class ClosingChannel( tx.TcpChannel ):
+	def __init__( self, **kwargs ):
+		tx.TcpChannel.__init__( self, **kwargs )
+		self.closed = Deferred()
+
+	def connectionLost( self, reason ):
+		tx.TcpChannel.connectionLost( self, reason )
+		self.closed.callback( None )
+
 class ServiceTestCase( unittest.TestCase ):
 	def setUp( self ):
 		self.service = TestService()
@@ -66,6 +183,33 @@ class ServiceTestCase( unittest.TestCase ):
 		d.addCallback( connected )
 		return d
 
+	def testDirectCall( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			self.assertIdentical( proxy.Test.Echo, proxy.Test.Echo )
+			request = EchoRequest()
+			request.text = "direct"
+			d = Deferred()
+			controller = Controller()
+			proxy.Test.Echo.call( request, d.callback, controller )
+			d.addCallback( lambda r: self.assertEquals( ( r.text, controller.Failed() ), ( "direct", False ) ) )
+			# Without a controller, a call that fails gets None.
+			responses = []
+			def lean( _ ):
+				proxy.Test.Echo.call( request, responses.append )
+				proxy.Test.Echo.call( request, responses.append )
+				return waitFor( lambda: len( responses ) == 2 )
+			d.addCallback( lean )
+			d.addCallback( lambda _: self.assertEquals( [ r and r.text for r in responses ], [ None, "direct" ] ) )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel, max_pending=1, block=False )
+		d = client.connectTCP( self.tcp_listener.getHost().host,
+			self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
 	def testUdpRpc( self ):
 		protocol = tx.UdpChannel( self.udp_listener.getHost().host, 
 			self.udp_listener.getHost().port )
@@ -78,3 +222,886 @@ class ServiceTestCase( unittest.TestCase ):
 		echoed.addCallback( lambda r: self.assertEquals( r.text, text ) )
 		return echoed
 
+	def testReliableUdpRpc( self ):
+		service = CountingService()
+		server = tx.UdpChannel( reliable=True )
+		server.add_service( service )
+		listener = reactor.listenUDP( 0, server )
+		protocol = tx.UdpChannel( listener.getHost().host, listener.getHost().port,
+			reliable=True, rto=0.05 )
+		# The client's first request is lost and so is the server's first
+		# answer, as is one piece of the large request.
+		sent = []
+		sendString = protocol.send_string
+		def lossy( data, host=None, port=None ):
+			sent.append( data )
+			if len( sent ) not in ( 1, 5 ):
+				sendString( data, host, port )
+		protocol.send_string = lossy
+		answered = []
+		serverSendString = server.send_string
+		def lossyServer( data, host=None, port=None ):
+			answered.append( data )
+			if len( answered ) > 1:
+				serverSendString( data, host, port )
+		server.send_string = lossyServer
+		port = reactor.listenUDP( 0, protocol )
+		proxy = tx.Proxy( Test_Stub( protocol ) )
+		request = EchoRequest()
+		request.text = "reliable"
+		large = EchoRequest()
+		large.text = "x" * 100000
+		d = proxy.Test.Echo( request )
+		def big( response ):
+			self.assertEquals( response.text, "reliable" )
+			self.assertEquals( service.calls, 1 )
+			return proxy.Test.Echo( large )
+		d.addCallback( big )
+		def check( response ):
+			self.assertEquals( response.text, large.text )
+			self.assertEquals( service.calls, 2 )
+			self.assertEquals( protocol._unanswered, {} )
+		d.addCallback( check )
+		def stop( result ):
+			port.stopListening()
+			listener.stopListening()
+			return result
+		d.addBoth( stop )
+		return d
+
+	def testReassembly( self ):
+		protocol = tx.UdpChannel( reliable=True, max_fragments=4 )
+		def piece( message, index, count, data ):
+			fragment = Fragment()
+			fragment.message = message
+			fragment.index = index
+			fragment.count = count
+			fragment.data = data
+			return protocol.reassemble( fragment.SerializeToString(), ( "127.0.0.1", 1 ) )
+		# Out of range, over the cap and disagreeing pieces are dropped.
+		self.assertEquals( piece( 1, 5, 2, "x" ), None )
+		self.assertEquals( piece( 2, 0, 5, "x" ), None )
+		self.assertEquals( piece( 3, 1, 3, "b" ), None )
+		self.assertEquals( piece( 3, 0, 2, "a" ), None )
+		self.assertEquals( piece( 3, 2, 3, "c" ), None )
+		self.assertEquals( piece( 3, 0, 3, "a" ), "abc" )
+		self.assertEquals( len( protocol._pieces ), 0 )
+
+	def testReliableUdpTimeout( self ):
+		protocol = tx.UdpChannel( "127.0.0.1", self.udp_listener.getHost().port, reliable=True,
+			rto=0.01, max_rto=0.01, max_retries=2 )
+		sent = []
+		protocol.send_string = lambda data, host=None, port=None: sent.append( data )
+		port = reactor.listenUDP( 0, protocol )
+		controller = Controller()
+		d = Deferred()
+		request = EchoRequest()
+		request.text = "lost"
+		Test_Stub( protocol ).Echo( controller, request, d.callback )
+		def check( response ):
+			port.stopListening()
+			self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.TIMEOUT ] )
+			self.assertEquals( len( sent ), 3 )
+			self.assertEquals( len( protocol._pending ), 0 )
+		d.addCallback( check )
+		return d
+
+	def testTcpBatchedRpc( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			frames = []
+			sendString = protocol.sendString
+			protocol.sendString = lambda data: frames.append( data ) or sendString( data )
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			calls = []
+			for text in [ "one", "two", "three" ]:
+				request = EchoRequest()
+				request.text = text
+				calls.append( proxy.Test.Echo( request ) )
+			dl = DeferredList( calls, fireOnOneErrback=True )
+			def check( results ):
+				self.assertEquals( [ r.text for ok, r in results ], [ "one", "two", "three" ] )
+				self.assertEquals( len( frames ), 1 )
+			dl.addCallback( check )
+			return dl
+
+		client = ClientCreator( reactor, tx.TcpChannel, batch=True )
+		d = client.connectTCP( self.tcp_listener.getHost().host,
+			self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testProxyBatch( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			batch = proxy.batch()
+			for text in [ "a", "b" ]:
+				request = EchoRequest()
+				request.text = text
+				batch.Test.Echo( request )
+			self.assertEquals( len( protocol._pending ), 2 )
+			d = batch.flush()
+			d.addCallback( lambda results: self.assertEquals(
+				[ r.text for ok, r in results ], [ "a", "b" ] ) )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( self.tcp_listener.getHost().host,
+			self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testSynchronousBatch( self ):
+		host = self.tcp_listener.getHost()
+		def call():
+			channel = synchronous.TcpChannel( ( host.host, host.port ) )
+			proxy = synchronous.Proxy( Test_Stub( channel ) )
+			batch = proxy.batch()
+			for text in [ "x", "y", "z" ]:
+				request = EchoRequest()
+				request.text = text
+				batch.Test.Echo( request )
+			try:
+				return [ r[ 0 ].text for r in batch.flush() ]
+			finally:
+				channel._tcpSocket.close()
+		d = deferToThread( call )
+		d.addCallback( self.assertEquals, [ "x", "y", "z" ] )
+		return d
+
+	def testServerCoalescesResponses( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			frames = []
+			stringReceived = protocol.stringReceived
+			protocol.stringReceived = lambda data: frames.append( data ) or stringReceived( data )
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			batch = proxy.batch()
+			for text in [ "a", "b", "c" ]:
+				request = EchoRequest()
+				request.text = text
+				batch.Test.Echo( request )
+			d = batch.flush()
+			d.addCallback( lambda results: self.assertEquals( len( frames ), 1 ) )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( self.tcp_listener.getHost().host,
+			self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testPipelinedChannel( self ):
+		host = self.tcp_listener.getHost()
+		def call():
+			channel = synchronous.PipelinedTcpChannel( ( host.host, host.port ) )
+			stub = Test_Stub( channel )
+			futures = []
+			for i in range( 20 ):
+				request = EchoRequest()
+				request.text = str( i )
+				futures.append( stub.Echo( None, request, None ) )
+			try:
+				proxy = synchronous.Proxy( stub )
+				request = EchoRequest()
+				request.text = "proxy"
+				echoed = proxy.Test.Echo( request )
+				return [ f.result( 5 ).text for f in futures ], echoed[ 0 ].text
+			finally:
+				channel.close()
+		d = deferToThread( call )
+		d.addCallback( self.assertEquals, ( [ str( i ) for i in range( 20 ) ], "proxy" ) )
+		return d
+
+	def testCompactMethodIds( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = "compact"
+			echoed = proxy.Test.Echo( request )
+			echoed.addCallback( lambda r: self.assertEquals( r.text, "compact" ) )
+			return echoed
+
+		client = ClientCreator( reactor, tx.TcpChannel, compact_methods=True )
+		d = client.connectTCP( self.tcp_listener.getHost().host,
+			self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testServiceNotFound( self ):
+		listener = reactor.listenTCP( 0, tx.Factory() )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			controller = Controller()
+			d = Deferred()
+			request = EchoRequest()
+			request.text = "missing"
+			Test_Stub( protocol ).Echo( controller, request, d.callback )
+			d.addCallback( lambda r: self.assertEquals( controller.ErrorText(),
+				RpcErrors.msgs[ RpcErrors.SERVICE_NOT_FOUND ] ) )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( listener.getHost().host, listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def silentServer( self ):
+		listener = reactor.listenTCP( 0, tx.Factory( SilentService() ) )
+		self.addCleanup( listener.stopListening )
+		return listener.getHost()
+
+	def testTimeout( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			controller = Controller()
+			controller.timeout = 0.05
+			d = Deferred()
+			request = EchoRequest()
+			request.text = "lost"
+			Test_Stub( protocol ).Echo( controller, request, d.callback )
+			def check( response ):
+				self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.TIMEOUT ] )
+				self.assertEquals( len( protocol._pending ), 0 )
+			d.addCallback( check )
+			return d
+
+		host = self.silentServer()
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def cancellableServer( self ):
+		service = CancellableService()
+		listener = reactor.listenTCP( 0, tx.Factory( service ) )
+		self.addCleanup( listener.stopListening )
+		return service, listener.getHost()
+
+	def testCancel( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			controller = Controller()
+			d = Deferred()
+			request = EchoRequest()
+			request.text = "cancelled"
+			Test_Stub( protocol ).Echo( controller, request, d.callback )
+			service.started.addCallback( lambda text: controller.StartCancel() )
+			def check( response ):
+				self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.CANCELLED ] )
+				self.assertEquals( len( protocol._pending ), 0 )
+				return service.cancelled
+			d.addCallback( check )
+			d.addCallback( self.assertEquals, "cancelled" )
+			return d
+
+		service, host = self.cancellableServer()
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testDeadlinePropagation( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			controller = Controller()
+			controller.timeout = 0.05
+			request = EchoRequest()
+			request.text = "expired"
+			Test_Stub( protocol ).Echo( controller, request, lambda response: None )
+			def check( text ):
+				self.assertEquals( text, "expired" )
+				self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.TIMEOUT ] )
+			return service.cancelled.addCallback( check )
+
+		service, host = self.cancellableServer()
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testMaxPending( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			stub = Test_Stub( protocol )
+			controllers = [ Controller(), Controller() ]
+			request = EchoRequest()
+			request.text = "full"
+			stub.Echo( controllers[ 0 ], request, lambda r: None )
+			stub.Echo( controllers[ 1 ], request, lambda r: None )
+			self.assertEquals( controllers[ 0 ].ErrorText(), None )
+			self.assertEquals( controllers[ 1 ].ErrorText(),
+				RpcErrors.msgs[ RpcErrors.TOO_MANY_PENDING ] )
+
+		host = self.silentServer()
+		client = ClientCreator( reactor, tx.TcpChannel, max_pending=1, block=False )
+		d = client.connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testMaxWaiting( self ):
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			stub = Test_Stub( protocol )
+			controllers = [ Controller(), Controller(), Controller() ]
+			controllers[ 1 ].timeout = 0.05
+			request = EchoRequest()
+			request.text = "waiting"
+			d = Deferred()
+			stub.Echo( controllers[ 0 ], request, lambda r: None )
+			stub.Echo( controllers[ 1 ], request, d.callback )
+			stub.Echo( controllers[ 2 ], request, lambda r: None )
+			self.assertEquals( controllers[ 2 ].ErrorText(),
+				RpcErrors.msgs[ RpcErrors.TOO_MANY_PENDING ] )
+			# The waiting call times out without ever getting a slot.
+			def check( response ):
+				self.assertEquals( controllers[ 1 ].ErrorText(), RpcErrors.msgs[ RpcErrors.TIMEOUT ] )
+				self.assertEquals( ( len( protocol._pending ), len( protocol._waiting ) ), ( 1, 0 ) )
+			return d.addCallback( check )
+
+		host = self.silentServer()
+		client = ClientCreator( reactor, tx.TcpChannel, max_pending=1, max_waiting=1 )
+		d = client.connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testSynchronousTimeout( self ):
+		host = self.silentServer()
+		def call():
+			channel = synchronous.TcpChannel( ( host.host, host.port ), timeout=0.05 )
+			try:
+				controller = Controller()
+				request = EchoRequest()
+				request.text = "lost"
+				Test_Stub( channel ).Echo( controller, request, None )
+				return controller.ErrorText(), len( channel._pending )
+			finally:
+				channel._tcpSocket.close()
+		d = deferToThread( call )
+		d.addCallback( self.assertEquals, ( RpcErrors.msgs[ RpcErrors.TIMEOUT ], 0 ) )
+		return d
+
+	def testPooledChannel( self ):
+		other = reactor.listenTCP( 0, tx.Factory( self.service ) )
+		self.addCleanup( other.stopListening )
+		dead = reactor.listenTCP( 0, tx.Factory() )
+		deadHost = dead.getHost()
+		dead.stopListening()
+		endpoints = [ ( h.host, h.port ) for h in ( deadHost, self.tcp_listener.getHost(), other.getHost() ) ]
+		pool = tx.PooledChannel( endpoints, size=2, balance="p2c", max_failures=1 )
+		self.addCleanup( pool.close )
+		proxy = tx.Proxy( Test_Stub( pool ) )
+		calls = []
+		for i in range( 20 ):
+			request = EchoRequest()
+			request.text = str( i )
+			calls.append( proxy.Test.Echo( request ) )
+		d = DeferredList( calls, fireOnOneErrback=True )
+		d.addCallback( lambda results: self.assertEquals( [ r.text for ok, r in results ],
+			[ str( i ) for i in range( 20 ) ] ) )
+		return d
+
+	def testLazyFieldNames( self ):
+		note = Note()
+		note.message = "hello"
+		note.parsed = True
+		lazy = LazyMessage( Note, note.SerializeToString() )
+		self.failIf( lazy._parsed() )
+		self.assertEquals( ( lazy.message, lazy.parsed ), ( "hello", True ) )
+		self.failUnless( lazy._parsed() )
+		lazy.message = "bye"
+		self.assertEquals( Note.FromString( lazy.SerializeToString() ).message, "bye" )
+		self.assertEquals( lazy, Note.FromString( lazy.SerializeToString() ) )
+
+	def testEnvelope( self ):
+		rpc = Rpc()
+		request = rpc.request.add()
+		request.method = "Test.Echo"
+		request.serialized_request = "payload"
+		request.id = 300
+		request.timeout = 1500
+		request.accept_compression.extend( [ Compression.ZLIB ] )
+		request = rpc.request.add()
+		request.id = 7
+		request.method_id = 4000000000
+		request.more = True
+		request = rpc.request.add()
+		request.id = 8
+		request.cancel = True
+		self.assertEquals( encode_request( 300, "Test.Echo", "payload", 1500, codecs=[ Compression.ZLIB ] ) +
+			encode_request( 7, 4000000000, more=True ) + encode_request( 8, cancel=True ), rpc.SerializeToString() )
+
+		rpc = Rpc()
+		response = rpc.response.add()
+		response.id = 1
+		response.serialized_response = "x" * 200
+		response.compression = Compression.ZLIB
+		response = rpc.response.add()
+		response.id = 2
+		response.more = True
+		response.error.code = -3
+		response.error.text = u"\u00e9chec"
+		data = encode_response( 1, "x" * 200, codec=Compression.ZLIB ) + \
+			encode_response( 2, error=( -3, u"\u00e9chec" ), more=True )
+		self.assertEquals( data, rpc.SerializeToString() )
+		scanned = scan_responses( data )
+		self.assertEquals( [ ( r.id, r.serialized_response, r.compression, r.more, r.HasField( 'error' ) )
+			for r in scanned ], [ ( 1, "x" * 200, Compression.ZLIB, False, False ), ( 2, "", 0, True, True ) ] )
+		self.assertEquals( ( scanned[ 1 ].error.code, scanned[ 1 ].error.text ), ( -3, u"\u00e9chec" ) )
+		self.assertEquals( scan_responses( encode_request( 1 ) + data ), None )
+
+	def testRawForwarding( self ):
+		def connected( backend ):
+			self.tcp_proxy_proto = backend
+			service = ForwardingService( tx.Proxy( Test_Stub( backend ), decoding="raw" ) )
+			front = reactor.listenTCP( 0, tx.Factory( service, decoding="raw" ) )
+			self.addCleanup( front.stopListening )
+			client = ClientCreator( reactor, tx.TcpChannel, decoding="lazy" )
+			d = client.connectTCP( "127.0.0.1", front.getHost().port )
+			d.addCallback( call, service )
+			return d
+
+		def call( protocol, service ):
+			self.addCleanup( protocol.transport.loseConnection )
+			request = EchoRequest()
+			request.text = "forwarded"
+			d = tx.Proxy( Test_Stub( protocol ) ).Test.Echo( request )
+			def check( response ):
+				self.failIf( response._parsed() )
+				self.assertEquals( response.text, "forwarded" )
+				self.failUnless( response._parsed() )
+				self.assertEquals( [ type( r ) for r in service.requests ], [ RawMessage ] )
+				self.assertEquals( service.requests[ 0 ].data, request.SerializeToString() )
+			d.addCallback( check )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( self.tcp_listener.getHost().host, self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testUnixSocket( self ):
+		listener = reactor.listenUNIX( self.mktemp(), tx.Factory( self.service ) )
+		self.addCleanup( listener.stopListening )
+		pool = tx.PooledChannel( [ listener.getHost().name ] )
+		self.addCleanup( pool.close )
+		proxy = tx.Proxy( Test_Stub( pool ) )
+		request = EchoRequest()
+		request.text = "Unix Test"
+		echoed = proxy.Test.Echo( request )
+		echoed.addCallback( lambda r: self.assertEquals( r.text, "Unix Test" ) )
+		return echoed
+
+	def testStreaming( self ):
+		def collect( stream, texts ):
+			def received( response ):
+				if response is None:
+					return texts
+				texts.append( response.text )
+				return collect( stream, texts )
+			return stream.next().addCallback( received )
+
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = "one two three"
+			split = collect( proxy.Test.Split.stream( request ), [] )
+			split.addCallback( self.assertEquals, [ "one", "two", "three" ] )
+
+			upload = proxy.Test.Join.open()
+			for text in [ "four", "five" ]:
+				request = EchoRequest()
+				request.text = text
+				upload.write( request )
+			upload.close()
+			join = collect( upload, [] )
+			join.addCallback( self.assertEquals, [ "four five" ] )
+			return DeferredList( [ split, join ], fireOnOneErrback=True )
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( self.tcp_listener.getHost().host,
+			self.tcp_listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testCompression( self ):
+		listener = reactor.listenTCP( 0, tx.Factory( self.service, compression=True,
+			compression_threshold=64 ) )
+		self.addCleanup( listener.stopListening )
+		text = "compressible " * 100
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = text
+			def echo( response=None ):
+				if response is not None:
+					self.assertEquals( response.text, text )
+				return proxy.Test.Echo( request )
+			d = echo()
+			d.addCallback( echo )
+			d.addCallback( echo )
+			def check( response ):
+				self.assertEquals( response.text, text )
+				self.assertEquals( protocol.compressor().codec, Compression.available[ 0 ] )
+			d.addCallback( check )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel, compression=True, compression_threshold=64 )
+		d = client.connectTCP( listener.getHost().host, listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testUdpCompression( self ):
+		server = tx.UdpChannel( compression=True, compression_threshold=64 )
+		server.add_service( self.service )
+		listener = reactor.listenUDP( 0, server )
+		self.addCleanup( listener.stopListening )
+		protocol = tx.UdpChannel( listener.getHost().host, listener.getHost().port,
+			compression=True, compression_threshold=64 )
+		port = reactor.listenUDP( 0, protocol )
+		self.addCleanup( port.stopListening )
+		sent = []
+		sendString = protocol.send_string
+		def record( data, host=None, port=None ):
+			rpc = Rpc()
+			rpc.ParseFromString( data )
+			sent.append( rpc.request[ 0 ] )
+			sendString( data, host, port )
+		protocol.send_string = record
+		proxy = tx.Proxy( Test_Stub( protocol ) )
+		request = EchoRequest()
+		request.text = "compressible " * 100
+		def echo( response=None ):
+			if response is not None:
+				self.assertEquals( response.text, request.text )
+			return proxy.Test.Echo( request )
+		d = echo()
+		d.addCallback( echo )
+		d.addCallback( echo )
+		def check( response ):
+			self.assertEquals( response.text, request.text )
+			codec = Compression.available[ 0 ]
+			self.assertEquals( [ r.compression for r in sent ], [ 0, codec, codec ] )
+			self.assertEquals( list( sent[ -1 ].accept_compression ), [] )
+		d.addCallback( check )
+		return d
+
+	def testFlowControl( self ):
+		service = SlowService()
+		listener = reactor.listenTCP( 0, tx.Factory( service, max_in_flight=2, max_total_in_flight=3 ) )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.addCleanup( protocol.transport.loseConnection )
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			calls = []
+			for i in range( 6 ):
+				request = EchoRequest()
+				request.text = str( i )
+				calls.append( proxy.Test.Echo( request ) )
+			return DeferredList( calls, fireOnOneErrback=True )
+		def check( results ):
+			for ok, calls in results:
+				self.assertEquals( [ r.text for success, r in calls ], [ str( i ) for i in range( 6 ) ] )
+			self.assertEquals( service.most, 3 )
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		host = listener.getHost()
+		calls = [ client.connectTCP( host.host, host.port ).addCallback( connected ) for i in range( 2 ) ]
+		d = DeferredList( calls, fireOnOneErrback=True )
+		d.addCallback( check )
+		return d
+
+	def testThreadExecution( self ):
+		service = BlockingService()
+		listener = reactor.listenTCP( 0, tx.Factory( service, execution={ "Test.Echo": "thread" } ) )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = "blocked"
+			blocked = proxy.Test.Echo( request )
+			request = EchoRequest()
+			request.text = "inline"
+			# Split runs on the reactor while Echo blocks its thread.
+			inline = proxy.Test.Split.stream( request ).next()
+			def released( response ):
+				service.release.set()
+				return response.text
+			inline.addCallback( released )
+			d = DeferredList( [ blocked, inline ], fireOnOneErrback=True )
+			d.addCallback( lambda results: self.assertEquals(
+				[ results[ 0 ][ 1 ].text, results[ 1 ][ 1 ] ], [ "blocked", "inline" ] ) )
+			return d
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( listener.getHost().host, listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testProcessExecution( self ):
+		listener = reactor.listenTCP( 0, tx.Factory( self.service, execution={ "Test": "process" },
+			processes=1 ) )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = "elsewhere"
+			echoed = proxy.Test.Echo( request )
+			echoed.addCallback( lambda r: self.assertEquals( r.text, "elsewhere" ) )
+			return echoed
+
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = client.connectTCP( listener.getHost().host, listener.getHost().port )
+		d.addCallback( connected )
+		return d
+
+	def testMetrics( self ):
+		serverMetrics = Metrics()
+		clientMetrics = Metrics()
+		listener = reactor.listenTCP( 0, tx.Factory( self.service, metrics=serverMetrics,
+			execution={ "Test.Echo": "thread" } ) )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.tcp_proxy_proto = protocol
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = "measured"
+			calls = [ proxy.Test.Echo( request ), proxy.Test.Echo( request ) ]
+			return DeferredList( calls, fireOnOneErrback=True )
+		def check( results ):
+			snapshot = serverMetrics.snapshot()
+			echo = snapshot[ "methods" ][ "Test.Echo" ]
+			self.assertEquals( echo[ "latency" ][ "count" ], 2 )
+			self.assertEquals( echo[ "in_flight" ], 0 )
+			self.assertEquals( echo[ "request_size" ][ "sum" ], 2 * ( len( "measured" ) + 2 ) )
+			self.assertEquals( clientMetrics.snapshot()[ "calls" ][ "Test.Echo" ][ "latency" ][ "count" ], 2 )
+			self.assertEquals( snapshot[ "frames_out" ], clientMetrics.snapshot()[ "frames_in" ] )
+			text = serverMetrics.prometheus()
+			self.assertIn( 'protobufrpc_handler_seconds_count{method="Test.Echo"} 2', text )
+			self.assertIn( 'protobufrpc_frames_sent_total', text )
+
+		client = ClientCreator( reactor, tx.TcpChannel, metrics=clientMetrics )
+		d = client.connectTCP( listener.getHost().host, listener.getHost().port )
+		d.addCallback( connected )
+		d.addCallback( check )
+		return d
+
+	def testMetricsInFlight( self ):
+		metrics = Metrics()
+		listener = reactor.listenTCP( 0, tx.Factory( SilentService(), metrics=metrics ) )
+		self.addCleanup( listener.stopListening )
+		def inFlight():
+			return metrics.snapshot()[ "methods" ][ "Test.Echo" ][ "in_flight" ]
+		def connected( protocol ):
+			request = EchoRequest()
+			request.text = "unanswered"
+			self.addCleanup( protocol.transport.loseConnection )
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			cancelled = Controller()
+			proxy.Test.Echo.call( request, lambda response: None, cancelled )
+			proxy.Test.Echo( request )
+			d = waitFor( lambda: metrics.snapshot()[ "methods" ] and inFlight() == 2 )
+			# Cancelled requests and those of a lost connection are over,
+			# although the service never answers them.
+			d.addCallback( lambda _: cancelled.StartCancel() )
+			d.addCallback( lambda _: waitFor( lambda: inFlight() == 1 ) )
+			d.addCallback( lambda _: protocol.transport.loseConnection() )
+			d.addCallback( lambda _: waitFor( lambda: inFlight() == 0 ) )
+			d.addCallback( lambda _: self.assertEquals( metrics.snapshot()[ "in_flight" ], 0 ) )
+			return d
+
+		host = listener.getHost()
+		d = ClientCreator( reactor, tx.TcpChannel ).connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		metrics.error( RpcErrors.UNSERIALIZE_RPC )
+		self.assertIn( 'protobufrpc_errors_total{code="application"} 1', metrics.prometheus() )
+		return d
+
+	def testResponseCache( self ):
+		service = CountingService()
+		serverCache = ResponseCache( [ "Test.Echo" ] )
+		listener = reactor.listenTCP( 0, tx.Factory( service, cache=serverCache ) )
+		self.addCleanup( listener.stopListening )
+		clientCache = ResponseCache( [ "Test" ] )
+		def echo( protocol, text ):
+			request = EchoRequest()
+			request.text = text
+			return tx.Proxy( Test_Stub( protocol ) ).Test.Echo( request )
+		def connected( protocols ):
+			plain, caching = [ protocol for ok, protocol in protocols ]
+			self.addCleanup( plain.transport.loseConnection )
+			self.addCleanup( caching.transport.loseConnection )
+			d = echo( plain, "cached" )
+			d.addCallback( lambda r: echo( plain, "cached" ) )
+			d.addCallback( lambda r: self.assertEquals( ( r.text, service.calls, serverCache.hits ),
+				( "cached", 1, 1 ) ) )
+			d.addCallback( lambda r: echo( caching, "local" ) )
+			d.addCallback( lambda r: echo( caching, "local" ) )
+			d.addCallback( lambda r: self.assertEquals( ( r.text, service.calls, clientCache.hits ),
+				( "local", 2, 1 ) ) )
+			return d
+
+		host = listener.getHost()
+		calls = [ ClientCreator( reactor, tx.TcpChannel ).connectTCP( host.host, host.port ),
+			ClientCreator( reactor, tx.TcpChannel, cache=clientCache ).connectTCP( host.host, host.port ) ]
+		d = DeferredList( calls, fireOnOneErrback=True )
+		d.addCallback( connected )
+		return d
+
+	def testResponseCacheEviction( self ):
+		cache = ResponseCache( { "Test.Echo": None, "Test.Split": 0 }, max_entries=2, max_bytes=20 )
+		cache.put( "Test.Echo", "a", "1" )
+		cache.put( "Test.Echo", "b", "2" )
+		self.assertEquals( cache.get( "Test.Echo", "a" ), "1" )
+		cache.put( "Test.Echo", "c", "3" )
+		self.assertEquals( cache.get( "Test.Echo", "b" ), None )
+		cache.put( "Test.Echo", "d", "x" * 16 )
+		self.assertEquals( ( cache.get( "Test.Echo", "a" ), cache.size ), ( None, 19 ) )
+		cache.put( "Test.Echo", "e", "x" * 20 )
+		self.assertEquals( cache.get( "Test.Echo", "e" ), None )
+		cache.put( "Test.Split", "f", "6" )
+		self.assertEquals( cache.get( "Test.Split", "f" ), None )
+		self.failIf( cache.enabled( "Test.Join" ) )
+
+	def testSingleFlight( self ):
+		service = SlowService()
+		serverFlight = SingleFlight()
+		listener = reactor.listenTCP( 0, tx.Factory( service, single_flight=serverFlight ) )
+		self.addCleanup( listener.stopListening )
+		clientFlight = SingleFlight( [ "Test" ] )
+		def echo( protocol, text ):
+			request = EchoRequest()
+			request.text = text
+			return tx.Proxy( Test_Stub( protocol ) ).Test.Echo( request )
+		def connected( protocols ):
+			plain, collapsing = [ protocol for ok, protocol in protocols ]
+			self.addCleanup( plain.transport.loseConnection )
+			self.addCleanup( collapsing.transport.loseConnection )
+			texts = [ "herd", "herd", "herd", "other" ]
+			calls = [ echo( collapsing, text ) for text in texts ] + [ echo( plain, "herd" ) ]
+			d = DeferredList( calls, fireOnOneErrback=True )
+			def check( results ):
+				self.assertEquals( [ r.text for ok, r in results ], texts + [ "herd" ] )
+				self.assertEquals( len( set( [ id( r ) for ok, r in results ] ) ), 5 )
+				self.assertEquals( ( service.calls, clientFlight.shared, serverFlight.shared ), ( 2, 2, 1 ) )
+			d.addCallback( check )
+			return d
+
+		host = listener.getHost()
+		calls = [ ClientCreator( reactor, tx.TcpChannel ).connectTCP( host.host, host.port ),
+			ClientCreator( reactor, tx.TcpChannel, single_flight=clientFlight ).connectTCP( host.host, host.port ) ]
+		d = DeferredList( calls, fireOnOneErrback=True )
+		d.addCallback( connected )
+		return d
+
+	def testSingleFlightLeaderTimeout( self ):
+		service = DelayedService( 0.3 )
+		listener = reactor.listenTCP( 0, tx.Factory( service, single_flight=SingleFlight() ) )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.addCleanup( protocol.transport.loseConnection )
+			proxy = tx.Proxy( Test_Stub( protocol ) )
+			request = EchoRequest()
+			request.text = "herd"
+			leader = Deferred()
+			controller = Controller()
+			controller.timeout = 0.1
+			proxy.Test.Echo.call( request, leader.callback, controller )
+			follower = proxy.Test.Echo( request )
+			d = DeferredList( [ leader, follower ], fireOnOneErrback=True )
+			def check( results ):
+				self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.TIMEOUT ] )
+				self.assertEquals( results[ 1 ][ 1 ].text, "herd" )
+				self.assertEquals( service.calls, 1 )
+			d.addCallback( check )
+			return d
+
+		host = listener.getHost()
+		d = ClientCreator( reactor, tx.TcpChannel ).connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testConnectionRegistry( self ):
+		factory = tx.Factory( TestService() )
+		listener = reactor.listenTCP( 0, factory )
+		self.addCleanup( listener.stopListening )
+		def connected( protocols ):
+			first, second = [ protocol for ok, protocol in protocols ]
+			self.addCleanup( second.transport.loseConnection )
+			self.assertEquals( len( factory._protocols ), 2 )
+			first.transport.loseConnection()
+			return waitFor( lambda: len( factory._protocols ) == 1 )
+
+		host = listener.getHost()
+		client = ClientCreator( reactor, tx.TcpChannel )
+		d = DeferredList( [ client.connectTCP( host.host, host.port ) for i in range( 2 ) ], fireOnOneErrback=True )
+		d.addCallback( connected )
+		return d
+
+	def testIdleTimeout( self ):
+		factory = tx.Factory( TestService(), idle_timeout=0.1 )
+		listener = reactor.listenTCP( 0, factory )
+		self.addCleanup( listener.stopListening )
+		def connected( protocol ):
+			self.addCleanup( protocol.transport.loseConnection )
+			request = EchoRequest()
+			request.text = "idle"
+			d = tx.Proxy( Test_Stub( protocol ) ).Test.Echo( request )
+			d.addCallback( lambda response: protocol.closed )
+			d.addCallback( lambda _: waitFor( lambda: not factory._protocols ) )
+			return d
+
+		host = listener.getHost()
+		d = ClientCreator( reactor, ClosingChannel ).connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testMaxConnections( self ):
+		listener = reactor.listenTCP( 0, tx.Factory( TestService(), max_connections=1 ) )
+		self.addCleanup( listener.stopListening )
+		host = listener.getHost()
+		client = ClientCreator( reactor, ClosingChannel )
+		def connected( first ):
+			self.addCleanup( first.transport.loseConnection )
+			d = client.connectTCP( host.host, host.port )
+			d.addCallback( lambda second: second.closed )
+			d.addCallback( lambda _: self.failIf( first.closed.called ) )
+			return d
+
+		d = client.connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testDrain( self ):
+		service = SlowService()
+		factory = tx.Factory( service )
+		listener = reactor.listenTCP( 0, factory )
+		def connected( protocol ):
+			self.addCleanup( protocol.transport.loseConnection )
+			request = EchoRequest()
+			request.text = "drained"
+			call = tx.Proxy( Test_Stub( protocol ) ).Test.Echo( request )
+			d = waitFor( lambda: service.running )
+			d.addCallback( lambda _: DeferredList( [ call, factory.drain( listener ), protocol.closed ],
+				fireOnOneErrback=True ) )
+			def check( results ):
+				self.assertEquals( results[ 0 ][ 1 ].text, "drained" )
+				self.assertEquals( ( service.calls, factory._protocols, factory.numPorts ), ( 1, set(), 0 ) )
+			d.addCallback( check )
+			return d
+
+		host = listener.getHost()
+		d = ClientCreator( reactor, ClosingChannel ).connectTCP( host.host, host.port )
+		d.addCallback( connected )
+		return d
+
+	def testTxWorkerNeedsNoReactor( self ):
+		# The reactor this suite runs on would be shared with the workers.
+		self.assertRaises( RuntimeError, tx_worker, TestService() )
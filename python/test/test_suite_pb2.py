@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: test_suite.proto
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import message as _message
+from google.protobuf import reflection as _reflection
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf import service as _service
+from google.protobuf import service_reflection
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor.FileDescriptor(
+  name='test_suite.proto',
+  package='test_suite',
+  syntax='proto2',
+  serialized_options=b'\220\001\001',
+  create_key=_descriptor._internal_create_key,
+  serialized_pb=b'\n\x10test_suite.proto\x12\ntest_suite\"\x1b\n\x0b\x45\x63hoRequest\x12\x0c\n\x04text\x18\x01 \x02(\t\"\x1c\n\x0c\x45\x63hoResponse\x12\x0c\n\x04text\x18\x01 \x02(\t\"\'\n\x04Note\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x0e\n\x06parsed\x18\x02 \x01(\x08\x32\xb8\x01\n\x04Test\x12\x39\n\x04\x45\x63ho\x12\x17.test_suite.EchoRequest\x1a\x18.test_suite.EchoResponse\x12:\n\x05Split\x12\x17.test_suite.EchoRequest\x1a\x18.test_suite.EchoResponse\x12\x39\n\x04Join\x12\x17.test_suite.EchoRequest\x1a\x18.test_suite.EchoResponseB\x03\x90\x01\x01'
+)
+
+
+
+
+_ECHOREQUEST = _descriptor.Descriptor(
+  name='EchoRequest',
+  full_name='test_suite.EchoRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='text', full_name='test_suite.EchoRequest.text', index=0,
+      number=1, type=9, cpp_type=9, label=2,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto2',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=32,
+  serialized_end=59,
+)
+
+
+_ECHORESPONSE = _descriptor.Descriptor(
+  name='EchoResponse',
+  full_name='test_suite.EchoResponse',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='text', full_name='test_suite.EchoResponse.text', index=0,
+      number=1, type=9, cpp_type=9, label=2,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto2',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=61,
+  serialized_end=89,
+)
+
+
+_NOTE = _descriptor.Descriptor(
+  name='Note',
+  full_name='test_suite.Note',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='message', full_name='test_suite.Note.message', index=0,
+      number=1, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='parsed', full_name='test_suite.Note.parsed', index=1,
+      number=2, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto2',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=91,
+  serialized_end=130,
+)
+
+DESCRIPTOR.message_types_by_name['EchoRequest'] = _ECHOREQUEST
+DESCRIPTOR.message_types_by_name['EchoResponse'] = _ECHORESPONSE
+DESCRIPTOR.message_types_by_name['Note'] = _NOTE
+_sym_db.RegisterFileDescriptor(DESCRIPTOR)
+
+EchoRequest = _reflection.GeneratedProtocolMessageType('EchoRequest', (_message.Message,), {
+  'DESCRIPTOR' : _ECHOREQUEST,
+  '__module__' : 'test_suite_pb2'
+  # @@protoc_insertion_point(class_scope:test_suite.EchoRequest)
+  })
+_sym_db.RegisterMessage(EchoRequest)
+
+EchoResponse = _reflection.GeneratedProtocolMessageType('EchoResponse', (_message.Message,), {
+  'DESCRIPTOR' : _ECHORESPONSE,
+  '__module__' : 'test_suite_pb2'
+  # @@protoc_insertion_point(class_scope:test_suite.EchoResponse)
+  })
+_sym_db.RegisterMessage(EchoResponse)
+
+Note = _reflection.GeneratedProtocolMessageType('Note', (_message.Message,), {
+  'DESCRIPTOR' : _NOTE,
+  '__module__' : 'test_suite_pb2'
+  # @@protoc_insertion_point(class_scope:test_suite.Note)
+  })
+_sym_db.RegisterMessage(Note)
+
+
+DESCRIPTOR._options = None
+
+_TEST = _descriptor.ServiceDescriptor(
+  name='Test',
+  full_name='test_suite.Test',
+  file=DESCRIPTOR,
+  index=0,
+  serialized_options=None,
+  create_key=_descriptor._internal_create_key,
+  serialized_start=133,
+  serialized_end=317,
+  methods=[
+  _descriptor.MethodDescriptor(
+    name='Echo',
+    full_name='test_suite.Test.Echo',
+    index=0,
+    containing_service=None,
+    input_type=_ECHOREQUEST,
+    output_type=_ECHORESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
+  _descriptor.MethodDescriptor(
+    name='Split',
+    full_name='test_suite.Test.Split',
+    index=1,
+    containing_service=None,
+    input_type=_ECHOREQUEST,
+    output_type=_ECHORESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
+  _descriptor.MethodDescriptor(
+    name='Join',
+    full_name='test_suite.Test.Join',
+    index=2,
+    containing_service=None,
+    input_type=_ECHOREQUEST,
+    output_type=_ECHORESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
+])
+_sym_db.RegisterServiceDescriptor(_TEST)
+
+DESCRIPTOR.services_by_name['Test'] = _TEST
+
+Test = service_reflection.GeneratedServiceType('Test', (_service.Service,), dict(
+  DESCRIPTOR = _TEST,
+  __module__ = 'test_suite_pb2'
+  ))
+
+Test_Stub = service_reflection.GeneratedServiceStubType('Test_Stub', (Test,), dict(
+  DESCRIPTOR = _TEST,
+  __module__ = 'test_suite_pb2'
+  ))
+
+
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,481 @@
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import socket
+import signal
+import os
+import time
+import sys
+import subprocess
+from protobufrpc import synchronous
+from protobufrpc.supervisor import Supervisor, synchronous_worker
+from protobufrpc.common import Controller, RpcErrors, Compression, ResponseCache, SingleFlight, RawMessage
+from protobufrpc.metrics import Metrics
+from twisted.trial import unittest
+from test_suite_pb2 import Test_Stub, EchoRequest, EchoResponse
+from test_service import TestService
+
+# Keeps the texts it echoes; "slow" takes a while.
+class RecordingService( TestService ):
+	def __init__( self ):
+		self.texts = []
+
+	def Echo( self, rpc_controller, request, done ):
+		self.texts.append( request.text )
+		if request.text == "slow":
+			time.sleep( 0.2 )
+		TestService.Echo( self, rpc_controller, request, done )
+
+class ServerTestCase( unittest.TestCase ):
+	serverClass = synchronous.TcpServer
+	serverArgs = {}
+	# Whether the server's metrics are kept in this process.
+	localMetrics = True
+
+	def setUp( self ):
+		self.metrics = Metrics()
+		self.cache = ResponseCache( [ "Test.Echo" ] )
+		self.server = self.serverClass( self.address(), TestService(), compression=True,
+			compression_threshold=64, metrics=self.metrics, cache=self.cache, **self.serverArgs )
+		self.thread = threading.Thread( target=self.server.serve_forever )
+		self.thread.setDaemon( True )
+		self.thread.start()
+
+	def tearDown( self ):
+		self.server.shutdown()
+		self.thread.join()
+		self.server.server_close()
+
+	def address( self ):
+		return ( "127.0.0.1", 0 )
+
+	def echo( self, proxy, text ):
+		request = EchoRequest()
+		request.text = text
+		return proxy.Test.Echo( request )[ 0 ].text
+
+	def testPersistentConnection( self ):
+		channel = synchronous.TcpChannel( self.server.server_address )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			for text in [ "one", "two", "three" ]:
+				self.assertEquals( self.echo( proxy, text ), text )
+		finally:
+			channel._tcpSocket.close()
+
+	def testDirectCall( self ):
+		channel = synchronous.TcpChannel( self.server.server_address )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			self.assertIdentical( proxy.Test.Echo, proxy.Test.Echo )
+			controller = Controller()
+			controller.timeout = 5
+			for text in [ "one", "two" ]:
+				request = EchoRequest()
+				request.text = text
+				controller.Reset()
+				self.assertEquals( ( controller.timeout, controller.canceller ), ( None, None ) )
+				self.assertEquals( proxy.Test.Echo.call( request, controller ).text, text )
+				self.failIf( controller.Failed() )
+			self.assertEquals( proxy.Test.Echo.call( request ).text, "two" )
+		finally:
+			channel.close()
+
+	def testPipelined( self ):
+		channel = synchronous.PipelinedTcpChannel( self.server.server_address, max_pending=8 )
+		stub = Test_Stub( channel )
+		try:
+			futures = []
+			for i in range( 50 ):
+				request = EchoRequest()
+				request.text = str( i )
+				futures.append( stub.Echo( None, request, None ) )
+			self.assertEquals( [ f.result( 5 ).text for f in futures ],
+				[ str( i ) for i in range( 50 ) ] )
+		finally:
+			channel.close()
+
+	def testStreaming( self ):
+		for channelClass in [ synchronous.TcpChannel, synchronous.PipelinedTcpChannel ]:
+			channel = channelClass( self.server.server_address )
+			proxy = synchronous.Proxy( Test_Stub( channel ) )
+			try:
+				request = EchoRequest()
+				request.text = "one two three"
+				self.assertEquals( [ r.text for r in proxy.Test.Split.stream( request ) ],
+					[ "one", "two", "three" ] )
+
+				upload = proxy.Test.Join.open()
+				for text in [ "four", "five" ]:
+					request = EchoRequest()
+					request.text = text
+					upload.write( request )
+				request = EchoRequest()
+				request.text = "six"
+				upload.close( request )
+				self.assertEquals( [ r.text for r in upload ], [ "four five six" ] )
+				self.assertEquals( self.echo( proxy, "after" ), "after" )
+			finally:
+				channel.close()
+
+	def testLargeMessages( self ):
+		channel = synchronous.PipelinedTcpChannel( self.server.server_address )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			for size in [ 10, 70000, 3 * 1024 * 1024 ]:
+				text = "".join( [ chr( 97 + i % 26 ) for i in range( 26 ) ] ) * ( size / 26 )
+				self.assertEquals( self.echo( proxy, text ), text )
+		finally:
+			channel.close()
+
+	def testCompression( self ):
+		text = "compressible " * 100
+		for channelClass in [ synchronous.TcpChannel, synchronous.PipelinedTcpChannel ]:
+			channel = channelClass( self.server.server_address, compression=True, compression_threshold=64 )
+			proxy = synchronous.Proxy( Test_Stub( channel ) )
+			try:
+				for i in range( 3 ):
+					self.assertEquals( self.echo( proxy, text ), text )
+				self.assertEquals( channel._compressor.codec, Compression.available[ 0 ] )
+				self.assertEquals( self.echo( proxy, "short" ), "short" )
+			finally:
+				channel.close()
+
+	def testPooled( self ):
+		dead = socket.socket()
+		dead.bind( ( "127.0.0.1", 0 ) )
+		deadAddress = dead.getsockname()
+		dead.close()
+		channel = synchronous.PooledChannel( [ deadAddress, self.server.server_address ] )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			for text in [ "one", "two", "three" ]:
+				self.assertEquals( self.echo( proxy, text ), text )
+		finally:
+			channel.close()
+
+	def testResponseCache( self ):
+		cache = ResponseCache( [ "Test.Echo" ] )
+		for channelClass in [ synchronous.TcpChannel, synchronous.PipelinedTcpChannel ]:
+			channel = channelClass( self.server.server_address, cache=cache )
+			proxy = synchronous.Proxy( Test_Stub( channel ) )
+			try:
+				self.assertEquals( self.echo( proxy, "cached" ), "cached" )
+				self.assertEquals( self.echo( proxy, "cached" ), "cached" )
+			finally:
+				channel.close()
+		self.assertEquals( ( cache.hits, cache.misses ), ( 3, 1 ) )
+
+		channel = synchronous.TcpChannel( self.server.server_address )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			self.assertEquals( self.echo( proxy, "on the server" ), "on the server" )
+			self.assertEquals( self.echo( proxy, "on the server" ), "on the server" )
+		finally:
+			channel.close()
+		if self.localMetrics:
+			self.assertEquals( self.cache.hits, 1 )
+
+	def testSingleFlight( self ):
+		flight = SingleFlight()
+		channel = synchronous.TcpChannel( self.server.server_address, single_flight=flight )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			batch = proxy.batch()
+			for text in [ "herd", "herd", "other" ]:
+				request = EchoRequest()
+				request.text = text
+				batch.Test.Echo( request )
+			self.assertEquals( len( channel._pending ), 2 )
+			self.assertEquals( [ r[ 0 ].text for r in batch.flush() ], [ "herd", "herd", "other" ] )
+		finally:
+			channel.close()
+		self.assertEquals( flight.shared, 1 )
+
+	def testRawDecoding( self ):
+		channel = synchronous.TcpChannel( self.server.server_address )
+		proxy = synchronous.Proxy( Test_Stub( channel ), decoding="raw" )
+		try:
+			request = EchoRequest()
+			request.text = "undecoded"
+			response = proxy.Test.Echo( RawMessage( request.SerializeToString() ) )[ 0 ]
+			self.assertEquals( type( response ), RawMessage )
+			self.assertEquals( EchoResponse.FromString( response.data ).text, "undecoded" )
+		finally:
+			channel.close()
+
+	def testMetrics( self ):
+		metrics = Metrics()
+		for channelClass in [ synchronous.TcpChannel, synchronous.PipelinedTcpChannel ]:
+			channel = channelClass( self.server.server_address, metrics=metrics )
+			proxy = synchronous.Proxy( Test_Stub( channel ) )
+			try:
+				text = "measured by %s" % channelClass.__name__
+				self.assertEquals( self.echo( proxy, text ), text )
+			finally:
+				channel.close()
+		self.assertEquals( metrics.snapshot()[ "calls" ][ "Test.Echo" ][ "latency" ][ "count" ], 2 )
+		self.assertEquals( metrics.snapshot()[ "frames_out" ], 2 )
+		if self.localMetrics:
+			snapshot = self.metrics.snapshot()
+			self.assertEquals( snapshot[ "methods" ][ "Test.Echo" ][ "latency" ][ "count" ], 2 )
+			self.assertEquals( snapshot[ "methods" ][ "Test.Echo" ][ "in_flight" ], 0 )
+			self.assertEquals( snapshot[ "frames_in" ], 2 )
+			self.assertIn( 'protobufrpc_handler_seconds_count{method="Test.Echo"} 2',
+				self.metrics.prometheus() )
+
+class ThreadPoolServerTestCase( ServerTestCase ):
+	serverClass = synchronous.ThreadPoolTcpServer
+	serverArgs = { "pool_size": 4, "max_in_flight": 8 }
+
+class PreForkServerTestCase( ServerTestCase ):
+	serverClass = synchronous.PreForkTcpServer
+	serverArgs = { "processes": 2, "pool_size": 2 }
+	localMetrics = False
+
+class SelectServerTestCase( ServerTestCase ):
+	serverClass = synchronous.SelectTcpServer
+
+class UnixServerTestCase( ThreadPoolServerTestCase ):
+	def address( self ):
+		return self.mktemp()
+
+	def tearDown( self ):
+		ThreadPoolServerTestCase.tearDown( self )
+		self.failIf( os.path.exists( self.server.server_address ) )
+
+class ShmServerTestCase( unittest.TestCase ):
+	def setUp( self ):
+		self.server = synchronous.ShmServer( self.mktemp(), TestService(), pool_size=2 )
+		self.thread = threading.Thread( target=self.server.serve_forever )
+		self.thread.setDaemon( True )
+		self.thread.start()
+
+	def tearDown( self ):
+		self.server.shutdown()
+		self.thread.join()
+		self.server.server_close()
+
+	def testShm( self ):
+		channel = synchronous.ShmChannel( self.server.server_address, ring_size=65536 )
+		proxy = synchronous.Proxy( Test_Stub( channel ) )
+		try:
+			# Enough calls to go round the rings several times, and one too
+			# big for them.
+			for i in range( 40 ):
+				text = str( i ) * 5000
+				request = EchoRequest()
+				request.text = text
+				self.assertEquals( proxy.Test.Echo( request )[ 0 ].text, text )
+			request.text = "x" * 100000
+			self.assertEquals( proxy.Test.Echo( request )[ 0 ].text, request.text )
+		finally:
+			channel.close()
+
+	def testForeignFileRejected( self ):
+		target = self.mktemp()
+		open( target, "w" ).write( "untouched" )
+		for path in [ target, os.path.join( synchronous._shm_directory(), "protobufrpc-missing" ) ]:
+			sock = socket.socket( socket.AF_UNIX )
+			try:
+				sock.connect( self.server.server_address )
+				synchronous.send_frame( sock, path )
+				self.assertEquals( synchronous.FrameReader( sock ).read_frame(), None )
+			finally:
+				sock.close()
+		self.assertEquals( open( target ).read(), "untouched" )
+
+	def testInlineFrames( self ):
+		client, server = socket.socketpair( socket.AF_UNIX )
+		rings, path = synchronous.SharedRings.create( 64 )
+		try:
+			peer = synchronous.SharedRings.open( path, os.getuid() )
+		finally:
+			os.unlink( path )
+		reader = peer.reader( synchronous.FrameReader( server ) )
+		try:
+			# Too big for the ring, then an empty frame that no longer fits.
+			frames = [ "x" * 100, "y" * 57, "" ]
+			for data in frames:
+				rings.send_frame( client, data )
+			for data in frames:
+				frame = reader.read_frame()
+				if isinstance( frame, memoryview ):
+					frame = frame.tobytes()
+				self.assertEquals( frame, data )
+		finally:
+			rings.close()
+			peer.close()
+			client.close()
+			server.close()
+
+class DeadlineTestCase( unittest.TestCase ):
+	def setUp( self ):
+		self.service = RecordingService()
+		self.server = synchronous.ThreadPoolTcpServer( ( "127.0.0.1", 0 ), self.service, pool_size=1 )
+		self.thread = threading.Thread( target=self.server.serve_forever )
+		self.thread.setDaemon( True )
+		self.thread.start()
+
+	def tearDown( self ):
+		self.server.shutdown()
+		self.thread.join()
+		self.server.server_close()
+
+	def call( self, stub, text, timeout=None ):
+		controller = Controller()
+		controller.timeout = timeout
+		request = EchoRequest()
+		request.text = text
+		return controller, stub.Echo( controller, request, None )
+
+	# A call that times out while queued behind a slow one is never run.
+	def testExpiredDropped( self ):
+		channel = synchronous.PipelinedTcpChannel( self.server.server_address )
+		stub = Test_Stub( channel )
+		try:
+			slow = self.call( stub, "slow" )[ 1 ]
+			controller, late = self.call( stub, "late", 0.05 )
+			late.result( 5 )
+			self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.TIMEOUT ] )
+			self.assertEquals( slow.result( 5 ).text, "slow" )
+			self.assertEquals( self.call( stub, "after" )[ 1 ].result( 5 ).text, "after" )
+		finally:
+			channel.close()
+		self.assertEquals( self.service.texts, [ "slow", "after" ] )
+
+	def testCancel( self ):
+		channel = synchronous.PipelinedTcpChannel( self.server.server_address )
+		stub = Test_Stub( channel )
+		try:
+			slow = self.call( stub, "slow" )[ 1 ]
+			controller, cancelled = self.call( stub, "cancelled" )
+			controller.StartCancel()
+			cancelled.result( 5 )
+			self.assertEquals( controller.ErrorText(), RpcErrors.msgs[ RpcErrors.CANCELLED ] )
+			self.assertEquals( slow.result( 5 ).text, "slow" )
+			self.assertEquals( self.call( stub, "after" )[ 1 ].result( 5 ).text, "after" )
+		finally:
+			channel.close()
+		self.assertEquals( self.service.texts, [ "slow", "after" ] )
+
+class SupervisorTestCase( unittest.TestCase ):
+	def setUp( self ):
+		self.supervisor = Supervisor( ( "127.0.0.1", 0 ), synchronous_worker( TestService() ),
+			workers=2, drain_time=5, restart_delay=0 )
+		self.thread = threading.Thread( target=self.supervisor.serve_forever )
+		self.thread.setDaemon( True )
+		self.thread.start()
+
+	def tearDown( self ):
+		self.supervisor.shutdown()
+		self.thread.join( 10 )
+		self.assertEquals( self.supervisor.children, {} )
+
+	def waitFor( self, condition ):
+		deadline = time.time() + 5
+		while not condition():
+			self.failIf( time.time() > deadline )
+			time.sleep( 0.01 )
+
+	def connect( self ):
+		def connected():
+			try:
+				self.channel = synchronous.TcpChannel( self.supervisor.server_address )
+				return True
+			except socket.error:
+				return False
+		self.waitFor( connected )
+		return synchronous.Proxy( Test_Stub( self.channel ) )
+
+	def testRestart( self ):
+		self.waitFor( lambda: len( self.supervisor.children ) == 2 )
+		proxy = self.connect()
+		request = EchoRequest()
+		request.text = "supervised"
+		self.assertEquals( proxy.Test.Echo( request )[ 0 ].text, "supervised" )
+		self.channel.close()
+
+		killed = self.supervisor.children.keys()[ 0 ]
+		os.kill( killed, signal.SIGKILL )
+		self.waitFor( lambda: len( self.supervisor.children ) == 2 and killed not in self.supervisor.children )
+		for i in range( 4 ):
+			proxy = self.connect()
+			self.assertEquals( proxy.Test.Echo( request )[ 0 ].text, "supervised" )
+			self.channel.close()
+
+# Serves Echo from tx workers, "slow" taking a while, and drains on SIGTERM.
+# It runs in a process of its own, which imports protobufrpc.tx but must not
+# have a reactor.
+_txSupervisor = """
+import sys, signal, threading
+from protobufrpc import tx
+from protobufrpc.supervisor import Supervisor, tx_worker
+from test_suite_pb2 import Test, EchoResponse
+
+class EchoService( Test ):
+	def Echo( self, rpc_controller, request, done ):
+		response = EchoResponse()
+		response.text = request.text
+		if request.text == "slow":
+			tx.reactor.callLater( 0.3, done, response )
+		else:
+			done( response )
+
+supervisor = Supervisor( ( "127.0.0.1", 0 ), tx_worker( EchoService() ), workers=2, drain_time=5 )
+signal.signal( signal.SIGTERM, lambda signum, frame: threading.Thread( target=supervisor.shutdown ).start() )
+print supervisor.server_address[ 1 ]
+sys.stdout.flush()
+supervisor.serve_forever()
+print len( supervisor.children ), "twisted.internet.reactor" in sys.modules
+"""
+
+class TxSupervisorTestCase( unittest.TestCase ):
+	def testServeAndDrain( self ):
+		env = dict( os.environ, PYTHONPATH=os.pathsep.join( sys.path ) )
+		process = subprocess.Popen( [ sys.executable, "-c", _txSupervisor ], stdout=subprocess.PIPE, env=env )
+		try:
+			address = ( "127.0.0.1", int( process.stdout.readline() ) )
+			deadline = time.time() + 5
+			while True:
+				try:
+					channel = synchronous.PipelinedTcpChannel( address )
+					break
+				except socket.error:
+					self.failIf( time.time() > deadline )
+					time.sleep( 0.05 )
+			try:
+				proxy = synchronous.Proxy( Test_Stub( channel ) )
+				request = EchoRequest()
+				request.text = "supervised"
+				self.assertEquals( proxy.Test.Echo.call( request ).text, "supervised" )
+				# A call in flight when the supervisor shuts down is answered.
+				request.text = "slow"
+				slow = channel.CallMethod( Test_Stub.GetDescriptor().methods[ 0 ], None, request, EchoResponse )
+				time.sleep( 0.1 )
+				process.send_signal( signal.SIGTERM )
+				self.assertEquals( slow.result( 5 ).text, "slow" )
+			finally:
+				channel.close()
+			self.assertEquals( process.stdout.read().split(), [ "0", "False" ] )
+			self.assertEquals( process.wait(), 0 )
+		finally:
+			if process.poll() is None:
+				process.kill()
+				process.wait()